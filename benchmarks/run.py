@@ -0,0 +1,361 @@
+"""
+Route Benchmarks
+================
+
+Drives the routes of the app in JSON and HTML modes against a database
+seeded by ``seed.py``. The requests go straight to the ASGI app, with a
+signed session cookie standing in for a Google login::
+
+    python benchmarks/run.py --data-dir .benchmarks
+
+The p50, p95 and p99 latencies and the throughput of every route, and the
+time taken to import the app, are compared with a stored baseline. Anything
+slower than the baseline by more than the tolerance is flagged and the run
+exits with status 1. Record a new baseline with ``--save-baseline``.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+accepts = {"json": "application/json", "html": "text/html"}
+"""Accept header sent for each response format"""
+
+import_budgets = {"pfaht.schema": 0.25, "pfaht.web.app": 1.5}
+"""Seconds a cold import of each module may take, whatever the baseline says"""
+
+
+@dataclass
+class Volumes:
+    """Largest ids in the seeded database, to pick random rows from"""
+
+    devices: int
+    issues: int
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: Callable[[random.Random, Volumes], str]
+    formats: tuple[str, ...] = ("json", "html")
+
+
+scenarios = [
+    Scenario("index", lambda rng, v: "/"),
+    Scenario("device list", lambda rng, v: "/devices"),
+    Scenario(
+        "device list deep page",
+        lambda rng, v: f"/devices?page={rng.randint(1, max(v.devices // 100, 1))}",
+    ),
+    Scenario("device list counts", lambda rng, v: "/devices?counts=true"),
+    Scenario(
+        "device list filtered",
+        lambda rng, v: "/devices?device_type=router&sort=device_name",
+    ),
+    Scenario("device", lambda rng, v: f"/devices/{rng.randint(1, max(v.devices, 1))}"),
+    Scenario(
+        "device issues",
+        lambda rng, v: f"/devices/{rng.randint(1, max(v.devices, 1))}/issues",
+        formats=("json",),
+    ),
+    Scenario("device types", lambda rng, v: "/device-types"),
+    Scenario("issue list", lambda rng, v: "/issues"),
+    Scenario("issue list counts", lambda rng, v: "/issues?counts=true"),
+    Scenario(
+        "issue list deep page",
+        lambda rng, v: f"/issues?page={rng.randint(1, max(v.issues // 100, 1))}",
+    ),
+    Scenario("issue", lambda rng, v: f"/issues/{rng.randint(1, max(v.issues, 1))}"),
+    Scenario(
+        "issue devices",
+        lambda rng, v: f"/issues/{rng.randint(1, max(v.issues, 1))}/devices",
+    ),
+    Scenario("new issue", lambda rng, v: "/issues/new", formats=("html",)),
+    Scenario(
+        "search",
+        lambda rng, v: f"/search?q={rng.choice(['router', 'firmware', 'rack-07'])}",
+    ),
+    Scenario("users", lambda rng, v: "/users"),
+    Scenario("groups", lambda rng, v: "/groups"),
+]
+"""Routes exercised, with the path of each request drawn at random"""
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    """Nearest rank percentile of sorted `latencies`
+
+    >>> percentile([0.1, 0.2, 0.3, 0.4], 0.5)
+    0.2
+    >>> percentile([0.1, 0.2, 0.3, 0.4], 0.99)
+    0.4
+    """
+    return latencies[max(math.ceil(p * len(latencies)) - 1, 0)]
+
+
+def summarize(latencies: list[float], seconds: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "throughput": len(latencies) / seconds,
+    }
+
+
+def measure_imports(repeat: int) -> dict[str, dict]:
+    """Seconds taken by a cold import of each budgeted module, best of `repeat`"""
+    results = {}
+    for module in import_budgets:
+        code = (
+            "from time import perf_counter; started = perf_counter(); "
+            f"import {module}; print(perf_counter() - started)"
+        )
+        timings = [
+            float(
+                subprocess.run(
+                    [sys.executable, "-c", code],
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                ).stdout
+            )
+            for _ in range(repeat)
+        ]
+        results[f"import {module}"] = {"seconds": min(timings)}
+    return results
+
+
+def volumes(database: Path) -> Volumes:
+    with sqlite3.connect(database) as connection:
+        devices, issues = connection.execute(
+            "SELECT (SELECT max(device_id) FROM devices), "
+            "(SELECT max(issue_id) FROM issues)"
+        ).fetchone()
+    return Volumes(devices=devices or 0, issues=issues or 0)
+
+
+def row_counts(database: Path) -> dict[str, int]:
+    """Rows in each seeded table"""
+    tables = ("users", "groups", "devices", "issues", "related_devices")
+    with sqlite3.connect(database) as connection:
+        return {
+            table: connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in tables
+        }
+
+
+def session_cookie(database: Path) -> dict[str, str]:
+    """A session for the first seeded user"""
+    from pfaht import schema, services
+
+    with sqlite3.connect(database) as connection:
+        connection.row_factory = sqlite3.Row
+        row = connection.execute("SELECT * FROM users ORDER BY rowid").fetchone()
+    if row is None:
+        return {}
+    user = schema.users.User.model_validate(dict(row))
+    token = services.sessions.create_session_token(user, group_ids=[])
+    return {services.sessions.session_cookie: token}
+
+
+async def run_scenario(
+    client, scenario: Scenario, response_format: str, args, v: Volumes
+) -> dict:
+    rng = random.Random(args.seed)
+    headers = {"Accept": accepts[response_format]}
+    latencies: list[float] = []
+    errors: list[str] = []
+
+    async def request():
+        path = scenario.path(rng, v)
+        started = perf_counter()
+        response = await client.get(path, headers=headers)
+        latency = perf_counter() - started
+        if response.status_code >= 400:
+            errors.append(f"{response.status_code} {path}")
+        return latency
+
+    for _ in range(args.warmup):
+        await request()
+
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            latencies.append(await request())
+
+    started = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    result = summarize(latencies, perf_counter() - started)
+    if errors:
+        result["errors"] = len(errors)
+        print(f"  {len(errors)} failed, first: {errors[0]}")
+    return result
+
+
+async def run_routes(args, database: Path) -> dict[str, dict]:
+    import httpx
+
+    from pfaht.web.app import app
+
+    v = volumes(database)
+    cookies = session_cookie(database)
+    pattern = re.compile(args.only) if args.only else None
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", cookies=cookies
+        ) as client:
+            for scenario in scenarios:
+                for response_format in scenario.formats:
+                    name = f"{scenario.name} ({response_format})"
+                    if pattern and not pattern.search(name):
+                        continue
+                    print(name, flush=True)
+                    results[name] = await run_scenario(
+                        client, scenario, response_format, args, v
+                    )
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """What is slower in `results` than in `baseline` by more than `tolerance`
+
+    >>> regressions(
+    ...     {"a": {"p95": 0.2, "throughput": 50}, "b": {"seconds": 2.0}},
+    ...     {"a": {"p95": 0.1, "throughput": 100}, "b": {"seconds": 1.9}},
+    ...     tolerance=0.1,
+    ... )
+    ['a: p95 200.0ms, was 100.0ms', 'a: throughput 50.0/s, was 100.0/s']
+    """
+    flagged = []
+    for name, result in results.items():
+        if (base := baseline.get(name)) is None:
+            continue
+        for key in ("p50", "p95", "p99", "seconds"):
+            if key not in result or key not in base:
+                continue
+            if result[key] > base[key] * (1 + tolerance):
+                flagged.append(
+                    f"{name}: {key} {result[key] * 1000:.1f}ms, "
+                    f"was {base[key] * 1000:.1f}ms"
+                )
+        if "throughput" in result and "throughput" in base:
+            if result["throughput"] < base["throughput"] * (1 - tolerance):
+                flagged.append(
+                    f"{name}: throughput {result['throughput']:.1f}/s, "
+                    f"was {base['throughput']:.1f}/s"
+                )
+    return flagged
+
+
+def report(results: dict):
+    print(f"\n{'':<32} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    for name, result in results.items():
+        if "seconds" in result:
+            print(f"{name:<32} {result['seconds'] * 1000:>8.1f}")
+            continue
+        print(
+            f"{name:<32} {result['p50'] * 1000:>8.1f} {result['p95'] * 1000:>8.1f} "
+            f"{result['p99'] * 1000:>8.1f} {result['throughput']:>8.1f}"
+        )
+
+
+def main(args) -> int:
+    # Set before the app reads its config
+    os.environ.setdefault("SESSION_SECRET", "benchmark")
+    os.environ.setdefault("FAST_API_RELOAD", "0")
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ.setdefault("DATABASE_MIGRATE", "0")
+    from pfaht import db
+
+    args.data_dir = args.data_dir.resolve()
+    args.baseline = args.baseline.resolve()
+    database = args.data_dir / db.pfaht_db_file
+    if not database.exists():
+        sys.exit(f"No database at {database}, seed one with benchmarks/seed.py")
+    os.chdir(args.data_dir)
+
+    results = measure_imports(args.import_repeat)
+    results.update(asyncio.run(run_routes(args, database)))
+    report(results)
+
+    failed = [
+        f"{name}: {result['errors']} requests failed"
+        for name, result in results.items()
+        if result.get("errors")
+    ]
+    failed += [
+        f"import {module}: {results[f'import {module}']['seconds']:.3f}s, "
+        f"budget {budget}s"
+        for module, budget in import_budgets.items()
+        if results[f"import {module}"]["seconds"] > budget
+    ]
+    document = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "volumes": vars(volumes(database)),
+            "rows": row_counts(database),
+        },
+        "results": results,
+    }
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(document, indent=2) + "\n")
+        print(f"\nSaved the baseline to {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline["meta"]["volumes"] != document["meta"]["volumes"]:
+            print("\nThe baseline was recorded against other volumes")
+        failed += regressions(results, baseline["results"], args.tolerance)
+    else:
+        print(f"\nNo baseline at {args.baseline}, record one with --save-baseline")
+    (args.data_dir / "results.json").write_text(json.dumps(document, indent=2) + "\n")
+
+    for failure in failed:
+        print(f"REGRESSION {failure}")
+    return 1 if failed else 0
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--data-dir", type=Path, default=Path(".benchmarks"))
+    parser.add_argument(
+        "--baseline", type=Path, default=Path(__file__).parent / "baseline.json"
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a result may be worse than the baseline before it is flagged",
+    )
+    parser.add_argument("--requests", type=int, default=200, help="Per route")
+    parser.add_argument("--warmup", type=int, default=10, help="Per route")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--import-repeat", type=int, default=5)
+    parser.add_argument("--only", help="Only routes whose name matches this regex")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser().parse_args()))
@@ -0,0 +1,203 @@
+"""
+Benchmark Data
+==============
+
+Seeds a database with synthetic users, groups, devices, issues and the
+devices related to each issue, at volumes given on the command line::
+
+    python benchmarks/seed.py --data-dir .benchmarks --devices 1000000 \\
+        --issues 500000 --related-devices 8
+
+The schema is created by the app's own migrations, then the rows are
+inserted straight through ``sqlite3`` in large batches. Data is generated
+from a fixed seed, so two databases seeded with the same arguments hold the
+same rows.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+from typing import Iterable, Iterator
+
+statuses = ("open", "closed", "in-progress", "pending")
+locations = tuple(
+    f"site-{site:02d}/rack-{rack:02d}" for site in range(20) for rack in range(10)
+)
+words = (
+    "link down flapping latency packet loss fan failure power supply firmware "
+    "upgrade reboot loop config drift disk full memory leak cpu spike port "
+    "error cable fault temperature alarm license expired certificate"
+).split()
+
+
+def device_types() -> list[str]:
+    """The device types the app ships icons for"""
+    import pfaht
+
+    icons = Path(pfaht.__file__).parent / "web" / "html" / "templates" / "svgrepo"
+    return sorted(icon.stem for icon in icons.glob("*.svg")) or ["router"]
+
+
+def batches(rows: Iterable[tuple], size: int) -> Iterator[list[tuple]]:
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def _sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(words) for _ in range(length))
+
+
+def users(rng: random.Random, count: int) -> Iterator[tuple]:
+    for user in range(count):
+        given, family = f"Given{user}", f"Family{rng.randrange(1000)}"
+        yield (
+            f"user-{user}",
+            f"user{user}@example.com",
+            True,
+            f"{given} {family}",
+            given,
+            family,
+            "https://example.com/avatar.png",
+        )
+
+
+def devices(rng: random.Random, count: int) -> Iterator[tuple]:
+    types = device_types()
+    for device in range(count):
+        device_type = rng.choice(types)
+        yield (f"{device_type}-{device:07d}", device_type, rng.choice(locations))
+
+
+def issues(rng: random.Random, count: int) -> Iterator[tuple]:
+    for _ in range(count):
+        yield (
+            _sentence(rng, rng.randint(3, 8)),
+            _sentence(rng, rng.randint(20, 80)),
+            rng.choice(statuses),
+        )
+
+
+def related_devices(
+    rng: random.Random, issue_count: int, device_count: int, per_issue: int
+) -> Iterator[tuple]:
+    """About `per_issue` devices for each issue, skewed towards low ids"""
+    for issue_id in range(1, issue_count + 1):
+        for _ in range(rng.randint(0, 2 * per_issue)):
+            device_id = int(device_count * rng.random() ** 2) + 1
+            yield issue_id, device_id
+
+
+async def create_schema():
+    from pfaht import db, migrations
+
+    async with db.create_engine() as engine:
+        async with engine.session() as session:
+            await migrations.migrate(session)
+
+
+def insert(
+    connection: sqlite3.Connection, table: str, query: str, rows: Iterable[tuple]
+):
+    """Insert `rows` into the empty `table` in one transaction"""
+    started = perf_counter()
+    with connection:
+        for batch in batches(rows, 10_000):
+            connection.executemany(query, batch)
+    # Counted afterwards, as duplicate relations are ignored
+    count = connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    print(f"{table:>16}: {count:>9} rows in {perf_counter() - started:.1f}s")
+
+
+def seed(args: argparse.Namespace):
+    from pfaht import db
+
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(args.data_dir)
+    if Path(db.pfaht_db_file).exists():
+        if not args.force:
+            sys.exit(f"{args.data_dir / db.pfaht_db_file} exists, pass --force")
+        for suffix in ("", "-wal", "-shm"):
+            Path(db.pfaht_db_file + suffix).unlink(missing_ok=True)
+
+    asyncio.run(create_schema())
+    rng = random.Random(args.seed)
+    connection = db.get_self_db()
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA foreign_keys = OFF")
+    insert(
+        connection,
+        "users",
+        "INSERT INTO users (id, email, verified_email, name, given_name, "
+        "family_name, picture) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        users(rng, args.users),
+    )
+    insert(
+        connection,
+        "groups",
+        "INSERT INTO groups (name) VALUES (?)",
+        ((f"group-{group}",) for group in range(args.groups)),
+    )
+    insert(
+        connection,
+        "user_groups",
+        "INSERT OR IGNORE INTO user_groups (user_id, group_id) VALUES (?, ?)",
+        (
+            (f"user-{user}", rng.randint(1, args.groups))
+            for user in range(args.users)
+            if args.groups
+        ),
+    )
+    insert(
+        connection,
+        "devices",
+        "INSERT INTO devices (device_name, device_type, device_location) "
+        "VALUES (?, ?, ?)",
+        devices(rng, args.devices),
+    )
+    insert(
+        connection,
+        "issues",
+        "INSERT INTO issues (issue_title, issue_body, issue_status) VALUES (?, ?, ?)",
+        issues(rng, args.issues),
+    )
+    if args.devices:
+        insert(
+            connection,
+            "related_devices",
+            "INSERT OR IGNORE INTO related_devices (issue_id, device_id) "
+            "VALUES (?, ?)",
+            related_devices(rng, args.issues, args.devices, args.related_devices),
+        )
+    connection.execute("ANALYZE")
+    connection.close()
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--data-dir", type=Path, default=Path(".benchmarks"))
+    parser.add_argument("--devices", type=int, default=100_000)
+    parser.add_argument("--issues", type=int, default=50_000)
+    parser.add_argument(
+        "--related-devices",
+        type=int,
+        default=8,
+        help="Average number of devices related to each issue",
+    )
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--force", action="store_true", help="Replace an existing database"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    seed(parser().parse_args())
@@ -1,3 +1,4 @@
+import importlib
 import sys
 
 if sys.version_info[:2] >= (3, 8):
@@ -15,4 +16,26 @@ except PackageNotFoundError:  # pragma: no cover
 finally:
     del version, PackageNotFoundError
 
-from . import logging, config, db, schema, services, web  # noqa: F401
+# Submodules are imported on first use, so that a script needing only the
+# schema does not pay for the web stack. Logging is configured by whatever
+# runs the app, see `pfaht.logging.configure_logging`.
+_submodules = {
+    "config",
+    "db",
+    "logging",
+    "metrics",
+    "migrations",
+    "schema",
+    "services",
+    "web",
+}
+
+
+def __getattr__(name: str):
+    if name in _submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
@@ -8,7 +8,6 @@ This module contains the configuration for the FastAPI application.
 
 from os import getenv
 
-
 FAST_API_RELOAD = getenv("FAST_API_RELOAD", "1") == "1"
 """Enable FastAPI auto-reload"""
 FAST_API_PORT = int(getenv("FAST_API_PORT", "8000"))
@@ -16,9 +15,134 @@ FAST_API_PORT = int(getenv("FAST_API_PORT", "8000"))
 FAST_API_HOST = getenv("FAST_API_HOST", "0.0.0.0")
 """FastAPI host to listen on"""
 
+LOG_CONFIG = getenv("LOG_CONFIG")
+"""Logging config YAML file replacing the bundled one, such as the bundled
+``logging.production.yaml`` that logs JSON lines to stdout"""
+LOG_LEVEL = getenv("LOG_LEVEL")
+"""Root log level, overriding the one in the logging config"""
+LOG_QUEUE = getenv("LOG_QUEUE", "0") == "1"
+"""Hand log records to a background thread that formats and writes them"""
+LOG_REQUEST_HEADERS = getenv("LOG_REQUEST_HEADERS", "0") == "1"
+"""Log the headers of every content negotiated request at debug level"""
+
 GOOGLE_CLIENT_ID = getenv("GOOGLE_CLIENT_ID")
 """Google OAuth Client ID"""
 GOOGLE_CLIENT_SECRET = getenv("GOOGLE_CLIENT_SECRET")
 """Google OAuth Client Secret"""
 GOOGLE_REDIRECT_URI = getenv("GOOGLE_REDIRECT_URI", "http://localhost:8000/auth/google")
 """Google OAuth Redirect URI"""
+
+DATABASE_POOL_SIZE = int(getenv("DATABASE_POOL_SIZE", "5"))
+"""Number of database connections the application keeps open"""
+DATABASE_POOL_TIMEOUT = float(getenv("DATABASE_POOL_TIMEOUT", "30"))
+"""Seconds a request waits for a free database connection before failing"""
+
+DATABASE_ENGINE = getenv("DATABASE_ENGINE", "pool")
+"""Database engine; ``pool`` for a plain connection pool or ``sqlite`` for WAL
+mode with read-only readers and a single serialized writer"""
+SQLITE_SYNCHRONOUS = getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+"""SQLite ``synchronous`` pragma used by the ``sqlite`` engine"""
+SQLITE_MMAP_SIZE = int(getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+"""Bytes of the database file SQLite may memory map"""
+SQLITE_CACHE_SIZE = int(getenv("SQLITE_CACHE_SIZE", "-65536"))
+"""SQLite page cache size; negative values are KiB, positive values pages"""
+SQLITE_BUSY_TIMEOUT = int(getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+"""Milliseconds a SQLite connection waits on a locked database"""
+SQLITE_WRITE_BATCH_SIZE = int(getenv("SQLITE_WRITE_BATCH_SIZE", "64"))
+"""Most queued writes the writer commits together in one transaction"""
+SQLITE_FOREIGN_KEYS = getenv("SQLITE_FOREIGN_KEYS", "1") == "1"
+"""Enforce foreign keys, including their ``ON DELETE CASCADE`` actions"""
+DATABASE_MIGRATE = getenv("DATABASE_MIGRATE", "1") == "1"
+"""Apply pending schema migrations when the application starts"""
+SLOW_QUERY_SECONDS = float(getenv("SLOW_QUERY_SECONDS", "0.05"))
+"""Queries taking at least this long are kept in the slow query log"""
+SLOW_QUERY_LOG_SIZE = int(getenv("SLOW_QUERY_LOG_SIZE", "50"))
+"""Distinct slow queries kept, the fastest are dropped first; 0 disables the log"""
+
+GOOGLE_USERINFO_CACHE_SIZE = int(getenv("GOOGLE_USERINFO_CACHE_SIZE", "1024"))
+"""Most Google user info lookups kept in the in-process cache"""
+GOOGLE_USERINFO_CACHE_TTL = float(getenv("GOOGLE_USERINFO_CACHE_TTL", "300"))
+"""Seconds a cached Google user info lookup stays valid"""
+
+SESSION_SECRET = getenv("SESSION_SECRET")
+"""Secret used to sign session tokens; the app will not start without one"""
+SESSION_ALGORITHM = getenv("SESSION_ALGORITHM", "HS256")
+"""JWT algorithm used to sign session tokens"""
+SESSION_TTL = int(getenv("SESSION_TTL", "3600"))
+"""Seconds a session token stays valid"""
+SESSION_REFRESH_WINDOW = int(getenv("SESSION_REFRESH_WINDOW", "300"))
+"""Seconds before expiry at which a session is refreshed in the background"""
+SESSION_REFRESH_CACHE_SIZE = int(getenv("SESSION_REFRESH_CACHE_SIZE", "1024"))
+"""Most refreshed session tokens held until their client picks them up"""
+ADMIN_GROUP_ID = int(getenv("ADMIN_GROUP_ID", "0"))
+"""Group whose members may run tasks and use the admin routes; 0 admits nobody"""
+METRICS_TOKEN = getenv("METRICS_TOKEN")
+"""Bearer token a scraper has to send for /metrics; unset, /metrics is not served"""
+
+GOOGLE_AUTH_URL = getenv(
+    "GOOGLE_AUTH_URL", "https://accounts.google.com/o/oauth2/v2/auth"
+)
+"""Google OAuth consent page users are sent to on login"""
+GOOGLE_TOKEN_URL = getenv(
+    "GOOGLE_TOKEN_URL", "https://accounts.google.com/o/oauth2/token"
+)
+"""Google OAuth token endpoint; point at a stub server for tests and load runs"""
+GOOGLE_USERINFO_URL = getenv(
+    "GOOGLE_USERINFO_URL", "https://www.googleapis.com/oauth2/v1/userinfo"
+)
+"""Google userinfo endpoint; point at a stub server for tests and load runs"""
+GOOGLE_HTTP2 = getenv("GOOGLE_HTTP2", "1") == "1"
+"""Use HTTP/2 for calls to Google"""
+GOOGLE_TIMEOUT = float(getenv("GOOGLE_TIMEOUT", "5"))
+"""Seconds to wait on a Google response"""
+GOOGLE_CONNECT_TIMEOUT = float(getenv("GOOGLE_CONNECT_TIMEOUT", "2"))
+"""Seconds to wait on a new connection to Google"""
+GOOGLE_MAX_CONNECTIONS = int(getenv("GOOGLE_MAX_CONNECTIONS", "20"))
+"""Most open connections to Google kept by the shared client"""
+GOOGLE_RETRIES = int(getenv("GOOGLE_RETRIES", "2"))
+"""Times a failed call to Google is retried"""
+GOOGLE_RETRY_BACKOFF = float(getenv("GOOGLE_RETRY_BACKOFF", "0.2"))
+"""Seconds before the first retry; doubled on each further retry"""
+
+BULK_IMPORT_BATCH_SIZE = int(getenv("BULK_IMPORT_BATCH_SIZE", "500"))
+"""Rows inserted per transaction by the bulk import endpoints"""
+BULK_IMPORT_MAX_ERRORS = int(getenv("BULK_IMPORT_MAX_ERRORS", "100"))
+"""Most per-row errors reported back by a bulk import"""
+BULK_IMPORT_MAX_LINE_BYTES = int(getenv("BULK_IMPORT_MAX_LINE_BYTES", str(1024 * 1024)))
+"""Longest line read from an upload; longer lines are reported as row errors"""
+
+EXPORT_CHUNK_SIZE = int(getenv("EXPORT_CHUNK_SIZE", "1000"))
+"""Rows fetched from the database and sent per chunk by the export endpoints"""
+
+TASK_CONCURRENCY = int(getenv("TASK_CONCURRENCY", "64"))
+"""Most commands running at once across every task"""
+TASK_DEVICE_CONCURRENCY = int(getenv("TASK_DEVICE_CONCURRENCY", "1"))
+"""Most commands running at once against any one device"""
+TASK_TIMEOUT = float(getenv("TASK_TIMEOUT", "60"))
+"""Seconds a command may run on one device before it is killed"""
+TASK_ENVIRONMENT = getenv("TASK_ENVIRONMENT", "PATH LANG LC_ALL TZ").split()
+"""Variables passed on to task commands from the app's environment"""
+TASK_RESULT_BATCH_SIZE = int(getenv("TASK_RESULT_BATCH_SIZE", "100"))
+"""Device results written to the database per transaction"""
+TASK_RESULT_FLUSH_INTERVAL = float(getenv("TASK_RESULT_FLUSH_INTERVAL", "1"))
+"""Most seconds a finished device result waits before it is written"""
+TASK_OUTPUT_LIMIT = int(getenv("TASK_OUTPUT_LIMIT", "16384"))
+"""Characters of stdout and of stderr kept per device"""
+TASK_STREAM_BUFFER = int(getenv("TASK_STREAM_BUFFER", "256"))
+"""Events buffered per task stream client before the client is dropped"""
+TASK_STREAM_KEEPALIVE = float(getenv("TASK_STREAM_KEEPALIVE", "15"))
+"""Seconds between keep-alive comments on an idle task stream"""
+
+FRAGMENT_CACHE_SIZE = int(getenv("FRAGMENT_CACHE_SIZE", str(16 * 1024 * 1024)))
+"""Characters of rendered item fragments kept in memory; 0 disables the cache"""
+
+TEMPLATE_AUTO_RELOAD = (
+    getenv("TEMPLATE_AUTO_RELOAD", "1" if FAST_API_RELOAD else "0") == "1"
+)
+"""Check templates for changes on disk every time they are used"""
+TEMPLATE_BYTECODE_CACHE = getenv("TEMPLATE_BYTECODE_CACHE", "1") == "1"
+"""Keep compiled templates on disk so new workers skip compiling them"""
+TEMPLATE_BYTECODE_CACHE_DIR = getenv("TEMPLATE_BYTECODE_CACHE_DIR")
+"""Directory of the template bytecode cache; defaults to a per-user temp directory"""
+TEMPLATE_PRECOMPILE = getenv("TEMPLATE_PRECOMPILE", "0") == "1"
+"""Compile every HTML template before the application starts serving"""
@@ -1,10 +1,21 @@
+import re
 import sqlite3
+from asyncio import CancelledError, Future, Queue, Task, create_task
+from asyncio import get_running_loop, wait_for
+from contextlib import asynccontextmanager
 from functools import partial
-from typing import AsyncGenerator
+from logging import getLogger
+from time import perf_counter
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable
 
 from databases import Database
+from databases.core import Connection
+from fastapi import HTTPException, Request
+from pydantic import BaseModel
 
-from . import dist_name
+from . import config, dist_name, metrics, schema
+
+logger = getLogger(__name__)
 
 
 def get_connection(file: str) -> sqlite3.Connection:
@@ -14,15 +25,716 @@ def get_connection(file: str) -> sqlite3.Connection:
 
 pfaht_db_file = f"{dist_name}.db"
 get_self_db = partial(get_connection, f"./{pfaht_db_file}")
+database_url = f"sqlite+aiosqlite:///{pfaht_db_file}"
+
+
+def paged_query(
+    query: str,
+    page_options: schema.api.PageOptions,
+    key: list[str],
+    where: list[str] | None = None,
+    values: dict | None = None,
+) -> tuple[str, dict]:
+    """Add the clauses that select one page of `query`
+
+    A page located by a cursor seeks on the `key` columns, so a deep page
+    costs the same as the first one. Otherwise the page is found by OFFSET.
+
+    >>> query, values = paged_query(
+    ...     "SELECT * FROM devices", schema.api.PageOptions(), key=["device_id"]
+    ... )
+    >>> query
+    'SELECT * FROM devices ORDER BY device_id LIMIT :per_page OFFSET :offset'
+    """
+    where = list(where or [])
+    values = {**(values or {}), "per_page": page_options.per_page}
+    columns = ", ".join(key)
+
+    if not page_options.is_keyset:
+        values["offset"] = page_options.offset
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        return (
+            f"{query}{clause} ORDER BY {columns} LIMIT :per_page OFFSET :offset",
+            values,
+        )
+
+    seek_after = page_options.after is not None
+    cursor_key = schema.api.decode_cursor(
+        page_options.after if seek_after else page_options.before
+    )
+    if len(cursor_key) != len(key):
+        raise HTTPException(status_code=422, detail="Cursor does not match this list")
+    params = ", ".join(f":cursor_{i}" for i in range(len(key)))
+    values.update({f"cursor_{i}": value for i, value in enumerate(cursor_key)})
+    where.append(f"({columns}) {'>' if seek_after else '<'} ({params})")
+    clause = f" WHERE {' AND '.join(where)}"
+
+    if seek_after:
+        return f"{query}{clause} ORDER BY {columns} LIMIT :per_page", values
+
+    # Seek backwards from the cursor, then put the page back in order
+    descending = ", ".join(f"{column} DESC" for column in key)
+    outer = ", ".join(column.split(".")[-1] for column in key)
+    return (
+        f"SELECT * FROM ({query}{clause} ORDER BY {descending} LIMIT :per_page) "
+        f"ORDER BY {outer}",
+        values,
+    )
+
+
+class PoolMetrics(BaseModel):
+    """Connection Pool Metrics
+
+    Counters describing how long callers waited to acquire a connection.
+    """
+
+    size: int = 0
+    """Number of connections held open by the pool"""
+
+    acquired: int = 0
+    """Total number of connections handed out"""
+
+    waiting: int = 0
+    """Number of callers currently waiting for a connection"""
+
+    timeouts: int = 0
+    """Number of acquires that gave up waiting"""
+
+    wait_seconds_total: float = 0.0
+    """Total time spent waiting for a connection"""
+
+    wait_seconds_max: float = 0.0
+    """Longest single wait for a connection"""
+
+    def record_wait(self, seconds: float):
+        """Record a successful acquire that waited for `seconds`"""
+        self.acquired += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+class ConnectionPool:
+    """Connection Pool
+
+    A fixed size pool of open database connections. Every connection is
+    opened once when the pool is entered and handed out to a single caller at
+    a time, so requests no longer pay for connection setup.
+
+    >>> pool = ConnectionPool(database_url, size=2)
+    >>> pool.metrics.size
+    2
+    """
+
+    def __init__(
+        self,
+        url: str,
+        size: int = 5,
+        timeout: float | None = None,
+        pragmas: list[str] | None = None,
+    ):
+        self.database = Database(url)
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or []
+        self.metrics = PoolMetrics(size=size)
+        self._idle: Queue[Connection] = Queue()
+        self._connections: list[Connection] = []
+
+    async def open(self):
+        """Connect to the database and open every connection in the pool"""
+        await self.database.connect()
+        for _ in range(self.size):
+            connection = await open_connection(self.database, self.pragmas)
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+
+    async def close(self):
+        """Close every connection in the pool and disconnect"""
+        logger.info(f"Closing connection pool; {self.metrics!r}")
+        for connection in self._connections:
+            await connection.__aexit__()
+        self._connections.clear()
+        await self.database.disconnect()
+
+    async def __aenter__(self) -> "ConnectionPool":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        """Borrow a connection from the pool, returning it when done
+
+        Waiting longer than `timeout` for one raises a 503.
+        """
+        self.metrics.waiting += 1
+        started = perf_counter()
+        try:
+            connection = await wait_for(self._idle.get(), self.timeout)
+        except TimeoutError:
+            self.metrics.timeouts += 1
+            logger.warning(
+                f"No database connection was free within {self.timeout}s; "
+                f"{self.metrics!r}"
+            )
+            # Busy rather than broken, so clients are asked to come back
+            raise HTTPException(
+                status_code=503,
+                detail="The database is busy, try again shortly",
+                headers={"Retry-After": "1"},
+            ) from None
+        finally:
+            self.metrics.waiting -= 1
+        self.metrics.record_wait(perf_counter() - started)
+
+        try:
+            yield connection
+        finally:
+            self._idle.put_nowait(connection)
+
+    def session(self):
+        """A request session is a single borrowed connection"""
+        return self.acquire()
+
+
+class ImmediateConnection(Connection):
+    """A connection whose transactions take the write lock as they begin
+
+    A deferred transaction holds a read lock until its first write asks for
+    the write lock. When two connections do that at once neither can go on,
+    and SQLite fails one with ``database is locked`` instead of making it
+    wait, whatever the busy timeout. Every transaction here writes, so it
+    might as well queue for the write lock up front.
+    """
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["ImmediateConnection"]:
+        if self.raw_connection.in_transaction:
+            # Nested in a transaction that already holds the lock
+            async with super().transaction():
+                yield self
+            return
+        await self.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            await self.execute("ROLLBACK")
+            raise
+        await self.execute("COMMIT")
+
+
+async def open_connection(database: Database, pragmas: list[str]) -> Connection:
+    """Open a long lived connection to `database` and apply `pragmas` to it"""
+    # Entering the connection keeps the underlying driver connection
+    # acquired until it is exited.
+    connection = ImmediateConnection(database, database._backend)
+    await connection.__aenter__()
+    for pragma in pragmas:
+        await connection.execute(f"PRAGMA {pragma}")
+    return connection
+
+
+async def execute_many(
+    session: "Connection | SQLiteSession | InstrumentedSession",
+    query: str,
+    values: list[dict],
+) -> None:
+    """Run `query` for every row of `values` in a single driver call
+
+    ``databases`` compiles and executes a statement per row, this hands the
+    whole batch to the driver's ``executemany`` instead. The query uses the
+    driver's ``:name`` parameter style.
+    """
+    if isinstance(session, (SQLiteSession, InstrumentedSession)):
+        return await session.execute_many(query, values)
+    await session.raw_connection.executemany(query, values)
+
+
+async def fetch_chunks(
+    session: "Connection | SQLiteSession | InstrumentedSession",
+    query: str,
+    values: dict | None = None,
+    size: int = 1000,
+) -> AsyncIterator[tuple[list[str], list[tuple]]]:
+    """Stream the rows of `query` off a driver cursor, `size` rows at a time
+
+    Yields the column names with each chunk of rows. Only one chunk is held
+    in memory at a time, however many rows the query returns.
+    """
+    if isinstance(session, InstrumentedSession):
+        session = session.session
+    if isinstance(session, SQLiteSession):
+        session = session._read_connection
+    async with session.raw_connection.execute(query, values or {}) as cursor:
+        columns = [column[0] for column in cursor.description]
+        while rows := await cursor.fetchmany(size):
+            yield columns, rows
+
+
+WriteOperation = Callable[[Connection], Awaitable[Any]]
+
+
+class WriterMetrics(BaseModel):
+    """SQLite Writer Metrics
+
+    Counters describing the work done by the serialized writer task.
+    """
+
+    queued: int = 0
+    """Number of writes waiting for the writer"""
+
+    writes: int = 0
+    """Total number of writes executed"""
+
+    batches: int = 0
+    """Total number of transactions committed by the writer"""
+
+    held_seconds_total: float = 0.0
+    """Total time callers held the writer for their own transactions"""
+
+
+class SQLiteWriter:
+    """SQLite Writer
+
+    SQLite allows a single writer at a time. Rather than letting concurrent
+    requests fight over the database lock, every write is queued to one task
+    that owns the only writable connection. Writes that are queued together
+    are committed in one transaction, and each caller gets its own result or
+    error back.
+    """
+
+    def __init__(self, url: str, pragmas: list[str], batch_size: int = 64):
+        self.database = Database(url)
+        self.pragmas = pragmas
+        self.batch_size = batch_size
+        self.metrics = WriterMetrics()
+        self._queue: Queue[tuple[WriteOperation, Future, Future | None]] = Queue()
+        self._connection: Connection | None = None
+        self._task: Task | None = None
+
+    async def open(self):
+        """Open the writable connection and start the writer task"""
+        await self.database.connect()
+        self._connection = await open_connection(self.database, self.pragmas)
+        self._task = create_task(self._run())
+
+    async def close(self):
+        """Finish the queued writes, stop the writer task and disconnect"""
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except CancelledError:
+            pass
+        await self._connection.__aexit__()
+        await self.database.disconnect()
+
+    async def submit(self, operation: WriteOperation) -> Any:
+        """Queue `operation` for the writer and wait for its result"""
+        future = get_running_loop().create_future()
+        self._queue.put_nowait((operation, future, None))
+        self.metrics.queued += 1
+        return await future
+
+    async def execute(self, query: str, values: dict | None = None) -> Any:
+        return await self.submit(lambda connection: connection.execute(query, values))
+
+    async def execute_many(self, query: str, values: list[dict]) -> None:
+        return await self.submit(
+            lambda connection: execute_many(connection, query, values)
+        )
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[Connection]:
+        """Take the writable connection for the caller's exclusive use
+
+        The writer task waits, without running other writes, until the
+        caller is done with the connection.
+        """
+        granted = get_running_loop().create_future()
+        released = get_running_loop().create_future()
+        self._queue.put_nowait((None, granted, released))
+        self.metrics.queued += 1
+        try:
+            connection = await granted
+            started = perf_counter()
+            yield connection
+            self.metrics.held_seconds_total += perf_counter() - started
+        finally:
+            released.set_result(None)
+
+    async def _run(self):
+        """Writer task; drain the queue in batches until cancelled"""
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self.metrics.queued -= len(batch)
+
+            pending = []
+            for operation, future, released in batch:
+                if released is None:
+                    pending.append((operation, future))
+                    continue
+                # Exclusive holds run on their own, after the writes queued
+                # before them have been committed.
+                await self._write_batch(pending)
+                pending = []
+                if not future.done():
+                    future.set_result(self._connection)
+                await released
+            await self._write_batch(pending)
+
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _write_batch(self, batch: list[tuple[WriteOperation, Future]]):
+        """Run `batch` in one transaction and resolve each caller's future"""
+        batch = [
+            (operation, future) for operation, future in batch if not future.done()
+        ]
+        if not batch:
+            return
+
+        results = []
+        try:
+            async with self._connection.transaction():
+                for operation, future in batch:
+                    try:
+                        results.append(
+                            (future, await operation(self._connection), None)
+                        )
+                    except Exception as error:
+                        results.append((future, None, error))
+        except Exception as error:
+            # The commit itself failed, so none of the writes persisted.
+            results = [(future, None, error) for future, _, _ in results]
+
+        self.metrics.batches += 1
+        self.metrics.writes += len(results)
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class SQLiteSession:
+    """SQLite Session
+
+    The per request view of a `SQLiteEngine`. Reads run on a read-only
+    connection borrowed for the request, writes are queued to the writer.
+    It exposes the same query methods as `databases.core.Connection`, so the
+    services do not need to know which engine they are running on.
+    """
+
+    def __init__(self, reader: Connection, writer: SQLiteWriter):
+        self._reader = reader
+        self._writer = writer
+        self._transaction: Connection | None = None
+
+    @property
+    def _read_connection(self) -> Connection:
+        """Reads inside a transaction must see its uncommitted writes"""
+        return self._transaction or self._reader
+
+    async def fetch_all(self, query: str, values: dict | None = None):
+        return await self._read_connection.fetch_all(query, values)
+
+    async def fetch_one(self, query: str, values: dict | None = None):
+        return await self._read_connection.fetch_one(query, values)
+
+    async def fetch_val(self, query: str, values: dict | None = None, column=0):
+        return await self._read_connection.fetch_val(query, values, column=column)
+
+    async def iterate(self, query: str, values: dict | None = None):
+        async for record in self._read_connection.iterate(query, values):
+            yield record
+
+    async def execute(self, query: str, values: dict | None = None):
+        if self._transaction is not None:
+            return await self._transaction.execute(query, values)
+        return await self._writer.execute(query, values)
+
+    async def execute_many(self, query: str, values: list[dict]):
+        if self._transaction is not None:
+            return await execute_many(self._transaction, query, values)
+        return await self._writer.execute_many(query, values)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["SQLiteSession"]:
+        """Hold the writer and run every query in one transaction"""
+        if self._transaction is not None:
+            yield self
+            return
+        async with self._writer.hold() as connection:
+            async with connection.transaction():
+                self._transaction = connection
+                try:
+                    yield self
+                finally:
+                    self._transaction = None
+
+
+def foreign_key_pragmas() -> list[str]:
+    """SQLite only enforces foreign keys on connections that ask for it"""
+    return ["foreign_keys = ON"] if config.SQLITE_FOREIGN_KEYS else []
+
+
+class SQLiteEngine:
+    """SQLite Engine
+
+    Runs the database in WAL mode with a pool of read-only connections and a
+    single serialized writer, so readers never wait on writers and concurrent
+    writes no longer fail with ``database is locked``.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        readers: int = 5,
+        timeout: float | None = None,
+        batch_size: int = 64,
+    ):
+        pragmas = [
+            f"synchronous = {config.SQLITE_SYNCHRONOUS}",
+            f"mmap_size = {config.SQLITE_MMAP_SIZE}",
+            f"cache_size = {config.SQLITE_CACHE_SIZE}",
+            f"busy_timeout = {config.SQLITE_BUSY_TIMEOUT}",
+            *foreign_key_pragmas(),
+        ]
+        self.writer = SQLiteWriter(
+            url, pragmas=["journal_mode = WAL", *pragmas], batch_size=batch_size
+        )
+        self.readers = ConnectionPool(
+            url, size=readers, timeout=timeout, pragmas=[*pragmas, "query_only = ON"]
+        )
+
+    @property
+    def metrics(self) -> PoolMetrics:
+        return self.readers.metrics
+
+    async def __aenter__(self) -> "SQLiteEngine":
+        # The writer switches the file to WAL before any reader opens it.
+        await self.writer.open()
+        await self.readers.open()
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.readers.close()
+        await self.writer.close()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[SQLiteSession]:
+        async with self.readers.acquire() as reader:
+            yield SQLiteSession(reader, self.writer)
+
+
+def create_engine(url: str = database_url) -> ConnectionPool | SQLiteEngine:
+    """Create the database engine selected by `config.DATABASE_ENGINE`"""
+    if config.DATABASE_ENGINE == "sqlite":
+        return SQLiteEngine(
+            url,
+            readers=config.DATABASE_POOL_SIZE,
+            timeout=config.DATABASE_POOL_TIMEOUT,
+            batch_size=config.SQLITE_WRITE_BATCH_SIZE,
+        )
+    return ConnectionPool(
+        url,
+        size=config.DATABASE_POOL_SIZE,
+        timeout=config.DATABASE_POOL_TIMEOUT,
+        pragmas=foreign_key_pragmas(),
+    )
+
+
+_sql_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace and replace literals, so alike queries group
+
+    >>> normalize_query("SELECT *\\n  FROM devices WHERE name = 'a''b' LIMIT 10")
+    'SELECT * FROM devices WHERE name = ? LIMIT ?'
+    """
+    return " ".join(_sql_literal.sub("?", query).split())
+
+
+class SlowQuery(BaseModel):
+    """Slow Query
+
+    Timings of one normalized query that took at least
+    `config.SLOW_QUERY_SECONDS`, with the plan SQLite chose for it.
+    """
+
+    query: str
+    """The query with its literals replaced and whitespace collapsed"""
+
+    count: int = 0
+    """Number of times the query was slow"""
+
+    seconds_total: float = 0.0
+    """Total time spent in the slow runs"""
+
+    seconds_max: float = 0.0
+    """Longest single run"""
+
+    seconds_last: float = 0.0
+    """Time taken by the latest slow run"""
+
+    plan: list[str] = []
+    """``EXPLAIN QUERY PLAN`` of the first slow run, indented by depth"""
+
+
+class SlowQueryLog:
+    """Slow Query Log
+
+    Keeps the `size` slowest distinct queries seen since startup. When a new
+    query does not fit, the one with the shortest longest run is dropped.
+    """
+
+    def __init__(self, size: int = config.SLOW_QUERY_LOG_SIZE):
+        self.size = size
+        self._queries: dict[str, SlowQuery] = {}
+
+    @property
+    def queries(self) -> list[SlowQuery]:
+        """The slow queries, slowest first"""
+        return sorted(
+            self._queries.values(), key=lambda query: query.seconds_max, reverse=True
+        )
+
+    def clear(self):
+        self._queries.clear()
+
+    async def record(
+        self, session: "Connection | SQLiteSession", query: str, values, seconds: float
+    ):
+        """Record a slow run, explaining the query the first time it is seen"""
+        if self.size <= 0:
+            return
+        normalized = normalize_query(query)
+        logger.warning("Slow query (%.3fs): %s", seconds, normalized)
+        if (slow := self._queries.get(normalized)) is None:
+            if len(self._queries) >= self.size:
+                fastest = min(self._queries.values(), key=lambda q: q.seconds_max)
+                if fastest.seconds_max >= seconds:
+                    return
+                del self._queries[fastest.query]
+            slow = self._queries[normalized] = SlowQuery(query=normalized)
+            slow.plan = await explain_query(session, query, values)
+        slow.count += 1
+        slow.seconds_total += seconds
+        slow.seconds_max = max(slow.seconds_max, seconds)
+        slow.seconds_last = seconds
+
+
+slow_queries = SlowQueryLog()
+"""Slow queries made through `InstrumentedSession`"""
+
+
+async def explain_query(
+    session: "Connection | SQLiteSession", query: str, values
+) -> list[str]:
+    """The ``EXPLAIN QUERY PLAN`` of `query`, one indented line per step
+
+    Batches are explained with their first row of values. Nothing is
+    executed, so this is safe for writes as well.
+    """
+    if isinstance(values, list):
+        values = values[0] if values else None
+    try:
+        rows = await session.fetch_all(f"EXPLAIN QUERY PLAN {query}", values)
+    except Exception as e:
+        logger.debug("Could not explain query: %s", e)
+        return [f"Could not explain query: {e}"]
+    depths: dict[int, int] = {0: -1}
+    plan = []
+    for row in rows:
+        depth = depths[row["parent"]] + 1 if row["parent"] in depths else 0
+        depths[row["id"]] = depth
+        plan.append("  " * depth + row["detail"])
+    return plan
+
+
+class InstrumentedSession:
+    """Instrumented Session
+
+    Wraps a `Connection` or `SQLiteSession` and times every query made
+    through it into `metrics.db_query_seconds`, by operation. Queries taking
+    at least `config.SLOW_QUERY_SECONDS` are kept in `slow_queries`.
+    """
+
+    def __init__(self, session: Connection | SQLiteSession):
+        self.session = session
+
+    async def _timed(
+        self, operation: str, call: Awaitable[Any], query: str, values=None
+    ) -> Any:
+        started = perf_counter()
+        try:
+            result = await call
+        finally:
+            seconds = perf_counter() - started
+            metrics.db_query_seconds.observe(seconds, operation)
+        if seconds >= config.SLOW_QUERY_SECONDS:
+            await slow_queries.record(self.session, query, values, seconds)
+        return result
+
+    async def fetch_all(self, query: str, values: dict | None = None):
+        return await self._timed(
+            "fetch_all", self.session.fetch_all(query, values), query, values
+        )
+
+    async def fetch_one(self, query: str, values: dict | None = None):
+        return await self._timed(
+            "fetch_one", self.session.fetch_one(query, values), query, values
+        )
+
+    async def fetch_val(self, query: str, values: dict | None = None, column=0):
+        return await self._timed(
+            "fetch_val",
+            self.session.fetch_val(query, values, column=column),
+            query,
+            values,
+        )
+
+    async def iterate(self, query: str, values: dict | None = None):
+        started = perf_counter()
+        try:
+            async for record in self.session.iterate(query, values):
+                yield record
+        finally:
+            # Includes the caller's time between rows, so not slow query logged
+            metrics.db_query_seconds.observe(perf_counter() - started, "iterate")
+
+    async def execute(self, query: str, values: dict | None = None):
+        return await self._timed(
+            "execute", self.session.execute(query, values), query, values
+        )
+
+    async def execute_many(self, query: str, values: list[dict]):
+        return await self._timed(
+            "execute_many", execute_many(self.session, query, values), query, values
+        )
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["InstrumentedSession"]:
+        async with self.session.transaction():
+            yield self
 
 
-async def get_database() -> AsyncGenerator[Database, None]:
-    """Create a Database instance, connect to it, and yield it.
+async def get_database(
+    request: Request,
+) -> AsyncGenerator[InstrumentedSession, None]:
+    """Open a database session for the request and yield it.
 
-    This function is an async generator, so it can be used in a context manager,
-    or in the fastapi Depends function.
+    The engine is owned by the application lifespan. FastAPI caches
+    dependencies per request, so every service depending on this function
+    shares the same session for the lifetime of the request.
     """
-    db = Database(f"sqlite+aiosqlite:///{pfaht_db_file}")
-    await db.connect()
-    yield db
-    await db.disconnect()
+    async with request.app.state.database_engine.session() as session:
+        yield InstrumentedSession(session)
@@ -1,10 +1,90 @@
+import atexit
+import json
+import logging
+import queue
+from copy import copy
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
-import yaml
+from . import config
 
 logging_yaml_config = Path(__file__).parent / "logging.config.yaml"
 
-# Load the config file
-with open(logging_yaml_config, "rt") as f:
-    dictConfig(yaml.safe_load(f.read()))
+_configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line
+
+    >>> record = logging.makeLogRecord(
+    ...     {"name": "pfaht", "msg": "hi %s", "args": ("you",)}
+    ... )
+    >>> json.loads(JsonFormatter().format(record))["message"]
+    'hi you'
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _UnformattedQueueHandler(QueueHandler):
+    """Queue records without formatting them
+
+    `QueueHandler.prepare` formats each record on the logging thread, and
+    drops its traceback for the formatted text. Only the message arguments
+    are merged here, in case they change before the record is written.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+def _queue_root_handlers():
+    """Move the root handlers onto a background thread behind a queue
+
+    Records are put on the queue by the logging call and formatted and
+    written by a `QueueListener`, so slow handlers never block the event
+    loop.
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_UnformattedQueueHandler(log_queue))
+    listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+
+
+def configure_logging():
+    """Load the logging config file, once
+
+    Deferred to whoever runs the app, so importing the package does not
+    load YAML and rich or replace the handlers of the importing program.
+    """
+    global _configured
+    if _configured:
+        return
+    import yaml
+
+    # Load the config file
+    with open(config.LOG_CONFIG or logging_yaml_config, "rt") as f:
+        dictConfig(yaml.safe_load(f.read()))
+    if config.LOG_LEVEL:
+        logging.getLogger().setLevel(config.LOG_LEVEL.upper())
+    if config.LOG_QUEUE:
+        _queue_root_handlers()
+    _configured = True
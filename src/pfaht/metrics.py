@@ -0,0 +1,210 @@
+"""
+Metrics
+=======
+
+In-process counters and histograms exposed in the Prometheus text format.
+Recording a value is a dict lookup and a few additions, cheap enough for
+every request and query.
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+"""Histogram bucket upper bounds in seconds"""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    """Render a label set, with `extra` appended as is
+
+    >>> _labels(("route", "format"), ("/devices", 'a"b'))
+    '{route="/devices",format="a\\\\"b"}'
+    """
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A monotonically increasing count per label set
+
+    >>> counter = Counter("jobs_total", "Jobs run", ("kind",))
+    >>> counter.inc("build")
+    >>> print(counter.render())
+    # HELP jobs_total Jobs run
+    # TYPE jobs_total counter
+    jobs_total{kind="build"} 1
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value:g}")
+        return "\n".join(lines)
+
+
+class Histogram:
+    """Observations counted into cumulative buckets per label set
+
+    >>> histogram = Histogram("wait_seconds", "Wait", buckets=(0.1, 1))
+    >>> histogram.observe(0.5)
+    >>> print(histogram.render())
+    # HELP wait_seconds Wait
+    # TYPE wait_seconds histogram
+    wait_seconds_bucket{le="0.1"} 0
+    wait_seconds_bucket{le="1"} 1
+    wait_seconds_bucket{le="+Inf"} 1
+    wait_seconds_sum 0.5
+    wait_seconds_count 1
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = latency_buckets,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: a count per bucket (the last is +Inf) and the sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        if (series := self._values.get(label_values)) is None:
+            series = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = _labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total[0]:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return "\n".join(lines)
+
+
+class Timer:
+    """Observe the seconds spent in a ``with`` block into a histogram"""
+
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, *label_values: str):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.histogram.observe(perf_counter() - self.started, *self.label_values)
+
+
+http_requests = Counter(
+    "pfaht_http_requests_total",
+    "HTTP requests handled",
+    ("method", "route", "format", "status"),
+)
+http_request_seconds = Histogram(
+    "pfaht_http_request_duration_seconds",
+    "Seconds spent handling HTTP requests",
+    ("method", "route", "format"),
+)
+db_query_seconds = Histogram(
+    "pfaht_db_query_duration_seconds",
+    "Seconds spent in database queries made for requests",
+    ("operation",),
+)
+template_render_seconds = Histogram(
+    "pfaht_template_render_duration_seconds",
+    "Seconds spent rendering page templates",
+    ("template",),
+)
+google_request_seconds = Histogram(
+    "pfaht_google_request_duration_seconds",
+    "Seconds spent waiting on requests to Google",
+    ("method", "url"),
+)
+
+registry: list[Counter | Histogram] = [
+    http_requests,
+    http_request_seconds,
+    db_query_seconds,
+    template_render_seconds,
+    google_request_seconds,
+]
+"""Metrics rendered by `render`"""
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+class MetricsMiddleware:
+    """Record the latency of every HTTP request by route template
+
+    A plain ASGI middleware, so responses are not buffered or copied. The
+    route is the matched path template, such as ``/devices/{device_id}``,
+    and the format is the one `content_negotiation` settled on.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Mounted apps, like the static files, are labelled by mount path
+            route = getattr(scope.get("route"), "path", None)
+            route = route or scope.get("root_path") or "unmatched"
+            response_format = scope.get("state", {}).get("response_format", "none")
+            method = scope["method"]
+            http_request_seconds.observe(
+                perf_counter() - started, method, route, response_format
+            )
+            http_requests.inc(method, route, response_format, status)
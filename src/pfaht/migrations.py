@@ -0,0 +1,388 @@
+"""
+Schema Migrations
+=================
+
+Ordered, versioned changes to the database schema. Pending migrations are
+applied when the application starts, each in its own transaction, and the
+versions applied so far are recorded in the ``schema_migrations`` table.
+
+Migrations are never edited once released; change the schema by appending a
+new one to `migrations`.
+"""
+
+import sqlite3
+from logging import getLogger
+
+from databases.core import Connection
+from fastapi import Depends
+from pydantic import BaseModel
+
+from . import db
+from .db import SQLiteSession
+
+logger = getLogger(__name__)
+
+
+class Migration(BaseModel):
+    """A versioned change to the database schema"""
+
+    version: int
+    """Position of the migration; applied in ascending order"""
+
+    name: str
+    """What the migration does"""
+
+    statements: list[str]
+    """SQL statements run, in order, in one transaction"""
+
+
+def _fts_sync(index: str, rowid: str, columns: tuple[str, ...]) -> tuple[str, str]:
+    """Statements adding the new row to, and removing the old row from, `index`"""
+    names = ", ".join(columns)
+    new = ", ".join(f"new.{column}" for column in columns)
+    old = ", ".join(f"old.{column}" for column in columns)
+    insert = f"INSERT INTO {index} (rowid, {names}) VALUES (new.{rowid}, {new});"
+    delete = (
+        f"INSERT INTO {index} ({index}, rowid, {names}) "
+        f"VALUES ('delete', old.{rowid}, {old});"
+    )
+    return insert, delete
+
+
+def _fts_statements(
+    index: str, table: str, rowid: str, columns: tuple[str, ...]
+) -> list[str]:
+    """Create an external content FTS5 `index` on `table` kept in sync by triggers"""
+    names = ", ".join(columns)
+    insert, delete = _fts_sync(index, rowid, columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+        f"{names}, content='{table}', content_rowid='{rowid}')",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE ON {table} "
+        f"BEGIN {delete} {insert} END",
+        # Index the rows that were there before the triggers
+        f"INSERT INTO {index} ({index}) VALUES ('rebuild')",
+    ]
+
+
+def _fts_update_statements(
+    index: str, table: str, rowid: str, columns: tuple[str, ...]
+) -> list[str]:
+    """Reindex a `table` row in `index` only when an indexed column is updated"""
+    insert, delete = _fts_sync(index, rowid, columns)
+    return [
+        f"DROP TRIGGER {index}_update",
+        f"CREATE TRIGGER {index}_update AFTER UPDATE OF {', '.join(columns)} "
+        f"ON {table} BEGIN {delete} {insert} END",
+    ]
+
+
+def _bump_table_version(table: str) -> str:
+    return (
+        "UPDATE table_versions SET version = version + 1 "
+        f"WHERE table_name = '{table}';"
+    )
+
+
+def _table_version_statements(table: str) -> list[str]:
+    """Bump the ``table_versions`` row of `table` whenever a row changes"""
+    bump = _bump_table_version(table)
+    return [
+        f"INSERT INTO table_versions (table_name) VALUES ('{table}')",
+        *(
+            f"CREATE TRIGGER {table}_version_{event.lower()} AFTER {event} "
+            f"ON {table} BEGIN {bump} END"
+            for event in ("INSERT", "UPDATE", "DELETE")
+        ),
+    ]
+
+
+def _table_version_update_statements(table: str) -> list[str]:
+    """Bump the table version of `table` only on updates that move a row version"""
+    return [
+        f"DROP TRIGGER {table}_version_update",
+        f"CREATE TRIGGER {table}_version_update AFTER UPDATE ON {table} "
+        "WHEN new.row_version <> old.row_version "
+        f"BEGIN {_bump_table_version(table)} END",
+    ]
+
+
+# The first migrations use IF NOT EXISTS so that databases created through
+# the old /init endpoints are adopted as they are.
+migrations: list[Migration] = [
+    Migration(
+        version=1,
+        name="Create users and groups",
+        statements=[
+            "CREATE TABLE IF NOT EXISTS users ("
+            "    id TEXT NOT NULL,"
+            "    email TEXT NOT NULL,"
+            "    verified_email BOOLEAN NOT NULL,"
+            "    name TEXT NOT NULL,"
+            "    given_name TEXT NOT NULL,"
+            "    family_name TEXT NOT NULL,"
+            "    picture TEXT NOT NULL"
+            ")",
+            "CREATE UNIQUE INDEX IF NOT EXISTS unique_idx_users_id ON users (id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+            "CREATE TABLE IF NOT EXISTS groups ("
+            "    id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "    name TEXT NOT NULL"
+            ")",
+            "CREATE UNIQUE INDEX IF NOT EXISTS unique_idx_groups_name "
+            "ON groups (name)",
+            "CREATE TABLE IF NOT EXISTS user_groups ("
+            "    user_id TEXT NOT NULL,"
+            "    group_id INTEGER NOT NULL,"
+            "    PRIMARY KEY (user_id, group_id),"
+            "    FOREIGN KEY (user_id) REFERENCES users (id),"
+            "    FOREIGN KEY (group_id) REFERENCES groups (id)"
+            ")",
+        ],
+    ),
+    Migration(
+        version=2,
+        name="Create devices",
+        statements=[
+            "CREATE TABLE IF NOT EXISTS devices ("
+            "    device_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "    device_name TEXT NOT NULL,"
+            "    device_type TEXT NOT NULL,"
+            "    device_location TEXT NOT NULL"
+            ")",
+        ],
+    ),
+    Migration(
+        version=3,
+        name="Create issues and related devices",
+        statements=[
+            "CREATE TABLE IF NOT EXISTS issues ("
+            "    issue_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "    issue_title TEXT NOT NULL,"
+            "    issue_body TEXT NOT NULL,"
+            "    issue_status TEXT NOT NULL"
+            ")",
+            "CREATE TABLE IF NOT EXISTS related_devices ("
+            "    issue_id INTEGER NOT NULL,"
+            "    device_id INTEGER NOT NULL,"
+            "    PRIMARY KEY (issue_id, device_id),"
+            "    FOREIGN KEY (issue_id) REFERENCES issues (issue_id),"
+            "    FOREIGN KEY (device_id) REFERENCES devices (device_id)"
+            ")",
+        ],
+    ),
+    Migration(
+        version=4,
+        name="Index devices for filtering by type, location and name",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_devices_type_location_name "
+            "ON devices (device_type, device_location, device_name)",
+            "CREATE INDEX IF NOT EXISTS idx_devices_location_name_type "
+            "ON devices (device_location, device_name, device_type)",
+            "CREATE INDEX IF NOT EXISTS idx_devices_name ON devices (device_name)",
+        ],
+    ),
+    Migration(
+        version=5,
+        name="Full-text search over issues, devices and users",
+        statements=[
+            *_fts_statements(
+                "issues_fts", "issues", "issue_id", ("issue_title", "issue_body")
+            ),
+            *_fts_statements(
+                "devices_fts",
+                "devices",
+                "device_id",
+                ("device_name", "device_location"),
+            ),
+            *_fts_statements("users_fts", "users", "rowid", ("name", "email")),
+        ],
+    ),
+    Migration(
+        version=6,
+        name="Cascade deletes to related devices and group members",
+        # SQLite cannot alter a constraint, so the link tables are rebuilt.
+        # Rows pointing at records that no longer exist are dropped.
+        statements=[
+            "CREATE TABLE related_devices_new ("
+            "    issue_id INTEGER NOT NULL,"
+            "    device_id INTEGER NOT NULL,"
+            "    PRIMARY KEY (issue_id, device_id),"
+            "    FOREIGN KEY (issue_id) REFERENCES issues (issue_id)"
+            "        ON DELETE CASCADE,"
+            "    FOREIGN KEY (device_id) REFERENCES devices (device_id)"
+            "        ON DELETE CASCADE"
+            ")",
+            "INSERT INTO related_devices_new (issue_id, device_id) "
+            "SELECT issue_id, device_id FROM related_devices "
+            "WHERE issue_id IN (SELECT issue_id FROM issues) "
+            "AND device_id IN (SELECT device_id FROM devices)",
+            "DROP TABLE related_devices",
+            "ALTER TABLE related_devices_new RENAME TO related_devices",
+            "CREATE TABLE user_groups_new ("
+            "    user_id TEXT NOT NULL,"
+            "    group_id INTEGER NOT NULL,"
+            "    PRIMARY KEY (user_id, group_id),"
+            "    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,"
+            "    FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE"
+            ")",
+            "INSERT INTO user_groups_new (user_id, group_id) "
+            "SELECT user_id, group_id FROM user_groups "
+            "WHERE user_id IN (SELECT id FROM users) "
+            "AND group_id IN (SELECT id FROM groups)",
+            "DROP TABLE user_groups",
+            "ALTER TABLE user_groups_new RENAME TO user_groups",
+        ],
+    ),
+    Migration(
+        version=7,
+        name="Index link tables by their second key",
+        # The primary keys only cover lookups by issue and by user
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_related_devices_device_id "
+            "ON related_devices (device_id)",
+            "CREATE INDEX IF NOT EXISTS idx_user_groups_group_id "
+            "ON user_groups (group_id)",
+        ],
+    ),
+    Migration(
+        version=8,
+        name="Create tasks and their per-device results",
+        statements=[
+            "CREATE TABLE tasks ("
+            "    task_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "    command TEXT NOT NULL,"
+            "    transport TEXT NOT NULL,"
+            "    status TEXT NOT NULL,"
+            "    created_by TEXT,"
+            "    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+            "    finished_at TEXT,"
+            "    device_count INTEGER NOT NULL DEFAULT 0"
+            ")",
+            "CREATE INDEX idx_tasks_status ON tasks (status)",
+            # Devices are not foreign keys so results outlive deleted devices
+            "CREATE TABLE task_results ("
+            "    task_id INTEGER NOT NULL,"
+            "    device_id INTEGER NOT NULL,"
+            "    status TEXT NOT NULL,"
+            "    exit_code INTEGER,"
+            "    stdout TEXT NOT NULL DEFAULT '',"
+            "    stderr TEXT NOT NULL DEFAULT '',"
+            "    started_at REAL,"
+            "    finished_at REAL,"
+            "    PRIMARY KEY (task_id, device_id),"
+            "    FOREIGN KEY (task_id) REFERENCES tasks (task_id) ON DELETE CASCADE"
+            ")",
+        ],
+    ),
+    Migration(
+        version=9,
+        name="Version device and issue rows on every update",
+        statements=[
+            "ALTER TABLE devices ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1",
+            "ALTER TABLE issues ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1",
+            # Skipped when the update already moved the version itself
+            "CREATE TRIGGER devices_row_version AFTER UPDATE ON devices "
+            "WHEN new.row_version = old.row_version BEGIN "
+            "UPDATE devices SET row_version = old.row_version + 1 "
+            "WHERE device_id = new.device_id; END",
+            "CREATE TRIGGER issues_row_version AFTER UPDATE ON issues "
+            "WHEN new.row_version = old.row_version BEGIN "
+            "UPDATE issues SET row_version = old.row_version + 1 "
+            "WHERE issue_id = new.issue_id; END",
+        ],
+    ),
+    Migration(
+        version=10,
+        name="Version the device, issue and related device tables",
+        statements=[
+            "CREATE TABLE table_versions ("
+            "    table_name TEXT PRIMARY KEY,"
+            "    version INTEGER NOT NULL DEFAULT 1"
+            ") WITHOUT ROWID",
+            *_table_version_statements("devices"),
+            *_table_version_statements("issues"),
+            *_table_version_statements("related_devices"),
+        ],
+    ),
+    Migration(
+        version=11,
+        name="Fire device and issue update triggers once per update",
+        # Updates now move row_version themselves. Where one does not, the
+        # row_version trigger's own update of the row would otherwise reindex
+        # it and bump its table version a second time.
+        statements=[
+            *_fts_update_statements(
+                "issues_fts", "issues", "issue_id", ("issue_title", "issue_body")
+            ),
+            *_fts_update_statements(
+                "devices_fts",
+                "devices",
+                "device_id",
+                ("device_name", "device_location"),
+            ),
+            *_table_version_update_statements("devices"),
+            *_table_version_update_statements("issues"),
+        ],
+    ),
+]
+
+
+async def applied_versions(session: Connection | SQLiteSession) -> set[int]:
+    """Versions recorded in ``schema_migrations``, creating it if needed"""
+    await session.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "    version INTEGER PRIMARY KEY,"
+        "    name TEXT NOT NULL,"
+        "    applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP"
+        ")"
+    )
+    rows = await session.fetch_all("SELECT version FROM schema_migrations")
+    return {row["version"] for row in rows}
+
+
+async def migrate(
+    session: Connection | SQLiteSession,
+    pending: list[Migration] | None = None,
+) -> list[Migration]:
+    """Apply the migrations `session` has not seen yet, returning them
+
+    Each migration claims its version before running, so when several
+    processes start together only one of them applies it.
+    """
+    applied = await applied_versions(session)
+    pending = sorted(
+        migrations if pending is None else pending, key=lambda m: m.version
+    )
+    done = []
+    for migration in pending:
+        if migration.version in applied:
+            continue
+        try:
+            async with session.transaction():
+                await session.execute(
+                    "INSERT INTO schema_migrations (version, name) "
+                    "VALUES (:version, :name)",
+                    {"version": migration.version, "name": migration.name},
+                )
+                for statement in migration.statements:
+                    await session.execute(statement)
+        except sqlite3.IntegrityError as error:
+            if "schema_migrations" not in str(error):
+                raise
+            logger.info(f"Migration {migration.version} was applied elsewhere")
+            continue
+        logger.info(f"Applied migration {migration.version}: {migration.name}")
+        done.append(migration)
+    return done
+
+
+async def apply_migrations(
+    db: db.Database = Depends(db.get_database),
+) -> list[Migration]:
+    """Apply any pending migrations for the request's database"""
+    return await migrate(db)
@@ -1 +1 @@
-from . import api, auth, devices, index, issues, location, users
+from . import api, auth, devices, index, issues, location, search, tasks, users
@@ -6,16 +6,52 @@ This module contains the schema for the API responses.
 """
 
 # need generic and type
-from typing import Generic, TypeVar, List
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from enum import StrEnum
+from typing import Annotated, Any, Generic, TypeVar, List
 from urllib.parse import urlencode
 
-from pydantic import BaseModel, Field
+from pydantic import AfterValidator, BaseModel, Field
 
 from . import index
 
 T = TypeVar("T")
 
 
+def encode_cursor(key: list[Any]) -> str:
+    """Encode the sort key of a row into an opaque cursor token
+
+    >>> encode_cursor([42])
+    'WzQyXQ'
+    """
+    return urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list[Any]:
+    """Decode a cursor token back into the sort key it was built from
+
+    >>> decode_cursor('WzQyXQ')
+    [42]
+    """
+    try:
+        key = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def _validate_cursor(cursor: str) -> str:
+    decode_cursor(cursor)
+    return cursor
+
+
+Cursor = Annotated[str, AfterValidator(_validate_cursor)]
+"""An opaque cursor token, rejected with a 422 when it cannot be decoded"""
+
+
 class ApiResponse(BaseModel, Generic[T]):
     """
     API Response Class
@@ -47,11 +83,40 @@ class PageOptions(BaseModel):
     per_page: int = 100
     """Number of items per page"""
 
+    after: Cursor | None = None
+    """Return the items that sort after this cursor, ignoring `page`"""
+
+    before: Cursor | None = None
+    """Return the items that sort before this cursor, ignoring `page`"""
+
     @property
     def offset(self):
         """Calculate the offset for the query"""
         return (self.page - 1) * self.per_page
 
+    @property
+    def is_keyset(self) -> bool:
+        """True when the page is located by a cursor rather than an offset"""
+        return self.after is not None or self.before is not None
+
+
+class CountOptions(BaseModel):
+    """Count Options
+
+    Asks a list to add counts of the rows related to each of its items.
+    """
+
+    counts: bool = False
+    """Add related row counts to every item"""
+
+    def query_string(self) -> str:
+        """The options as query parameters, leaving out the defaults
+
+        >>> CountOptions(counts=True).query_string()
+        'counts=true'
+        """
+        return urlencode({"counts": "true"}) if self.counts else ""
+
 
 class PagedApiResponse(BaseModel, Generic[T]):
     """Paged API Response
@@ -71,18 +136,37 @@ class PagedApiResponse(BaseModel, Generic[T]):
     page_options: PageOptions = PageOptions()
     """Page options for the response"""
 
+    _cursor_fields: tuple[str, ...] = ()
+    """Fields of an item that make up its cursor; empty for offset paging"""
+
+    def cursor(self, item) -> str:
+        """Build the cursor token that points at `item`"""
+        return encode_cursor([getattr(item, field) for field in self._cursor_fields])
+
+    def _page_fragment(self, params: dict) -> str:
+        """Query string of the page located by `params`"""
+        fragment = urlencode({**params, "per_page": self.page_options.per_page})
+        return f"{query}&{fragment}" if (query := self.link_query()) else fragment
+
     def next_page_fragment(
         self,
     ):
         """Adds next page link to the response links list.
 
+        A cursor page without rows can only come from seeking before the
+        first row, so what follows it is the first page.
+
         >>> response = PagedApiResponse()
         >>> response.next_page_fragment()
         'page=2&per_page=100'
+        >>> PagedApiResponse(page_options={"before": "WzFd"}).next_page_fragment()
+        'per_page=100'
         """
-        return urlencode(
-            {"page": self.page_options.page + 1, "per_page": self.page_options.per_page}
-        )
+        if self._cursor_fields and self.response:
+            return self._page_fragment({"after": self.cursor(self.response[-1])})
+        if self.page_options.is_keyset:
+            return self._page_fragment({})
+        return self._page_fragment({"page": self.page_options.page + 1})
 
     def prior_page_fragment(
         self,
@@ -93,6 +177,89 @@ class PagedApiResponse(BaseModel, Generic[T]):
         >>> response.prior_page_fragment()
         'page=0&per_page=100'
         """
-        return urlencode(
-            {"page": self.page_options.page - 1, "per_page": self.page_options.per_page}
-        )
+        if self._cursor_fields and self.response:
+            return self._page_fragment({"before": self.cursor(self.response[0])})
+        return self._page_fragment({"page": self.page_options.page - 1})
+
+    def link_query(self) -> str:
+        """Query parameters the page links keep, besides those of the page"""
+        return ""
+
+    def page_links(self, url: str) -> dict[str, index.Link]:
+        """Build the Prior and Next links for a list served from `url`
+
+        A cursor page has rows on the far side of its cursor, so a ``before``
+        page always has a Next page and an ``after`` page a Prior one, as long
+        as it has rows to point from. Going on the other way, a short page
+        has reached the end of the list.
+        """
+        links = {}
+        full = len(self.response) == self.page_options.per_page
+        if self.page_options.is_keyset:
+            backwards = self.page_options.before is not None
+            has_prior = full if backwards else bool(self.response)
+            has_next = backwards or full
+        else:
+            has_prior, has_next = self.page_options.page > 1, full
+        if has_prior:
+            links["Prior"] = index.Link(
+                url=f"{url}?{self.prior_page_fragment()}", title="Prior Page"
+            )
+        if has_next:
+            links["Next"] = index.Link(
+                url=f"{url}?{self.next_page_fragment()}", title="Next Page"
+            )
+        return links
+
+
+class RowError(BaseModel):
+    """An uploaded row that could not be imported"""
+
+    row: int
+    """Row number in the upload, starting at 1 and not counting a CSV header"""
+
+    error: str
+    """Why the row was rejected"""
+
+
+class BulkImportResult(BaseModel):
+    """Bulk Import Result
+
+    Summary of a streamed bulk import.
+    """
+
+    received: int = 0
+    """Number of rows read from the upload"""
+
+    created: int = 0
+    """Number of rows inserted"""
+
+    failed: int = 0
+    """Number of rows rejected"""
+
+    errors: List[RowError] = []
+    """Per-row errors, capped at `BULK_IMPORT_MAX_ERRORS`"""
+
+    def add_error(self, row: int, error: str, max_errors: int):
+        """Count a rejected row, keeping its error while under `max_errors`"""
+        self.failed += 1
+        if len(self.errors) < max_errors:
+            self.errors.append(RowError(row=row, error=error))
+
+
+class BulkImportResponse(ApiResponse[BulkImportResult]):
+    """Bulk Import Response"""
+
+
+class ExportFormat(StrEnum):
+    """Formats the export endpoints can stream"""
+
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+    @property
+    def media_type(self) -> str:
+        return {
+            ExportFormat.NDJSON: "application/x-ndjson",
+            ExportFormat.CSV: "text/csv",
+        }[self]
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from . import api, users
+from . import api, services, users
 
 
 class GetAuthLoginResponse(api.ApiResponse[None]):
@@ -16,6 +16,41 @@ class GetAuthGoogleResponse(api.ApiResponse[None]):
     pass
 
 
+class SessionClaims(users.User):
+    """Claims carried by the signed session token"""
+
+    group_ids: list[int] = []
+    """IDs of the groups the user belongs to"""
+
+    iat: int
+    """Issued at, in seconds since the epoch"""
+
+    exp: int
+    """Expires at, in seconds since the epoch"""
+
+    @property
+    def user(self) -> users.User:
+        return users.User.model_validate(
+            self.model_dump(include=set(users.User.model_fields))
+        )
+
+
+class GoogleSession(BaseModel):
+    """The result of a successful Google login"""
+
+    session_token: str
+    refresh_token: str | None = None
+    user: users.User
+
+
+class GoogleSessionServiceResponse(services.ServiceResponse[GoogleSession]):
+    """Google Session Service Response Schema"""
+
+
+class GetAuthLogoutResponse(api.ApiResponse[None]):
+    pass
+
+
 class GetGoogleMeResponse(api.ApiResponse[users.User | None]):
 
     def model_post_init(self, __context):
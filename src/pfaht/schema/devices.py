@@ -3,6 +3,9 @@ Schema for devices
 ==================
 """
 
+from enum import StrEnum
+from urllib.parse import urlencode
+
 from pydantic import BaseModel, ConfigDict, Field
 
 from . import api, index, services
@@ -28,15 +31,85 @@ class Device(NewDevice):
 
     device_id: DeviceId
 
+    row_version: int = Field(default=1, exclude=True)
+    """Bumped by the database on every update of the row"""
+
+    issue_counts: dict[str, int] | None = None
+    """Number of related issues by status, when the list was asked for counts"""
+
+    @property
+    def _fragment_version(self):
+        """Identifies this revision of the device for the fragment cache"""
+        counts = None if self.issue_counts is None else tuple(self.issue_counts.items())
+        return (self.device_id, self.row_version, counts)
+
+
+class DeviceSort(StrEnum):
+    """Columns a device list can be sorted by"""
+
+    DEVICE_ID = "device_id"
+    DEVICE_NAME = "device_name"
+    DEVICE_TYPE = "device_type"
+    DEVICE_LOCATION = "device_location"
+
+
+class DeviceFilter(BaseModel):
+    """Device Filter
+
+    Narrows and orders a device list on the server.
+    """
+
+    device_type: str | None = None
+    """Only devices of this type"""
+
+    device_location: str | None = None
+    """Only devices at this location"""
+
+    name_prefix: str | None = None
+    """Only devices whose name starts with this"""
+
+    sort: DeviceSort = DeviceSort.DEVICE_ID
+    """Column to sort by; ties are broken by device ID"""
+
+    @property
+    def key(self) -> list[str]:
+        """Columns the list is ordered and paged by
+
+        >>> DeviceFilter(sort="device_name").key
+        ['device_name', 'device_id']
+        """
+        if self.sort == DeviceSort.DEVICE_ID:
+            return [DeviceSort.DEVICE_ID.value]
+        return [self.sort.value, DeviceSort.DEVICE_ID.value]
+
+    def query_string(self) -> str:
+        """The filter as query parameters, leaving out the defaults"""
+        return urlencode(self.model_dump(mode="json", exclude_defaults=True))
+
 
 class MissingDeviceResponse(api.ApiResponse[None]):
     message: str = "Device not found"
 
 
-class DeviceListResponse(api.ApiResponse[list[Device]]):
+class DeviceListResponse(api.PagedApiResponse[Device]):
     _header_links: list[str] = {
         "NewForm": index.Link(url="/devices/new", title="New Device"),
     }
+    _cursor_fields: tuple[str, ...] = ("device_id",)
+
+    filters: DeviceFilter = DeviceFilter()
+    """The filter the devices were listed with"""
+
+    count_options: api.CountOptions = api.CountOptions()
+    """The counts added to the devices"""
+
+    def model_post_init(self, __context):
+        self._cursor_fields = tuple(self.filters.key)
+        self.links.update(self.page_links("/devices"))
+
+    def link_query(self):
+        queries = (self.filters.query_string(), self.count_options.query_string())
+        return "&".join(query for query in queries if query)
 
     @property
     def title(self):
@@ -82,6 +155,7 @@ class DeviceType(BaseModel):
     """
 
     device_type: str
+    device_count: int = 0
     links: dict[str, index.Link] = Field(default_factory=dict)
 
     def model_post_init(self, __context):
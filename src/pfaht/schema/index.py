@@ -15,8 +15,8 @@ class AnchorLink(Link):
 class Index(BaseModel):
     _html_template: str = "index.html"
     links: dict[str, Link | AnchorLink] = {
-        "Devices": Link(url="/devices", title="Devices"),
-        "Issues": Link(url="/issues/", title="Issues"),
+        "Devices": Link(url="/devices?counts=true", title="Devices"),
+        "Issues": Link(url="/issues/?counts=true", title="Issues"),
         "Users": Link(url="/users", title="Users"),
         "Docs": AnchorLink(url="/docs", title="API Documentation"),
         "ReDoc": AnchorLink(url="/redoc", title="API Documentation (ReDoc)"),
@@ -3,7 +3,7 @@ Issues Schema
 =============
 """
 
-from pydantic import BaseModel, computed_field
+from pydantic import BaseModel, Field, computed_field, model_validator
 from enum import StrEnum
 from . import api, index, services, devices
 
@@ -66,11 +66,22 @@ class Issue(NewIssue):
 
     issue_id: int
 
+    row_version: int = Field(default=1, exclude=True)
+    """Bumped by the database on every update of the row"""
+
+    device_count: int | None = None
+    """Number of related devices, when the list was asked for counts"""
+
     @property
     def _is_editing(self):
         """When returned as html this will set the alpine data context."""
         return False
 
+    @property
+    def _fragment_version(self):
+        """Identifies this revision of the issue for the fragment cache"""
+        return (self.issue_id, self.row_version, self.device_count)
+
     def __str__(self):
         return self.issue_title
 
@@ -89,6 +100,14 @@ class IssueListResponse(api.PagedApiResponse[Issue]):
         "New": index.Link(url="/issues", title="New Issue", method="POST"),
     }
 
+    _cursor_fields: tuple[str, ...] = ("issue_id",)
+
+    count_options: api.CountOptions = api.CountOptions()
+    """The counts added to the issues"""
+
+    def link_query(self):
+        return self.count_options.query_string()
+
     @property
     def title(self):
         return "Issue List"
@@ -103,22 +122,7 @@ class IssueListResponse(api.PagedApiResponse[Issue]):
         After the model has been initialized, we will add the additional
         links for the issues list page.
         """
-        if not self.page_options.page <= 1:
-            prior_page_fragment = self.prior_page_fragment()
-            self.links.update(
-                Prior=index.Link(
-                    url=f"/issues?{prior_page_fragment}",
-                    title="Prior Page",
-                )
-            )
-        if len(self.response) == self.page_options.per_page:
-            next_page_fragment = self.next_page_fragment()
-            self.links.update(
-                Next=index.Link(
-                    url=f"/issues?{next_page_fragment}",
-                    title="Next Page",
-                )
-            )
+        self.links.update(self.page_links("/issues"))
         self.links.update(
             Add=index.Link(url="/issues/", title="New Issue", method="POST")
         )
@@ -175,10 +179,13 @@ class RelatedDevicesResponse(api.PagedApiResponse[devices.Device]):
     issue_id: int
     """The ID of the issue the devices are related to."""
 
+    _cursor_fields: tuple[str, ...] = ("device_id",)
+
     def model_post_init(self, __context):
         self.links.update(
             Issue=index.Link(url=f"/issues/{self.issue_id}", title="View Issue")
         )
+        self.links.update(self.page_links(f"/issues/{self.issue_id}/devices"))
 
     @property
     def title(self):
@@ -205,6 +212,53 @@ class RelatedDevice(BaseModel):
     device_id: int
 
 
+class RelatedDeviceBatch(BaseModel):
+    """Related Device Batch Schema
+
+    Devices to relate to or unrelate from an issue at once. Devices listed
+    by id and devices matching the filter are both selected.
+    """
+
+    device_ids: list[devices.DeviceId] = []
+    """These devices"""
+
+    device_filter: devices.DeviceFilter | None = None
+    """Devices matching this filter; its sort is ignored"""
+
+    @model_validator(mode="after")
+    def _not_everything(self):
+        device_filter = self.device_filter
+        if device_filter is not None and not (
+            device_filter.device_type
+            or device_filter.device_location
+            or device_filter.name_prefix
+        ):
+            raise ValueError("Filter devices by type, location or name prefix")
+        if not (self.device_ids or device_filter):
+            raise ValueError("Select devices by id or filter")
+        return self
+
+
+class RelatedDeviceBatchResult(BaseModel):
+    """Related Device Batch Result
+
+    Summary of relating or unrelating a batch of devices.
+    """
+
+    matched: int = 0
+    """Number of existing devices the batch selected"""
+
+    changed: int = 0
+    """Number of relations created or removed"""
+
+    related: int = 0
+    """Number of devices related to the issue afterwards"""
+
+
+class RelatedDeviceBatchResponse(api.ApiResponse[RelatedDeviceBatchResult]):
+    """Related Device Batch Response"""
+
+
 class IssueListServiceResponse(services.ServiceResponseList[Issue]):
     """Issue List Service Response Schema"""
 
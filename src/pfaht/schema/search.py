@@ -0,0 +1,77 @@
+"""
+Schema for search
+=================
+"""
+
+from enum import StrEnum
+from urllib.parse import urlencode
+
+from pydantic import BaseModel
+
+from . import api, services
+
+
+class SearchEntity(StrEnum):
+    """Kinds of records the search index covers"""
+
+    ISSUE = "issue"
+    DEVICE = "device"
+    USER = "user"
+
+
+class SearchHit(BaseModel):
+    """A record matching a search"""
+
+    entity: SearchEntity
+    """Kind of record that matched"""
+
+    entity_id: int | str
+    """ID of the record that matched"""
+
+    title: str
+    """Name or title of the record"""
+
+    snippet: str
+    """Excerpt of the indexed text around the match"""
+
+    rank: float
+    """BM25 rank of the match; lower is a better match"""
+
+    _template_path: str = "search-hit"
+
+    @property
+    def url(self) -> str:
+        """Where the matched record is served"""
+        if self.entity == SearchEntity.USER:
+            return "/users"
+        return f"/{self.entity}s/{self.entity_id}"
+
+
+class SearchResponse(api.PagedApiResponse[SearchHit]):
+    """Search Response Schema"""
+
+    q: str = ""
+    """The search terms"""
+
+    def model_post_init(self, __context):
+        self.links.update(self.page_links("/search"))
+
+    def next_page_fragment(self):
+        return f"{urlencode({'q': self.q})}&{super().next_page_fragment()}"
+
+    def prior_page_fragment(self):
+        return f"{urlencode({'q': self.q})}&{super().prior_page_fragment()}"
+
+    @property
+    def title(self):
+        return f"Search results for {self.q!r}"
+
+    @property
+    def _html_template(self):
+        return "page/list.html"
+
+
+class SearchServiceResponse(services.ServiceResponseList[SearchHit]):
+    """Search Service Response Schema"""
+
+    q: str = ""
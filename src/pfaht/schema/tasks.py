@@ -0,0 +1,152 @@
+"""
+Schema for tasks
+================
+
+A task runs one command against a selection of devices.
+"""
+
+from enum import StrEnum
+
+from pydantic import BaseModel, model_validator
+
+from . import api, index, services
+
+TaskId = int
+
+
+class TaskStatus(StrEnum):
+    """State of a task, or of one device's run within it"""
+
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+    CANCELLED = "cancelled"
+
+
+class DeviceSelection(BaseModel):
+    """Devices a task runs against; every given criterion has to match"""
+
+    device_ids: list[int] = []
+    """Only these devices"""
+
+    device_type: str | None = None
+    """Only devices of this type"""
+
+    device_location: str | None = None
+    """Only devices at this location"""
+
+    @model_validator(mode="after")
+    def _not_everything(self):
+        if not (self.device_ids or self.device_type or self.device_location):
+            raise ValueError("Select devices by id, type or location")
+        return self
+
+
+class NewTask(BaseModel):
+    """
+    New Task Schema
+    ===============
+    """
+
+    command: str
+    """Shell command to run; the device is described by ``PFAHT_DEVICE_*``
+    environment variables"""
+
+    devices: DeviceSelection
+    """Devices to run the command against"""
+
+    transport: str = "local"
+    """Name of the transport that runs the command"""
+
+    timeout: float | None = None
+    """Seconds each device may run for; defaults to `TASK_TIMEOUT`"""
+
+
+class TaskResult(BaseModel):
+    """Outcome of a task on one device"""
+
+    device_id: int
+    status: TaskStatus
+    exit_code: int | None = None
+    stdout: str = ""
+    stderr: str = ""
+    started_at: float | None = None
+    finished_at: float | None = None
+
+
+class Task(BaseModel):
+    """
+    Task Schema
+    ===========
+    """
+
+    task_id: TaskId
+    command: str
+    transport: str
+    status: TaskStatus
+    created_by: str | None = None
+    created_at: str
+    finished_at: str | None = None
+    device_count: int = 0
+    results: list[TaskResult] = []
+
+
+class TaskEventType(StrEnum):
+    """Kinds of event streamed while a task runs"""
+
+    OUTPUT = "output"
+    """A chunk of a device's stdout or stderr"""
+
+    STATUS = "status"
+    """A device started or finished"""
+
+    DONE = "done"
+    """The task finished; the stream ends"""
+
+    DROPPED = "dropped"
+    """The client fell too far behind; the stream ends"""
+
+
+class TaskEventFormat(StrEnum):
+    """How streamed task events are encoded"""
+
+    HTML = "html"
+    JSON = "json"
+
+
+class TaskEvent(BaseModel):
+    """An event streamed while a task runs"""
+
+    event: TaskEventType
+    device_id: int | None = None
+    stream: str | None = None
+    text: str | None = None
+    status: TaskStatus | None = None
+    exit_code: int | None = None
+
+
+class TaskResponse(api.ApiResponse[Task]):
+    """Task Response Schema"""
+
+    def model_post_init(self, __context):
+        if self.response is not None:
+            self.links.update(
+                Task=index.Link(url=f"/tasks/{self.response.task_id}", title="Task"),
+                Stream=index.Link(
+                    url=f"/tasks/{self.response.task_id}/stream", title="Live Output"
+                ),
+                Cancel=index.Link(
+                    url=f"/tasks/{self.response.task_id}/cancel",
+                    title="Cancel Task",
+                    method="POST",
+                ),
+            )
+
+
+class TaskCreatedResponse(TaskResponse):
+    message: str = "Task started"
+
+
+class TaskServiceResponse(services.ServiceResponse[Task]):
+    """Task Service Response Schema"""
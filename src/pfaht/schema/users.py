@@ -30,7 +30,10 @@ class GetUserResponse(api.ApiResponse[User]):
 
 
 class ListUserResponse(api.PagedApiResponse[User]):
-    pass
+    _cursor_fields: tuple[str, ...] = ("id",)
+
+    def model_post_init(self, __context):
+        self.links.update(self.page_links("/users"))
 
 
 class CreateGroupResponse(api.ApiResponse[Group]):
@@ -42,7 +45,10 @@ class DeleteUserResponse(api.ApiResponse[bool]):
 
 
 class ListGroupResponse(api.PagedApiResponse[Group]):
-    pass
+    _cursor_fields: tuple[str, ...] = ("id",)
+
+    def model_post_init(self, __context):
+        self.links.update(self.page_links("/groups"))
 
 
 class GroupServiceResponse(services.ServiceResponse[Group]):
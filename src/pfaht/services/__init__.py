@@ -3,4 +3,15 @@ Service Module
 ==============
 """
 
-from . import devices, google, issues, tasks, users
+from . import (
+    bulk,
+    devices,
+    etags,
+    export,
+    google,
+    issues,
+    search,
+    sessions,
+    tasks,
+    users,
+)
@@ -0,0 +1,174 @@
+"""
+Bulk Import Service
+===================
+
+Streams NDJSON or CSV uploads row by row, validating each row and inserting
+them in batches, so an upload is never held in memory as a whole.
+"""
+
+import csv
+import json
+from codecs import getincrementaldecoder
+from typing import AsyncIterator
+
+from fastapi import Request
+from pydantic import BaseModel, ValidationError
+
+from .. import config, db, schema
+from ..db import execute_many
+
+
+async def iter_lines(request: Request) -> AsyncIterator[str | ValueError]:
+    """Yield the lines of the request body as its chunks arrive
+
+    Each line is decoded as its bytes arrive, so only the current line is
+    held. A line that is not UTF-8, or is longer than
+    `BULK_IMPORT_MAX_LINE_BYTES`, is yielded as a ValueError and the rest of
+    it is skipped.
+    """
+    limit = config.BULK_IMPORT_MAX_LINE_BYTES
+    decoder = getincrementaldecoder("utf-8")()
+    parts: list[str] = []
+    size = 0
+    error: ValueError | None = None
+
+    def feed(data: bytes, final: bool = False):
+        nonlocal size, error
+        if error is not None:
+            return
+        size += len(data)
+        try:
+            if size > limit:
+                raise ValueError(f"Line is longer than {limit} bytes")
+            parts.append(decoder.decode(data, final))
+        except UnicodeDecodeError as e:
+            error = ValueError(f"Line is not valid UTF-8: {e.reason}")
+        except ValueError as e:
+            error = e
+        if error is not None:
+            parts.clear()
+
+    def end_line() -> str | ValueError:
+        nonlocal size, error
+        feed(b"", final=True)
+        line = error or "".join(parts).rstrip("\r")
+        decoder.reset()
+        parts.clear()
+        size, error = 0, None
+        return line
+
+    async for chunk in request.stream():
+        start = 0
+        while (end := chunk.find(b"\n", start)) != -1:
+            feed(chunk[start:end])
+            yield end_line()
+            start = end + 1
+        feed(chunk[start:])
+    if size:
+        yield end_line()
+
+
+async def iter_ndjson(request: Request) -> AsyncIterator[dict | Exception]:
+    """Yield one object per non-blank line of an NDJSON body"""
+    async for line in iter_lines(request):
+        if isinstance(line, Exception):
+            yield line
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+async def iter_csv(request: Request) -> AsyncIterator[dict | Exception]:
+    """Yield one dict per record of a CSV body, keyed by its header row"""
+    header = None
+    record = ""
+    async for line in iter_lines(request):
+        if isinstance(line, Exception):
+            record = ""
+            yield line
+            continue
+        record = f"{record}\n{line}" if record else line
+        # A quoted field may span lines; wait for its closing quote
+        if record.count('"') % 2:
+            if len(record) > config.BULK_IMPORT_MAX_LINE_BYTES:
+                record = ""
+                yield ValueError("Quoted field is never closed")
+            continue
+        if not record.strip():
+            record = ""
+            continue
+        values = next(csv.reader([record]))
+        record = ""
+        if header is None:
+            header = values
+        elif len(values) != len(header):
+            yield ValueError(f"Expected {len(header)} fields, got {len(values)}")
+        else:
+            yield dict(zip(header, values))
+
+
+def iter_rows(request: Request) -> AsyncIterator[dict | Exception]:
+    """Pick the row parser from the request's content type"""
+    if "csv" in request.headers.get("content-type", ""):
+        return iter_csv(request)
+    return iter_ndjson(request)
+
+
+def describe_error(error: Exception) -> str:
+    """Summarize why a row was rejected"""
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, detail['loc']))}: {detail['msg']}"
+            for detail in error.errors()
+        )
+    return str(error)
+
+
+async def import_rows(
+    request: Request,
+    db: db.Database,
+    model: type[BaseModel],
+    query: str,
+) -> schema.api.BulkImportResult:
+    """Validate the uploaded rows against `model` and insert them with `query`
+
+    Rows are inserted `BULK_IMPORT_BATCH_SIZE` at a time, each batch in its
+    own transaction. A batch that fails to insert is reported against each
+    of its rows; the batches before it stay committed.
+    """
+    result = schema.api.BulkImportResult()
+    batch: list[tuple[int, dict]] = []
+
+    async def flush():
+        try:
+            async with db.transaction():
+                await execute_many(db, query, [values for _, values in batch])
+        except Exception as e:
+            for row, _ in batch:
+                result.add_error(row, str(e), config.BULK_IMPORT_MAX_ERRORS)
+        else:
+            result.created += len(batch)
+        batch.clear()
+
+    async for row in iter_rows(request):
+        result.received += 1
+        try:
+            if isinstance(row, Exception):
+                raise row
+            values = model.model_validate(row).model_dump(mode="json")
+        except (ValidationError, ValueError) as e:
+            result.add_error(
+                result.received, describe_error(e), config.BULK_IMPORT_MAX_ERRORS
+            )
+            continue
+        batch.append((result.received, values))
+        if len(batch) >= config.BULK_IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+
+    return result
@@ -1,19 +1,11 @@
-from fastapi import Depends
-
-from .. import db, schema
+import json
 
+from fastapi import Depends, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
-async def create_device_table(db: db.Database = Depends(db.get_database)):
-    """Create the devices table"""
-    query = (
-        "CREATE TABLE IF NOT EXISTS devices ("
-        "    device_id INTEGER PRIMARY KEY AUTOINCREMENT,"
-        "    device_name TEXT NOT NULL,"
-        "    device_type TEXT NOT NULL,"
-        "    device_location TEXT NOT NULL"
-        ")"
-    )
-    return await db.execute(query=query)
+from .. import db, schema
+from ..db import paged_query
+from . import bulk, etags, export
 
 
 async def create_device(
@@ -39,6 +31,23 @@ async def create_device(
     return await get_device(new_row_id, db)
 
 
+async def bulk_create_devices(
+    request: Request,
+    db: db.Database = Depends(db.get_database),
+) -> schema.api.BulkImportResult:
+    """Create devices from a streamed NDJSON or CSV upload
+
+    Returns:
+    --------
+        schema.api.BulkImportResult: Counts of created and rejected rows
+    """
+    query = (
+        "INSERT INTO devices (device_name, device_type, device_location) "
+        "VALUES (:device_name, :device_type, :device_location)"
+    )
+    return await bulk.import_rows(request, db, schema.devices.NewDevice, query)
+
+
 async def delete_device(device_id: int, db: db.Database = Depends(db.get_database)):
     """Delete a device by ID
 
@@ -51,22 +60,122 @@ async def delete_device(device_id: int, db: db.Database = Depends(db.get_databas
     await db.execute(query=query, values={"device_id": device_id})
 
 
+def _glob_prefix(prefix: str) -> str:
+    """GLOB pattern matching strings that start with `prefix`
+
+    GLOB is case sensitive like the default collation, so unlike LIKE a
+    prefix match can seek on an index.
+
+    >>> _glob_prefix("lab*1")
+    'lab[*]1*'
+    """
+    return "".join(f"[{c}]" if c in "*?[" else c for c in prefix) + "*"
+
+
+def _filter_clauses(device_filter: schema.devices.DeviceFilter):
+    """WHERE clauses and values selecting the devices `device_filter` allows"""
+    where, values = [], {}
+    if device_filter.device_type is not None:
+        where.append("device_type = :device_type")
+        values["device_type"] = device_filter.device_type
+    if device_filter.device_location is not None:
+        where.append("device_location = :device_location")
+        values["device_location"] = device_filter.device_location
+    if device_filter.name_prefix:
+        where.append("device_name GLOB :name_pattern")
+        values["name_pattern"] = _glob_prefix(device_filter.name_prefix)
+    return where, values
+
+
+async def issue_counts(
+    db: db.Database, device_ids: list[int]
+) -> dict[int, dict[str, int]]:
+    """Number of issues related to each device by status, in one grouped join
+
+    Every status is counted, so devices without issues get zeros.
+    """
+    counts = {
+        device_id: {status: 0 for status in schema.issues.IssueStatus}
+        for device_id in device_ids
+    }
+    rows = await db.fetch_all(
+        "SELECT related_devices.device_id, issues.issue_status, count(*) AS issues "
+        "FROM related_devices "
+        "JOIN issues ON issues.issue_id = related_devices.issue_id "
+        "WHERE related_devices.device_id IN (SELECT value FROM json_each(:device_ids)) "
+        "GROUP BY related_devices.device_id, issues.issue_status",
+        {"device_ids": json.dumps(device_ids)},
+    )
+    for row in rows:
+        counts[row["device_id"]][row["issue_status"]] = row["issues"]
+    return counts
+
+
 async def list_devices(
     db: db.Database = Depends(db.get_database),
     page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
+    device_filter: schema.devices.DeviceFilter = Depends(schema.devices.DeviceFilter),
+    count_options: schema.api.CountOptions = Depends(schema.api.CountOptions),
 ) -> list[schema.devices.Device]:
-    """List all devices
+    """List the devices matching `device_filter`
+
+    With ``counts``, every device carries the number of its issues by status.
 
     Returns:
     --------
-        list[schema.devices.Device]: A list of all devices in the database
+        list[schema.devices.Device]: A page of the matching devices
     """
-    query = "SELECT * FROM devices LIMIT :per_page OFFSET :offset"
-    devices = await db.fetch_all(
-        query=query,
-        values={"per_page": page_options.per_page, "offset": page_options.offset},
+    where, values = _filter_clauses(device_filter)
+    query, values = paged_query(
+        "SELECT * FROM devices",
+        page_options,
+        key=device_filter.key,
+        where=where,
+        values=values,
+    )
+    rows = await db.fetch_all(query=query, values=values)
+    devices = [schema.devices.Device.model_validate(dict(row)) for row in rows]
+    if count_options.counts and devices:
+        counts = await issue_counts(db, [device.device_id for device in devices])
+        for device in devices:
+            device.issue_counts = counts[device.device_id]
+    return devices
+
+
+async def export_devices(
+    request: Request,
+    issue_id: int | None = None,
+    issue_status: schema.issues.IssueStatus | None = None,
+    export_format: schema.api.ExportFormat = Query(
+        schema.api.ExportFormat.NDJSON, alias="format"
+    ),
+) -> StreamingResponse:
+    """Stream every device as NDJSON or CSV
+
+    Parameters:
+    -----------
+        issue_id (int): Only devices related to this issue
+        issue_status (schema.issues.IssueStatus): Only devices related to an
+            issue with this status
+    """
+    where, values = [], {}
+    if issue_id is not None:
+        where.append(
+            "device_id IN "
+            "(SELECT device_id FROM related_devices WHERE issue_id = :issue_id)"
+        )
+        values["issue_id"] = issue_id
+    if issue_status is not None:
+        where.append(
+            "device_id IN (SELECT related_devices.device_id FROM related_devices "
+            "JOIN issues ON issues.issue_id = related_devices.issue_id "
+            "WHERE issues.issue_status = :issue_status)"
+        )
+        values["issue_status"] = issue_status
+    query = "SELECT device_id, device_name, device_type, device_location FROM devices"
+    return export.export_response(
+        request, "devices", query, "device_id", where, values, export_format
     )
-    return [schema.devices.Device.model_validate(dict(device)) for device in devices]
 
 
 async def get_device(device_id: int, db: db.Database = Depends(db.get_database)):
@@ -92,8 +201,11 @@ async def get_device(device_id: int, db: db.Database = Depends(db.get_database))
 
 
 async def update_device(
+    request: Request,
+    response: Response,
     device_id: int,
     updated_device: schema.devices.NewDevice,
+    if_match: str | None = Header(None),
     db: db.Database = Depends(db.get_database),
 ) -> schema.devices.Device:
     """
@@ -104,36 +216,69 @@ async def update_device(
         device_id (int): The ID of the device to update
         updated_device (schema.devices.NewDevice): The updated device information
             to apply to the device with the specified ID
+        if_match (str): Only update while the device still has one of these
+            ETags, otherwise 412
         db (db.Database): The database connection
     """
     query = (
         "UPDATE devices "
-        "SET device_name = :device_name, device_type = :device_type, device_location = :device_location "
+        "SET device_name = :device_name, device_type = :device_type, "
+        "device_location = :device_location, row_version = row_version + 1 "
         "WHERE device_id = :device_id"
     )
-    await db.execute(
-        query=query, values={**updated_device.model_dump(), "device_id": device_id}
-    )
+    condition, values = etags.if_match_condition(if_match, "devices", device_id)
+    # Begun by the write, so no read lock has to be upgraded
+    async with db.transaction():
+        await db.execute(
+            query=query + condition,
+            values={**updated_device.model_dump(), "device_id": device_id, **values},
+        )
+        await etags.check_if_match(db, if_match)
 
     device = await get_device(device_id, db)
+    etags.tag_response(
+        request,
+        response,
+        etags.row_version_validator("devices", device_id, device.row_version),
+    )
     return device
 
 
-async def list_device_types() -> list[str]:
+async def list_device_types(
+    db: db.Database = Depends(db.get_database),
+    device_filter: schema.devices.DeviceFilter = Depends(schema.devices.DeviceFilter),
+) -> list[str]:
     """List all valid device types
 
     The valid device types are going to be ones that we have svg\'s for in the
-    templates directory.
+    templates directory, along with any other type a device has. Each type
+    carries the number of devices matching `device_filter`, counted off the
+    device type indexes rather than the table.
 
     Returns:
     --------
-        list[str]: A list of all valid device types
+        list[schema.devices.DeviceType]: A list of all valid device types
     """
     from ..web.html import template_path
 
+    where, values = _filter_clauses(device_filter)
+    clause = f" WHERE {' AND '.join(where)}" if where else ""
+    query = (
+        "SELECT device_type, COUNT(*) AS device_count "
+        f"FROM devices{clause} GROUP BY device_type"
+    )
+    counts = {
+        row["device_type"]: row["device_count"]
+        for row in await db.fetch_all(query=query, values=values)
+    }
+
     # for each file in the svgrepo directory, get the name of the file without the extension
-    device_types = [f.stem for f in template_path.glob("svgrepo/*.svg")]
+    device_types = {f.stem for f in template_path.glob("svgrepo/*.svg")}
+    if device_filter.device_type is not None:
+        device_types &= {device_filter.device_type}
     return [
-        schema.devices.DeviceType(device_type=device_type)
-        for device_type in device_types
+        schema.devices.DeviceType(
+            device_type=device_type, device_count=counts.get(device_type, 0)
+        )
+        for device_type in sorted(device_types | counts.keys())
     ]
@@ -0,0 +1,215 @@
+"""
+Entity Tag Service
+==================
+
+Strong ETags for device and issue resources, answering conditional requests
+before any rows are loaded. A tag is built from a validator and a digest of
+the representation:
+
+- The validator names what the body was built from: ``devices.12.3`` is
+  revision 3 of device 12, and ``devices.4711`` is revision 4711 of the
+  devices table. Rows are versioned by their ``row_version`` column, tables
+  by ``table_versions``, and both are bumped by triggers on every write.
+- The digest covers what else shapes the body: the path and query, the
+  Accept and HX-Request headers, the user shown in the page layout and the
+  app version.
+"""
+
+import json
+from hashlib import blake2b
+
+from fastapi import Depends, HTTPException, Request, Response, status
+from pydantic import ValidationError
+
+from .. import __version__, db, schema
+
+vary = "Accept, HX-Request, Cookie"
+"""Request headers a tagged representation depends on"""
+
+
+def representation_digest(request: Request) -> str:
+    """Digest of everything besides the data that shapes the response body"""
+    user = getattr(request.state, "user", None)
+    parts = [
+        __version__,
+        request.url.path,
+        request.url.query,
+        request.headers.get("Accept", ""),
+        request.headers.get("HX-Request", ""),
+        user.model_dump_json() if user is not None else "",
+    ]
+    return blake2b("\n".join(parts).encode(), digest_size=8).hexdigest()
+
+
+def entity_tag(validator: str, request: Request) -> str:
+    """The strong ETag of the representation of `validator` for `request`
+
+    >>> from starlette.requests import Request
+    >>> request = Request({"type": "http", "path": "/devices/1", "query_string": b"",
+    ...                    "headers": [], "state": {}})
+    >>> entity_tag("devices.1.3", request).startswith('"devices.1.3-')
+    True
+    """
+    return f'"{validator}-{representation_digest(request)}"'
+
+
+def _tags(header: str) -> list[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def tag_validator(tag: str) -> str | None:
+    """The validator of a strong tag we issued, None for anything else
+
+    >>> tag_validator('"devices.1.3-0011223344556677"')
+    'devices.1.3'
+    >>> tag_validator('W/"devices.1.3-0011223344556677"') is None
+    True
+    """
+    if not (tag.startswith('"') and tag.endswith('"')):
+        return None
+    return tag[1:-1].rpartition("-")[0] or None
+
+
+def tag_response(request: Request, response: Response, validator: str) -> dict:
+    """Tag the response with the representation of `validator`
+
+    The headers are also kept on the request state, for responses that are
+    built by hand instead of from `response`.
+    """
+    headers = {
+        "ETag": entity_tag(validator, request),
+        "Vary": vary,
+        "Cache-Control": "no-cache",
+    }
+    response.headers.update(headers)
+    request.state.etag_headers = headers
+    return headers
+
+
+def check_if_none_match(request: Request, response: Response, validator: str):
+    """Tag the response, raising 304 if the client already holds it"""
+    headers = tag_response(request, response, validator)
+    if (if_none_match := request.headers.get("If-None-Match")) is None:
+        return
+    held = {tag.removeprefix("W/") for tag in _tags(if_none_match)}
+    if "*" in held or headers["ETag"] in held:
+        raise HTTPException(status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def row_version_validator(table: str, key_value: int, row_version: int) -> str:
+    """Validator of revision `row_version` of a `table` row
+
+    >>> row_version_validator("devices", 12, 3)
+    'devices.12.3'
+    """
+    return f"{table}.{key_value}.{row_version}"
+
+
+async def row_validator(
+    session: db.Database, table: str, key: str, key_value: int
+) -> str | None:
+    """Validator of one row, None if the row does not exist"""
+    row_version = await session.fetch_val(
+        f"SELECT row_version FROM {table} WHERE {key} = :key", {"key": key_value}
+    )
+    if row_version is None:
+        return None
+    return row_version_validator(table, key_value, row_version)
+
+
+def if_match_condition(
+    if_match: str | None, table: str, key_value: int
+) -> tuple[str, dict]:
+    """Condition limiting an update of a `table` row to the revisions in `if_match`
+
+    The check is made by the write itself, so no other writer can change
+    the row in between, and no read lock ever has to be upgraded to write.
+    Requests without If-Match, or with ``*``, are not limited.
+
+    >>> condition, values = if_match_condition(
+    ...     '"devices.1.3-00", "devices.2.4-00"', "devices", 1
+    ... )
+    >>> values
+    {'if_match': '[3]'}
+    >>> if_match_condition("*", "devices", 1)
+    ('', {})
+    """
+    if if_match is None or "*" in (tags := _tags(if_match)):
+        return "", {}
+    prefix = f"{table}.{key_value}."
+    versions = [
+        int(version)
+        for tag in tags
+        if (validator := tag_validator(tag)) and validator.startswith(prefix)
+        if (version := validator.removeprefix(prefix)).isdigit()
+    ]
+    condition = " AND row_version IN (SELECT value FROM json_each(:if_match))"
+    return condition, {"if_match": json.dumps(versions)}
+
+
+async def check_if_match(session: db.Database, if_match: str | None):
+    """Raise 412 when an update made conditional on `if_match` changed nothing
+
+    Run it in the transaction making the update, right after it.
+    """
+    if if_match is not None and not await session.fetch_val("SELECT changes()"):
+        raise HTTPException(
+            status.HTTP_412_PRECONDITION_FAILED,
+            detail="The resource has changed since it was fetched",
+        )
+
+
+async def table_validator(session: db.Database, *tables: str) -> str:
+    """Validator of everything in `tables`"""
+    rows = await session.fetch_all("SELECT table_name, version FROM table_versions")
+    versions = {row["table_name"]: row["version"] for row in rows}
+    return ".".join(f"{table}.{versions.get(table, 0)}" for table in tables)
+
+
+def row_etag(table: str, key: str):
+    """Dependency tagging a single `table` row, keyed by the `key` path param"""
+
+    async def _row_etag(
+        request: Request,
+        response: Response,
+        db: db.Database = Depends(db.get_database),
+    ):
+        try:
+            key_value = int(request.path_params[key])
+        except (KeyError, ValueError):
+            return
+        if validator := await row_validator(db, table, key, key_value):
+            check_if_none_match(request, response, validator)
+
+    return _row_etag
+
+
+def _asks_for_counts(request: Request) -> bool:
+    """True if the request asks a list for counts, or might do"""
+    try:
+        options = schema.api.CountOptions.model_validate(dict(request.query_params))
+    except ValidationError:
+        return True
+    return options.counts
+
+
+def table_etag(*tables: str, counted: tuple[str, ...] = ()):
+    """Dependency tagging a response built from the rows of `tables`
+
+    The path parameters are part of the digest, so one table version serves
+    every issue's related devices. The `counted` tables are only tagged when
+    the list is asked for counts of related rows.
+    """
+
+    async def _table_etag(
+        request: Request,
+        response: Response,
+        db: db.Database = Depends(db.get_database),
+    ):
+        if counted and _asks_for_counts(request):
+            validator = await table_validator(db, *tables, *counted)
+        else:
+            validator = await table_validator(db, *tables)
+        check_if_none_match(request, response, validator)
+
+    return _table_etag
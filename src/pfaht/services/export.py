@@ -0,0 +1,105 @@
+"""
+Export Service
+==============
+
+Streams query results as NDJSON or CSV one keyset chunk at a time, so
+exporting a whole table uses the same memory as exporting one chunk of it,
+and holds a database connection only while a chunk is read.
+"""
+
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from .. import config, schema
+from ..db import fetch_chunks, paged_query
+
+
+def encode_ndjson(columns: list[str], rows: list[tuple]) -> str:
+    return "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+def encode_csv(columns: list[str] | None, rows: list[tuple]) -> str:
+    """Encode `rows` as CSV, led by a header row when `columns` is given"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if columns is not None:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+async def read_chunk(
+    request: Request, query: str, values: dict
+) -> tuple[list[str], list[tuple]]:
+    """Read the page of rows `query` selects with a session of its own
+
+    Returns the column names and rows, no columns when there are no rows.
+    """
+    async with request.app.state.database_engine.session() as db:
+        async for columns, rows in fetch_chunks(
+            db, query, values, size=values["per_page"]
+        ):
+            return columns, rows
+    return [], []
+
+
+async def stream_rows(
+    request: Request,
+    query: str,
+    key: str,
+    where: list[str],
+    values: dict | None,
+    export_format: schema.api.ExportFormat,
+) -> AsyncIterator[str]:
+    """Stream the rows of `query` in `key` order, encoded as `export_format`
+
+    Every chunk seeks past the `key` of the last row sent and is read with
+    a short session, so a slow download does not keep a connection from the
+    pool. Rows written meanwhile show up if they sort after that row.
+    """
+    page_options = schema.api.PageOptions(per_page=config.EXPORT_CHUNK_SIZE)
+    header_sent = False
+    while True:
+        chunk_query, chunk_values = paged_query(
+            query, page_options, key=[key], where=where, values=values
+        )
+        columns, rows = await read_chunk(request, chunk_query, chunk_values)
+        if not rows:
+            return
+        if export_format == schema.api.ExportFormat.CSV:
+            yield encode_csv(None if header_sent else columns, rows)
+            header_sent = True
+        else:
+            yield encode_ndjson(columns, rows)
+        if len(rows) < page_options.per_page:
+            return
+        last = rows[-1][columns.index(key)]
+        page_options = page_options.model_copy(
+            update={"after": schema.api.encode_cursor([last])}
+        )
+
+
+def export_response(
+    request: Request,
+    name: str,
+    query: str,
+    key: str,
+    where: list[str] | None = None,
+    values: dict | None = None,
+    export_format: schema.api.ExportFormat = schema.api.ExportFormat.NDJSON,
+) -> StreamingResponse:
+    """Stream the rows of `query` matching `where` as a `name`.ndjson or
+    `name`.csv download, ordered by the unique `key` column
+    """
+    return StreamingResponse(
+        stream_rows(request, query, key, where or [], values, export_format),
+        media_type=export_format.media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}.{export_format}"'
+        },
+    )
@@ -1,16 +1,203 @@
-from fastapi import Depends, Request, Cookie
-from fastapi.responses import RedirectResponse
-from typing import Annotated
+from asyncio import Task, create_task, shield, sleep
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha256
+from logging import getLogger
+from time import monotonic
+from typing import Annotated, Awaitable, Callable
+
 import httpx
-from .. import config, schema, db
+from fastapi import Cookie, Depends, HTTPException, Request
+from fastapi.responses import RedirectResponse
+
+from .. import config, db, metrics, schema
+from . import sessions, users
+
+logger = getLogger(__name__)
+
+retry_status_codes = {429, 500, 502, 503, 504}
+"""Google responses that are worth retrying"""
+
+UserInfoFetch = Callable[[str], Awaitable[schema.users.User | None]]
+
+
+class UserInfoCache:
+    """Google User Info Cache
+
+    A bounded, least recently used cache of Google user info keyed by a hash
+    of the access token, so the raw token is never held as a key. Entries
+    expire after `ttl` seconds or when the token expires, whichever is
+    sooner. Concurrent lookups for the same token share one in-flight call.
 
-token_url = "https://accounts.google.com/o/oauth2/token"
+    >>> cache = UserInfoCache(max_size=1, ttl=60)
+    >>> cache.get("token") is None
+    True
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, schema.users.User]] = OrderedDict()
+        self._in_flight: dict[str, Task] = {}
+
+    @staticmethod
+    def key(access_token: str) -> str:
+        """Hash the access token for use as a cache key"""
+        return sha256(access_token.encode()).hexdigest()
+
+    def get(self, access_token: str) -> schema.users.User | None:
+        """Return the cached user for `access_token` if it has not expired"""
+        key = self.key(access_token)
+        if (entry := self._entries.get(key)) is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return user
+
+    def set(
+        self,
+        access_token: str,
+        user: schema.users.User,
+        expires_in: float | None = None,
+    ):
+        """Cache `user` for `access_token`, evicting the least recently used"""
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        if ttl <= 0:
+            return
+        key = self.key(access_token)
+        self._entries[key] = (monotonic() + ttl, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, access_token: str):
+        """Forget `access_token`, including any lookup still in flight"""
+        key = self.key(access_token)
+        self._entries.pop(key, None)
+        self._in_flight.pop(key, None)
+
+    async def get_or_fetch(
+        self,
+        access_token: str,
+        fetch: UserInfoFetch,
+        expires_in: float | None = None,
+    ) -> schema.users.User | None:
+        """Return the cached user, calling `fetch` once on a miss"""
+        if (user := self.get(access_token)) is not None:
+            return user
+
+        key = self.key(access_token)
+        if (in_flight := self._in_flight.get(key)) is None:
+
+            async def _fetch():
+                user = await fetch(access_token)
+                # Do not cache a lookup that was invalidated while in flight
+                if user is not None and self._in_flight.get(key) is in_flight:
+                    self.set(access_token, user, expires_in)
+                return user
+
+            in_flight = create_task(_fetch())
+            self._in_flight[key] = in_flight
+            in_flight.add_done_callback(
+                lambda task: self._in_flight.get(key) is task
+                and self._in_flight.pop(key)
+            )
+
+        # Shielded so one cancelled request does not cancel the shared lookup
+        return await shield(in_flight)
+
+
+userinfo_cache = UserInfoCache(
+    max_size=config.GOOGLE_USERINFO_CACHE_SIZE,
+    ttl=config.GOOGLE_USERINFO_CACHE_TTL,
+)
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Create the client shared by every call to Google
+
+    The application lifespan owns the client, so connections to Google are
+    kept alive and reused across requests.
+    """
+    return httpx.AsyncClient(
+        http2=config.GOOGLE_HTTP2,
+        timeout=httpx.Timeout(
+            config.GOOGLE_TIMEOUT, connect=config.GOOGLE_CONNECT_TIMEOUT
+        ),
+        limits=httpx.Limits(
+            max_connections=config.GOOGLE_MAX_CONNECTIONS,
+            max_keepalive_connections=config.GOOGLE_MAX_CONNECTIONS,
+        ),
+    )
+
+
+async def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Get the application's shared Google client"""
+    return request.app.state.http_client
+
+
+async def send_with_retry(
+    http_client: httpx.AsyncClient, method: str, url: str, **kwargs
+) -> httpx.Response:
+    """Send a request to Google, retrying transient failures with backoff
+
+    Transport errors and `retry_status_codes` responses are retried up to
+    `GOOGLE_RETRIES` times. The last failure is returned or raised as is.
+    """
+    for attempt in range(config.GOOGLE_RETRIES + 1):
+        last_attempt = attempt == config.GOOGLE_RETRIES
+        try:
+            with metrics.Timer(metrics.google_request_seconds, method, url):
+                response = await http_client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if last_attempt:
+                raise
+            logger.warning(f"Retrying {method} {url} after {e!r}")
+        else:
+            if last_attempt or response.status_code not in retry_status_codes:
+                return response
+            logger.warning(f"Retrying {method} {url} after {response.status_code}")
+        await sleep(config.GOOGLE_RETRY_BACKOFF * 2**attempt)
+
+
+async def fetch_user_info(
+    http_client: httpx.AsyncClient, access_token: str
+) -> schema.users.User | None:
+    """Ask Google who the owner of `access_token` is"""
+    try:
+        user_info = await send_with_retry(
+            http_client,
+            "GET",
+            config.GOOGLE_USERINFO_URL,
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        user_info.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return schema.users.User.model_validate(user_info.json())
+
+
+async def get_user_info(
+    http_client: httpx.AsyncClient,
+    access_token: str | None,
+    expires_in: float | None = None,
+) -> schema.users.User | None:
+    """Get the user for `access_token`, from the cache when possible"""
+    if not access_token:
+        return None
+    return await userinfo_cache.get_or_fetch(
+        access_token, partial(fetch_user_info, http_client), expires_in=expires_in
+    )
 
 
 async def get_google_auth_token(
     request: Request,
     code: str,
     db: db.Database = Depends(db.get_database),
+    http_client: httpx.AsyncClient = Depends(get_http_client),
 ):
     """Returns the token response from Google for a given code."""
     data = {
@@ -20,24 +207,29 @@ async def get_google_auth_token(
         "redirect_uri": config.GOOGLE_REDIRECT_URI,
         "grant_type": "authorization_code",
     }
-    google_response = httpx.post(token_url, data=data)
     try:
+        google_response = await send_with_retry(
+            http_client, "POST", config.GOOGLE_TOKEN_URL, data=data
+        )
         google_response.raise_for_status()
-    except httpx.HTTPStatusError as e:
+    except httpx.HTTPError as e:
         return schema.auth.GetAuthGoogleResponse(
             message=f"Failed to get token: {e}",
         )
     google_json_response = google_response.json()
 
     # Now that we have the token, let's get the user info and store it in the database
-    user_info = current_user()(request, google_json_response["access_token"])
-    if user_info is None:
+    user = await get_user_info(
+        http_client,
+        google_json_response["access_token"],
+        expires_in=google_json_response.get("expires_in"),
+    )
+    if user is None:
         return schema.auth.GetAuthGoogleResponse(
             message="Failed to get user info",
         )
 
     # Check if the user already exists
-    user = schema.users.User.model_validate(user_info)
     query = "SELECT * FROM users WHERE id = :id"
     existing_user = await db.fetch_one(query=query, values={"id": user.id})
     if existing_user is None:
@@ -49,7 +241,84 @@ async def get_google_auth_token(
         )
         await db.execute(query=query, values=user.model_dump())
 
-    return google_json_response
+    group_ids = await users.list_user_group_ids(user.id, db)
+    return schema.auth.GoogleSessionServiceResponse(
+        data=schema.auth.GoogleSession(
+            session_token=sessions.create_session_token(user, group_ids),
+            refresh_token=google_json_response.get("refresh_token"),
+            user=user,
+        ),
+        db=db,
+    )
+
+
+async def refresh_access_token(
+    http_client: httpx.AsyncClient, refresh_token: str
+) -> dict | None:
+    """Exchange a refresh token for a new Google token response"""
+    data = {
+        "refresh_token": refresh_token,
+        "client_id": config.GOOGLE_CLIENT_ID,
+        "client_secret": config.GOOGLE_CLIENT_SECRET,
+        "grant_type": "refresh_token",
+    }
+    try:
+        google_response = await send_with_retry(
+            http_client, "POST", config.GOOGLE_TOKEN_URL, data=data
+        )
+        google_response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return google_response.json()
+
+
+async def refresh_session(
+    engine,
+    http_client: httpx.AsyncClient,
+    session_token: str,
+    refresh_token: str,
+):
+    """Mint a replacement for `session_token` using the Google refresh token
+
+    The replacement is stored until the client's next request picks it up.
+    If Google no longer honours the refresh token the session is left to
+    expire and the user has to log in again.
+    """
+    token_response = await refresh_access_token(http_client, refresh_token)
+    if token_response is None:
+        return
+    user = await get_user_info(
+        http_client,
+        token_response["access_token"],
+        expires_in=token_response.get("expires_in"),
+    )
+    if user is None:
+        return
+    async with engine.session() as db:
+        group_ids = await users.list_user_group_ids(user.id, db)
+    sessions.store_refreshed(
+        session_token, sessions.create_session_token(user, group_ids)
+    )
+
+
+_refreshing: dict[str, Task] = {}
+
+
+def schedule_session_refresh(request: Request, session_token: str, refresh_token):
+    """Refresh `session_token` in the background, once per token"""
+    key = UserInfoCache.key(session_token)
+    if key in _refreshing:
+        return
+    task = create_task(
+        refresh_session(
+            request.app.state.database_engine,
+            request.app.state.http_client,
+            session_token,
+            refresh_token,
+        )
+    )
+    _refreshing[key] = task
+    task.add_done_callback(lambda _: _refreshing.pop(key, None))
 
 
 def current_user(redirect_on_fail: bool = False):
@@ -59,25 +328,49 @@ def current_user(redirect_on_fail: bool = False):
         redirect_on_fail (bool, optional): Redirect to login page on fail. Defaults to False.
     """
 
-    def _internal(
+    async def _internal(
         request: Request,
+        session: Annotated[str | None, Cookie()] = None,
+        refresh_token: Annotated[str | None, Cookie()] = None,
         access_token: Annotated[str | None, Cookie()] = None,
+        expires_in: Annotated[int | None, Cookie()] = None,
+        http_client: httpx.AsyncClient = Depends(get_http_client),
     ):
-        """Function to get the current user data"""
-        user_info = httpx.get(
-            "https://www.googleapis.com/oauth2/v1/userinfo",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
-        try:
-            user_info.raise_for_status()
-        except httpx.HTTPStatusError as e:
+        """Function to get the current user data
+
+        A session token issued by this app is verified locally. Clients
+        that only hold a Google access token fall back to a Google lookup.
+        """
+        if session and (refreshed := sessions.pop_refreshed(session)):
+            # Picked up by the session middleware and sent to the client
+            request.state.session_token = session = refreshed
+        if session and (claims := sessions.decode_session_token(session)):
+            if refresh_token and sessions.needs_refresh(claims):
+                schedule_session_refresh(request, session, refresh_token)
+            user, group_ids = claims.user, claims.group_ids
+        else:
+            # Group membership is only carried by session tokens
+            group_ids = []
+            user = await get_user_info(http_client, access_token, expires_in=expires_in)
+        if user is None:
             if redirect_on_fail:
                 # will raise w/ proper exception to redirect response later
                 return RedirectResponse("/auth/login")
             return None
-        user = schema.users.User.model_validate(user_info.json())
         # Assign the user to the request state for use in templates
         request.state.user = user
+        request.state.group_ids = group_ids
         return user
 
     return _internal
+
+
+async def require_admin(request: Request):
+    """Reject anyone outside the `ADMIN_GROUP_ID` group
+
+    Relies on `current_user` having already run as a router dependency.
+    """
+    if getattr(request.state, "user", None) is None:
+        raise HTTPException(status_code=401, detail="Log in to continue")
+    if config.ADMIN_GROUP_ID not in getattr(request.state, "group_ids", []):
+        raise HTTPException(status_code=403, detail="Only admins may do this")
@@ -1,40 +1,16 @@
-from fastapi import Depends, Body
+import json
+
+from fastapi import Depends, Body, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from typing import Annotated
 
 from .. import db, schema
+from ..db import paged_query
+from . import bulk, devices, etags, export
 
 from enum import StrEnum
 
 
-async def create_issue_table(db: db.Database = Depends(db.get_database)):
-    """Create the issues table"""
-    query = (
-        "CREATE TABLE IF NOT EXISTS issues ("
-        "    issue_id INTEGER PRIMARY KEY AUTOINCREMENT,"
-        "    issue_title TEXT NOT NULL,"
-        "    issue_body TEXT NOT NULL,"
-        "    issue_status TEXT NOT NULL"
-        ")"
-    )
-    return await db.execute(query=query)
-
-
-async def create_related_devices_table(db: db.Database = Depends(db.get_database)):
-    """Create the related_devices table"""
-    # Need to create a table with a composite primary key with the issue_id and device_id
-    # with each of them being a foreign key to the issues and devices tables respectively
-    query = (
-        "CREATE TABLE IF NOT EXISTS related_devices ("
-        "    issue_id INTEGER NOT NULL,"
-        "    device_id INTEGER NOT NULL,"
-        "    PRIMARY KEY (issue_id, device_id),"
-        "    FOREIGN KEY (issue_id) REFERENCES issues (issue_id),"
-        "    FOREIGN KEY (device_id) REFERENCES devices (device_id)"
-        ")"
-    )
-    return await db.execute(query=query)
-
-
 async def create_issue(
     new_issue: schema.issues.NewIssue,
     db: db.Database = Depends(db.get_database),
@@ -60,6 +36,23 @@ async def create_issue(
     )
 
 
+async def bulk_create_issues(
+    request: Request,
+    db: db.Database = Depends(db.get_database),
+) -> schema.api.BulkImportResult:
+    """Create issues from a streamed NDJSON or CSV upload
+
+    Returns:
+    --------
+        schema.api.BulkImportResult: Counts of created and rejected rows
+    """
+    query = (
+        "INSERT INTO issues (issue_title, issue_body, issue_status) "
+        "VALUES (:issue_title, :issue_body, :issue_status)"
+    )
+    return await bulk.import_rows(request, db, schema.issues.NewIssue, query)
+
+
 async def delete_issue(issue_id: int, db: db.Database = Depends(db.get_database)):
     """Delete an issue by ID
 
@@ -72,28 +65,75 @@ async def delete_issue(issue_id: int, db: db.Database = Depends(db.get_database)
     return await db.execute(query=query, values={"issue_id": issue_id})
 
 
+async def device_counts(db: db.Database, issue_ids: list[int]) -> dict[int, int]:
+    """Number of devices related to each issue, in one grouped query"""
+    rows = await db.fetch_all(
+        "SELECT issue_id, count(*) AS devices FROM related_devices "
+        "WHERE issue_id IN (SELECT value FROM json_each(:issue_ids)) "
+        "GROUP BY issue_id",
+        {"issue_ids": json.dumps(issue_ids)},
+    )
+    return {row["issue_id"]: row["devices"] for row in rows}
+
+
 async def list_issues(
     db: db.Database = Depends(db.get_database),
     page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
+    count_options: schema.api.CountOptions = Depends(schema.api.CountOptions),
 ) -> schema.issues.IssueListServiceResponse:
     """List all issues
 
+    With ``counts``, every issue carries the number of its related devices.
+
     Returns:
     --------
         list[schema.issues.Issues]: A list of all issues in the database
     """
-    query = "SELECT * FROM issues LIMIT :per_page OFFSET :offset"
-    issues = await db.fetch_all(
-        query=query,
-        values={"per_page": page_options.per_page, "offset": page_options.offset},
-    )
+    query, values = paged_query("SELECT * FROM issues", page_options, key=["issue_id"])
+    rows = await db.fetch_all(query=query, values=values)
+    issues = [schema.issues.Issue.model_validate(dict(row)) for row in rows]
+    if count_options.counts and issues:
+        counts = await device_counts(db, [issue.issue_id for issue in issues])
+        for issue in issues:
+            issue.device_count = counts.get(issue.issue_id, 0)
     return schema.issues.IssueListServiceResponse(
-        data=[schema.issues.Issue.model_validate(dict(issue)) for issue in issues],
+        data=issues,
         db=db,
         page_options=page_options,
     )
 
 
+async def export_issues(
+    request: Request,
+    device_id: int | None = None,
+    issue_status: schema.issues.IssueStatus | None = None,
+    export_format: schema.api.ExportFormat = Query(
+        schema.api.ExportFormat.NDJSON, alias="format"
+    ),
+) -> StreamingResponse:
+    """Stream every issue as NDJSON or CSV
+
+    Parameters:
+    -----------
+        device_id (int): Only issues related to this device
+        issue_status (schema.issues.IssueStatus): Only issues with this status
+    """
+    where, values = [], {}
+    if device_id is not None:
+        where.append(
+            "issue_id IN "
+            "(SELECT issue_id FROM related_devices WHERE device_id = :device_id)"
+        )
+        values["device_id"] = device_id
+    if issue_status is not None:
+        where.append("issue_status = :issue_status")
+        values["issue_status"] = issue_status
+    query = "SELECT issue_id, issue_title, issue_body, issue_status FROM issues"
+    return export.export_response(
+        request, "issues", query, "issue_id", where, values, export_format
+    )
+
+
 async def list_issues_for_device(
     db: db.Database = Depends(db.get_database),
     device_id: int = None,
@@ -139,8 +179,11 @@ async def get_issue(
 
 
 async def update_issue(
+    request: Request,
+    response: Response,
     issue_id: int,
     updated_issue: schema.issues.NewIssue,
+    if_match: str | None = Header(None),
     db: db.Database = Depends(db.get_database),
 ) -> schema.issues.IssueServiceResponse:
     """
@@ -151,20 +194,34 @@ async def update_issue(
         issue_id (int): The ID of the device to update
         updated_issue (schema.issues.NewIssue): The updated issue information
             to apply to the issue with the specified ID
+        if_match (str): Only update while the issue still has one of these
+            ETags, otherwise 412
         db (db.Database): The database connection
     """
     query = (
         "UPDATE issues SET "
         "issue_title = :issue_title, "
         "issue_body = :issue_body, "
-        "issue_status = :issue_status "
+        "issue_status = :issue_status, "
+        "row_version = row_version + 1 "
         "WHERE issue_id = :issue_id"
     )
-    await db.execute(
-        query=query, values={**updated_issue.model_dump(), "issue_id": issue_id}
-    )
+    condition, values = etags.if_match_condition(if_match, "issues", issue_id)
+    # Begun by the write, so no read lock has to be upgraded
+    async with db.transaction():
+        await db.execute(
+            query=query + condition,
+            values={**updated_issue.model_dump(), "issue_id": issue_id, **values},
+        )
+        await etags.check_if_match(db, if_match)
 
-    return await get_issue(issue_id, db)
+    issue = await get_issue(issue_id, db)
+    etags.tag_response(
+        request,
+        response,
+        etags.row_version_validator("issues", issue_id, issue.data.row_version),
+    )
+    return issue
 
 
 async def list_device_types() -> list[str]:
@@ -184,9 +241,11 @@ async def list_device_types() -> list[str]:
 
 
 async def get_related_devices(
-    issue_id: int, db: db.Database = Depends(db.get_database)
+    issue_id: int,
+    db: db.Database = Depends(db.get_database),
+    page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
 ):
-    """Get all devices related to an issue
+    """Get a page of the devices related to an issue
 
     Parameters:
     -----------
@@ -194,15 +253,98 @@ async def get_related_devices(
 
     Returns:
     --------
-        list[schema.devices.Device]: A list of all devices related to the issue
+        list[schema.devices.Device]: A page of the devices related to the issue
     """
-    query = (
-        "SELECT * FROM devices "
-        "JOIN related_devices ON devices.device_id = related_devices.device_id "
-        "WHERE related_devices.issue_id = :issue_id"
+    query, values = paged_query(
+        "SELECT devices.* FROM devices "
+        "JOIN related_devices ON devices.device_id = related_devices.device_id",
+        page_options,
+        key=["related_devices.device_id"],
+        where=["related_devices.issue_id = :issue_id"],
+        values={"issue_id": issue_id},
+    )
+    rows = await db.fetch_all(query=query, values=values)
+    return [schema.devices.Device.model_validate(dict(row)) for row in rows]
+
+
+def _batch_clause(batch: schema.issues.RelatedDeviceBatch) -> tuple[str, dict]:
+    """WHERE clause and values selecting the devices of `batch`"""
+    clauses, values = [], {}
+    if batch.device_ids:
+        clauses.append("device_id IN (SELECT value FROM json_each(:device_ids))")
+        values["device_ids"] = json.dumps(batch.device_ids)
+    if batch.device_filter is not None:
+        where, filter_values = devices._filter_clauses(batch.device_filter)
+        clauses.append(f"({' AND '.join(where)})")
+        values.update(filter_values)
+    return " OR ".join(clauses), values
+
+
+async def _change_related_devices(
+    db: db.Database,
+    issue_id: int,
+    batch: schema.issues.RelatedDeviceBatch,
+    statement: str,
+) -> schema.issues.RelatedDeviceBatchResult:
+    """Run `statement` over the devices of `batch` in one transaction
+
+    `statement` is formatted with the ``selection`` clause and gets the
+    values of the batch along with ``issue_id``.
+    """
+    selection, values = _batch_clause(batch)
+    issue = {"issue_id": issue_id}
+    # Begun by the write, so no read lock has to be upgraded
+    async with db.transaction():
+        await db.execute(statement.format(selection=selection), {**values, **issue})
+        changed = await db.fetch_val("SELECT changes()")
+        found = await db.fetch_val(
+            "SELECT 1 FROM issues WHERE issue_id = :issue_id", issue
+        )
+        if found is None:
+            raise HTTPException(status_code=404, detail=f"Issue {issue_id} not found")
+        matched = await db.fetch_val(
+            f"SELECT count(*) FROM devices WHERE {selection}", values
+        )
+        related = await db.fetch_val(
+            "SELECT count(*) FROM related_devices WHERE issue_id = :issue_id", issue
+        )
+    return schema.issues.RelatedDeviceBatchResult(
+        matched=matched, changed=changed, related=related
+    )
+
+
+async def relate_devices(
+    issue_id: int,
+    batch: schema.issues.RelatedDeviceBatch,
+    db: db.Database = Depends(db.get_database),
+) -> schema.issues.RelatedDeviceBatchResult:
+    """Relate every device of `batch` to an issue
+
+    Devices already related to the issue are left as they are.
+    """
+    return await _change_related_devices(
+        db,
+        issue_id,
+        batch,
+        "INSERT OR IGNORE INTO related_devices (issue_id, device_id) "
+        "SELECT :issue_id, device_id FROM devices WHERE ({selection}) "
+        "AND EXISTS (SELECT 1 FROM issues WHERE issue_id = :issue_id)",
+    )
+
+
+async def unrelate_devices(
+    issue_id: int,
+    batch: schema.issues.RelatedDeviceBatch,
+    db: db.Database = Depends(db.get_database),
+) -> schema.issues.RelatedDeviceBatchResult:
+    """Remove the relations between an issue and every device of `batch`"""
+    return await _change_related_devices(
+        db,
+        issue_id,
+        batch,
+        "DELETE FROM related_devices WHERE issue_id = :issue_id AND device_id IN "
+        "(SELECT device_id FROM devices WHERE {selection})",
     )
-    devices = await db.fetch_all(query=query, values={"issue_id": issue_id})
-    return [schema.devices.Device.model_validate(dict(device)) for device in devices]
 
 
 async def relate_device(
@@ -0,0 +1,75 @@
+"""
+Search Service
+==============
+
+Full-text search over issues, devices and users backed by SQLite FTS5.
+
+Each searchable table has an external content FTS5 index, created by the
+migrations, that triggers keep in sync. The indexed text is not stored twice
+and a search never scans the tables themselves.
+"""
+
+from fastapi import Depends
+
+from .. import db, schema
+
+
+def match_expression(q: str) -> str:
+    """Turn free text into an FTS5 query matching every term as a prefix
+
+    Terms are quoted, so FTS5 operators and punctuation in `q` are searched
+    for rather than parsed.
+
+    >>> match_expression("printer 3rd-floor")
+    '"printer"* "3rd-floor"*'
+    """
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in q.split())
+
+
+_search_query = (
+    "SELECT 'issue' AS entity, issues.issue_id AS entity_id,"
+    " issues.issue_title AS title,"
+    " snippet(issues_fts, -1, '', '', '...', 16) AS snippet,"
+    " bm25(issues_fts) AS rank "
+    "FROM issues_fts JOIN issues ON issues.issue_id = issues_fts.rowid "
+    "WHERE issues_fts MATCH :match "
+    "UNION ALL "
+    "SELECT 'device', devices.device_id, devices.device_name,"
+    " snippet(devices_fts, -1, '', '', '...', 16), bm25(devices_fts) "
+    "FROM devices_fts JOIN devices ON devices.device_id = devices_fts.rowid "
+    "WHERE devices_fts MATCH :match "
+    "UNION ALL "
+    "SELECT 'user', users.id, users.name,"
+    " snippet(users_fts, -1, '', '', '...', 16), bm25(users_fts) "
+    "FROM users_fts JOIN users ON users.rowid = users_fts.rowid "
+    "WHERE users_fts MATCH :match "
+    "ORDER BY rank LIMIT :limit OFFSET :offset"
+)
+
+
+async def search(
+    q: str = "",
+    db: db.Database = Depends(db.get_database),
+    page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
+) -> schema.search.SearchServiceResponse:
+    """Search issues, devices and users, best matches first
+
+    Hits are ranked, so pages are located by offset; cursors are ignored.
+    """
+    hits = []
+    if match := match_expression(q):
+        rows = await db.fetch_all(
+            query=_search_query,
+            values={
+                "match": match,
+                "limit": page_options.per_page,
+                "offset": page_options.offset,
+            },
+        )
+        hits = [schema.search.SearchHit.model_validate(dict(row)) for row in rows]
+    return schema.search.SearchServiceResponse(
+        data=hits,
+        db=db,
+        page_options=page_options.model_copy(update={"after": None, "before": None}),
+        q=q,
+    )
@@ -0,0 +1,85 @@
+"""
+Session Service
+===============
+
+Signed session tokens issued by the app after a Google login. The token
+carries the user and their group ids, so authenticated requests are verified
+locally without asking Google who the user is.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+
+from fastapi import Response
+from jose import JWTError, jwt
+
+from .. import config, schema
+
+session_cookie = "session"
+"""Name of the cookie holding the session token"""
+
+_refreshed_sessions: OrderedDict[str, str] = OrderedDict()
+"""Replacement tokens minted in the background, keyed by a hash of the old one"""
+
+
+def create_session_token(
+    user: schema.users.User, group_ids: list[int], now: float | None = None
+) -> str:
+    """Sign a session token for `user` that expires after `SESSION_TTL`"""
+    issued_at = int(time() if now is None else now)
+    claims = schema.auth.SessionClaims(
+        **user.model_dump(),
+        group_ids=group_ids,
+        iat=issued_at,
+        exp=issued_at + config.SESSION_TTL,
+    )
+    return jwt.encode(
+        claims.model_dump(), config.SESSION_SECRET, algorithm=config.SESSION_ALGORITHM
+    )
+
+
+def decode_session_token(token: str) -> schema.auth.SessionClaims | None:
+    """Verify a session token, returning its claims or None if invalid/expired"""
+    try:
+        claims = jwt.decode(
+            token, config.SESSION_SECRET, algorithms=[config.SESSION_ALGORITHM]
+        )
+    except JWTError:
+        return None
+    return schema.auth.SessionClaims.model_validate(claims)
+
+
+def needs_refresh(claims: schema.auth.SessionClaims, now: float | None = None):
+    """True when the session is within `SESSION_REFRESH_WINDOW` of expiring"""
+    now = time() if now is None else now
+    return claims.exp - now <= config.SESSION_REFRESH_WINDOW
+
+
+def _key(token: str) -> str:
+    return sha256(token.encode()).hexdigest()
+
+
+def store_refreshed(old_token: str, new_token: str):
+    """Keep `new_token` until the client next presents `old_token`"""
+    key = _key(old_token)
+    _refreshed_sessions[key] = new_token
+    _refreshed_sessions.move_to_end(key)
+    while len(_refreshed_sessions) > config.SESSION_REFRESH_CACHE_SIZE:
+        _refreshed_sessions.popitem(last=False)
+
+
+def pop_refreshed(old_token: str) -> str | None:
+    """Take the replacement minted for `old_token`, if there is one"""
+    return _refreshed_sessions.pop(_key(old_token), None)
+
+
+def set_session_cookie(response: Response, token: str):
+    """Hand the session token to the client"""
+    response.set_cookie(
+        session_cookie,
+        token,
+        max_age=config.SESSION_TTL,
+        httponly=True,
+        samesite="strict",
+    )
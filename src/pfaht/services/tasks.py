@@ -0,0 +1,623 @@
+"""
+Task Service
+============
+
+Runs a command against many devices at once. Devices are coroutines on the
+event loop, not threads: a run starts at most `TASK_CONCURRENCY` workers
+that take devices off a shared iterator. A global semaphore bounds the
+commands running across every task and a per-device semaphore bounds the
+commands running against any one device. Finished device results are
+buffered and written in batches.
+"""
+
+import json
+import os
+import signal
+from asyncio import CancelledError, Event, Queue, QueueFull, Semaphore, Task
+from asyncio import TaskGroup, TimeoutError
+from asyncio import create_subprocess_shell, create_task, gather, wait, wait_for
+from asyncio.subprocess import PIPE, Process
+from codecs import getincrementaldecoder
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager, suppress
+from logging import getLogger
+from time import time
+from typing import AsyncIterator, Callable, Iterator, Protocol
+
+from fastapi import Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from .. import config, db, schema
+from ..db import execute_many
+
+logger = getLogger(__name__)
+
+OutputCallback = Callable[[str, str], None]
+"""Called with the stream (``stdout`` or ``stderr``) and a chunk of its text"""
+
+
+class Transport(Protocol):
+    """Runs a command against a device"""
+
+    async def run(
+        self, device: schema.devices.Device, command: str, output: OutputCallback
+    ) -> int:
+        """Run `command` against `device`, reporting its output as it arrives
+
+        Returns the exit code. A cancelled run stops the command before the
+        cancellation is raised.
+        """
+
+
+class LocalTransport:
+    """Run commands in a local shell
+
+    The device is described to the command by the ``PFAHT_DEVICE_ID``,
+    ``PFAHT_DEVICE_NAME``, ``PFAHT_DEVICE_TYPE`` and ``PFAHT_DEVICE_LOCATION``
+    environment variables rather than by formatting it into the command. Of
+    the app's own environment, which holds its secrets, only the variables
+    named by `TASK_ENVIRONMENT` are passed on.
+    """
+
+    chunk_size = 4096
+
+    async def run(
+        self, device: schema.devices.Device, command: str, output: OutputCallback
+    ) -> int:
+        process = await create_subprocess_shell(
+            command,
+            stdout=PIPE,
+            stderr=PIPE,
+            env={
+                **{
+                    name: os.environ[name]
+                    for name in config.TASK_ENVIRONMENT
+                    if name in os.environ
+                },
+                "PFAHT_DEVICE_ID": str(device.device_id),
+                "PFAHT_DEVICE_NAME": device.device_name,
+                "PFAHT_DEVICE_TYPE": device.device_type,
+                "PFAHT_DEVICE_LOCATION": device.device_location,
+            },
+            # A session of its own, so the whole process group can be killed
+            start_new_session=True,
+        )
+        try:
+            await gather(
+                self._read(process.stdout, "stdout", output),
+                self._read(process.stderr, "stderr", output),
+            )
+            return await process.wait()
+        except BaseException:
+            await self._kill(process)
+            raise
+
+    async def _read(self, stream, name: str, output: OutputCallback):
+        decoder = getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := await stream.read(self.chunk_size):
+            if text := decoder.decode(chunk):
+                output(name, text)
+        if text := decoder.decode(b"", final=True):
+            output(name, text)
+
+    @staticmethod
+    async def _kill(process: Process):
+        if process.returncode is None:
+            with suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+
+
+transports: dict[str, Transport] = {"local": LocalTransport()}
+"""Transports a task can name; add an entry to plug in another one"""
+
+
+def _append_output(result: schema.tasks.TaskResult, stream: str, text: str, limit):
+    """Keep the first `limit` characters of each of a result's streams"""
+    kept = getattr(result, stream)
+    if len(kept) < limit:
+        setattr(result, stream, kept + text[: limit - len(kept)])
+
+
+class TaskSubscription:
+    """A client's bounded buffer of the events of one run
+
+    A client that falls `size` events behind is dropped: its buffer is
+    emptied straight away, so a slow reader cannot hold on to server memory.
+    """
+
+    def __init__(self, size: int = 256):
+        self.dropped = False
+        self._queue: Queue[schema.tasks.TaskEvent | None] = Queue(size)
+
+    def push(self, event: schema.tasks.TaskEvent | None) -> bool:
+        """Buffer `event`; False when the buffer was full and the client dropped"""
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except QueueFull:
+            self.dropped = True
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+            return False
+
+    def close(self):
+        """End the stream once the client has read what is buffered"""
+        self.push(None)
+
+    async def get(self) -> schema.tasks.TaskEvent | None:
+        """Wait for the next event; None once the stream has ended"""
+        return await self._queue.get()
+
+
+class TaskEngine:
+    """Task Engine
+
+    Owned by the application lifespan. Runs are asyncio tasks; a run that is
+    cancelled, or still going at shutdown, records its unfinished devices as
+    cancelled.
+    """
+
+    def __init__(
+        self,
+        database_engine,
+        concurrency: int = 64,
+        device_concurrency: int = 1,
+        timeout: float = 60,
+        batch_size: int = 100,
+        flush_interval: float = 1,
+        output_limit: int = 16384,
+        stream_buffer: int = 256,
+    ):
+        self.database_engine = database_engine
+        self.concurrency = concurrency
+        self.device_concurrency = device_concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.output_limit = output_limit
+        self.stream_buffer = stream_buffer
+        self._limit = Semaphore(concurrency)
+        self._device_limits: dict[int, Semaphore] = {}
+        self._device_waiters: Counter[int] = Counter()
+        self._runs: dict[schema.tasks.TaskId, Task] = {}
+        self._subscribers: dict[schema.tasks.TaskId, set[TaskSubscription]] = {}
+
+    async def __aenter__(self) -> "TaskEngine":
+        # Runs do not survive a restart
+        async with self.database_engine.session() as session:
+            await session.execute(
+                "UPDATE tasks SET status = :cancelled, "
+                "finished_at = CURRENT_TIMESTAMP WHERE status = :running",
+                {
+                    "cancelled": schema.tasks.TaskStatus.CANCELLED,
+                    "running": schema.tasks.TaskStatus.RUNNING,
+                },
+            )
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        runs = list(self._runs.values())
+        for run in runs:
+            run.cancel()
+        await gather(*runs, return_exceptions=True)
+
+    def start(
+        self,
+        task_id: schema.tasks.TaskId,
+        command: str,
+        devices: list[schema.devices.Device],
+        transport: Transport,
+        timeout: float | None = None,
+    ):
+        """Start running `command` against `devices` in the background"""
+        run = create_task(
+            self._run(task_id, command, devices, transport, timeout or self.timeout)
+        )
+        self._runs[task_id] = run
+        run.add_done_callback(lambda _: self._runs.pop(task_id, None))
+
+    async def cancel(self, task_id: schema.tasks.TaskId) -> bool:
+        """Cancel a run and wait for it to record what it got done"""
+        if (run := self._runs.get(task_id)) is None:
+            return False
+        run.cancel()
+        await wait({run})
+        return True
+
+    @contextmanager
+    def subscribe(
+        self, task_id: schema.tasks.TaskId
+    ) -> Iterator[TaskSubscription | None]:
+        """Follow the events of a run; None when the task is not running"""
+        if task_id not in self._runs:
+            yield None
+            return
+        subscription = TaskSubscription(self.stream_buffer)
+        self._subscribers.setdefault(task_id, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            if (subscribers := self._subscribers.get(task_id)) is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[task_id]
+
+    def _publish(self, task_id: schema.tasks.TaskId, **event):
+        if not (subscribers := self._subscribers.get(task_id)):
+            return
+        event = schema.tasks.TaskEvent(**event)
+        for subscription in list(subscribers):
+            if not subscription.push(event):
+                subscribers.discard(subscription)
+
+    def _publish_result(self, task_id, result: schema.tasks.TaskResult):
+        self._publish(
+            task_id,
+            event=schema.tasks.TaskEventType.STATUS,
+            device_id=result.device_id,
+            status=result.status,
+            exit_code=result.exit_code,
+        )
+
+    @asynccontextmanager
+    async def _device_slot(self, device_id: int) -> AsyncIterator[None]:
+        limit = self._device_limits.setdefault(
+            device_id, Semaphore(self.device_concurrency)
+        )
+        self._device_waiters[device_id] += 1
+        try:
+            async with limit:
+                yield
+        finally:
+            self._device_waiters[device_id] -= 1
+            if not self._device_waiters[device_id]:
+                del self._device_waiters[device_id]
+                del self._device_limits[device_id]
+
+    async def _run_device(
+        self,
+        task_id: schema.tasks.TaskId,
+        result: schema.tasks.TaskResult,
+        device: schema.devices.Device,
+        command: str,
+        transport: Transport,
+        timeout: float,
+    ):
+        def output(stream: str, text: str):
+            _append_output(result, stream, text, self.output_limit)
+            self._publish(
+                task_id,
+                event=schema.tasks.TaskEventType.OUTPUT,
+                device_id=device.device_id,
+                stream=stream,
+                text=text,
+            )
+
+        # The device slot is taken first so that waiting on a busy device
+        # does not hold one of the global slots.
+        async with self._device_slot(device.device_id), self._limit:
+            result.status = schema.tasks.TaskStatus.RUNNING
+            result.started_at = time()
+            self._publish_result(task_id, result)
+            try:
+                result.exit_code = await wait_for(
+                    transport.run(device, command, output), timeout
+                )
+            except TimeoutError:
+                result.status = schema.tasks.TaskStatus.TIMED_OUT
+            except Exception as error:
+                logger.warning(f"Task command failed on {device.device_id}: {error!r}")
+                output("stderr", f"{error!r}\n")
+                result.status = schema.tasks.TaskStatus.FAILED
+            else:
+                result.status = (
+                    schema.tasks.TaskStatus.SUCCEEDED
+                    if result.exit_code == 0
+                    else schema.tasks.TaskStatus.FAILED
+                )
+            finally:
+                result.finished_at = time()
+            self._publish_result(task_id, result)
+
+    async def _run(
+        self,
+        task_id: schema.tasks.TaskId,
+        command: str,
+        devices: list[schema.devices.Device],
+        transport: Transport,
+        timeout: float,
+    ):
+        queue = iter(devices)
+        unfinished: dict[int, schema.tasks.TaskResult] = {
+            device.device_id: schema.tasks.TaskResult(
+                device_id=device.device_id, status=schema.tasks.TaskStatus.CANCELLED
+            )
+            for device in devices
+        }
+        finished: list[schema.tasks.TaskResult] = []
+        flush_now, done = Event(), False
+        status = schema.tasks.TaskStatus.SUCCEEDED
+
+        async def worker():
+            nonlocal status
+            for device in queue:
+                result = unfinished[device.device_id]
+                await self._run_device(
+                    task_id, result, device, command, transport, timeout
+                )
+                if result.status != schema.tasks.TaskStatus.SUCCEEDED:
+                    status = schema.tasks.TaskStatus.FAILED
+                finished.append(unfinished.pop(device.device_id))
+                if len(finished) >= self.batch_size:
+                    flush_now.set()
+
+        async def writer():
+            # The only writer of a run, so its batches never contend
+            while True:
+                with suppress(TimeoutError):
+                    await wait_for(flush_now.wait(), self.flush_interval)
+                flush_now.clear()
+                stopping = done
+                batch = finished[:]
+                finished.clear()
+                if batch:
+                    await self._write_results(task_id, batch)
+                if stopping:
+                    return
+
+        writes = create_task(writer())
+        try:
+            async with TaskGroup() as group:
+                for _ in range(min(self.concurrency, len(devices))):
+                    group.create_task(worker())
+        except CancelledError:
+            status = schema.tasks.TaskStatus.CANCELLED
+        except Exception:
+            logger.exception(f"Task {task_id} failed")
+            status = schema.tasks.TaskStatus.FAILED
+
+        # Devices that never finished keep their partial output
+        for result in unfinished.values():
+            started = result.status == schema.tasks.TaskStatus.RUNNING
+            result.status = schema.tasks.TaskStatus.CANCELLED
+            if started:
+                self._publish_result(task_id, result)
+            finished.append(result)
+        done = True
+        flush_now.set()
+        try:
+            await writes
+        except Exception:
+            logger.exception(f"Failed to save the results of task {task_id}")
+            status = schema.tasks.TaskStatus.FAILED
+
+        async with self.database_engine.session() as session:
+            await session.execute(
+                "UPDATE tasks SET status = :status, finished_at = CURRENT_TIMESTAMP "
+                "WHERE task_id = :task_id",
+                {"status": status, "task_id": task_id},
+            )
+        self._publish(task_id, event=schema.tasks.TaskEventType.DONE, status=status)
+        for subscription in self._subscribers.pop(task_id, ()):
+            subscription.close()
+
+    async def _write_results(
+        self, task_id: schema.tasks.TaskId, results: list[schema.tasks.TaskResult]
+    ):
+        query = (
+            "INSERT OR REPLACE INTO task_results ("
+            " task_id, device_id, status, exit_code, stdout, stderr,"
+            " started_at, finished_at) "
+            "VALUES (:task_id, :device_id, :status, :exit_code, :stdout, :stderr,"
+            " :started_at, :finished_at)"
+        )
+        values = [
+            {"task_id": task_id, **result.model_dump(mode="json")} for result in results
+        ]
+        async with self.database_engine.session() as session:
+            async with session.transaction():
+                await execute_many(session, query, values)
+
+
+def create_task_engine(database_engine) -> TaskEngine:
+    """Create the task engine configured by the ``TASK_*`` settings"""
+    return TaskEngine(
+        database_engine,
+        concurrency=config.TASK_CONCURRENCY,
+        device_concurrency=config.TASK_DEVICE_CONCURRENCY,
+        timeout=config.TASK_TIMEOUT,
+        batch_size=config.TASK_RESULT_BATCH_SIZE,
+        flush_interval=config.TASK_RESULT_FLUSH_INTERVAL,
+        output_limit=config.TASK_OUTPUT_LIMIT,
+        stream_buffer=config.TASK_STREAM_BUFFER,
+    )
+
+
+async def get_task_engine(request: Request) -> TaskEngine:
+    """Get the application's task engine"""
+    return request.app.state.task_engine
+
+
+async def select_devices(
+    selection: schema.tasks.DeviceSelection,
+    db: db.Database = Depends(db.get_database),
+) -> list[schema.devices.Device]:
+    """List the devices matching every criterion of `selection`"""
+    where, values = [], {}
+    if selection.device_ids:
+        where.append("device_id IN (SELECT value FROM json_each(:device_ids))")
+        values["device_ids"] = json.dumps(selection.device_ids)
+    if selection.device_type is not None:
+        where.append("device_type = :device_type")
+        values["device_type"] = selection.device_type
+    if selection.device_location is not None:
+        where.append("device_location = :device_location")
+        values["device_location"] = selection.device_location
+    query = f"SELECT * FROM devices WHERE {' AND '.join(where)} ORDER BY device_id"
+    devices = await db.fetch_all(query=query, values=values)
+    return [schema.devices.Device.model_validate(dict(device)) for device in devices]
+
+
+async def get_task(
+    task_id: schema.tasks.TaskId,
+    db: db.Database = Depends(db.get_database),
+) -> schema.tasks.TaskServiceResponse:
+    """Get a task and the results of the devices that have finished
+
+    Parameters:
+    -----------
+        task_id (int): The ID of the task to retrieve
+    """
+    task = await db.fetch_one(
+        query="SELECT * FROM tasks WHERE task_id = :task_id",
+        values={"task_id": task_id},
+    )
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    results = await db.fetch_all(
+        query="SELECT * FROM task_results WHERE task_id = :task_id ORDER BY device_id",
+        values={"task_id": task_id},
+    )
+    return schema.tasks.TaskServiceResponse(
+        data=schema.tasks.Task.model_validate(
+            {**dict(task), "results": [dict(result) for result in results]}
+        ),
+        db=db,
+    )
+
+
+async def start_task(
+    request: Request,
+    new_task: schema.tasks.NewTask,
+    db: db.Database = Depends(db.get_database),
+    task_engine: TaskEngine = Depends(get_task_engine),
+) -> schema.tasks.TaskServiceResponse:
+    """Start running a command against the selected devices
+
+    Parameters:
+    -----------
+        new_task (schema.tasks.NewTask): The command and the devices to run it on
+
+    Returns:
+    --------
+        schema.tasks.TaskServiceResponse: The task, as it stands once started
+    """
+    if (user := getattr(request.state, "user", None)) is None:
+        raise HTTPException(status_code=401, detail="Log in to run tasks")
+    if (transport := transports.get(new_task.transport)) is None:
+        raise HTTPException(
+            status_code=422, detail=f"Unknown transport {new_task.transport!r}"
+        )
+    devices = await select_devices(new_task.devices, db)
+    task_id = await db.execute(
+        query=(
+            "INSERT INTO tasks "
+            "(command, transport, status, created_by, device_count) "
+            "VALUES (:command, :transport, :status, :created_by, :device_count)"
+        ),
+        values={
+            "command": new_task.command,
+            "transport": new_task.transport,
+            "status": schema.tasks.TaskStatus.RUNNING,
+            "created_by": user.id,
+            "device_count": len(devices),
+        },
+    )
+    task_engine.start(task_id, new_task.command, devices, transport, new_task.timeout)
+    return await get_task(task_id, db)
+
+
+async def cancel_task(
+    task_id: schema.tasks.TaskId,
+    db: db.Database = Depends(db.get_database),
+    task_engine: TaskEngine = Depends(get_task_engine),
+) -> schema.tasks.TaskServiceResponse:
+    """Cancel a running task
+
+    Parameters:
+    -----------
+        task_id (int): The ID of the task to cancel
+    """
+    await task_engine.cancel(task_id)
+    return await get_task(task_id, db)
+
+
+def format_event(event: str, data: str) -> str:
+    """Frame `data` as one Server-Sent Event named `event`
+
+    >>> format_event("output", "a\\nb")
+    'event: output\\ndata: a\\ndata: b\\n\\n'
+    """
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return f"event: {event}\n{lines}\n"
+
+
+async def stream_task(
+    request: Request,
+    task_id: schema.tasks.TaskId,
+    event_format: schema.tasks.TaskEventFormat = Query(
+        schema.tasks.TaskEventFormat.HTML, alias="format"
+    ),
+    task_engine: TaskEngine = Depends(get_task_engine),
+) -> StreamingResponse:
+    """Stream a running task's output and status changes as Server-Sent Events
+
+    HTML events are fragments for the HTMX SSE extension to swap in; JSON
+    events carry the same fields as `schema.tasks.TaskEvent`. Clients see the
+    events from when they connect; a task that is not running gets a single
+    ``done`` event.
+    """
+    from ..web.html import templates
+
+    template = templates.env.get_template("task-event/detail.html")
+
+    def encode(event: schema.tasks.TaskEvent) -> str:
+        if event_format == schema.tasks.TaskEventFormat.JSON:
+            data = event.model_dump_json(exclude_none=True)
+        else:
+            data = template.render(item=event)
+        return format_event(event.event, data)
+
+    async def finished() -> schema.tasks.TaskEvent:
+        async with request.app.state.database_engine.session() as session:
+            status = await session.fetch_val(
+                "SELECT status FROM tasks WHERE task_id = :task_id",
+                {"task_id": task_id},
+            )
+        return schema.tasks.TaskEvent(
+            event=schema.tasks.TaskEventType.DONE, status=status
+        )
+
+    async def events() -> AsyncIterator[str]:
+        with task_engine.subscribe(task_id) as subscription:
+            if subscription is None:
+                yield encode(await finished())
+                return
+            while True:
+                try:
+                    event = await wait_for(
+                        subscription.get(), config.TASK_STREAM_KEEPALIVE
+                    )
+                except TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield encode(event)
+            if subscription.dropped:
+                yield encode(
+                    schema.tasks.TaskEvent(event=schema.tasks.TaskEventType.DROPPED)
+                )
+
+    # Not found is reported before the stream starts. The session is released
+    # before then too, as a request session would be held until the stream
+    # ends.
+    async with request.app.state.database_engine.session() as session:
+        await get_task(task_id, db.InstrumentedSession(session))
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,61 +1,13 @@
-from fastapi import Depends
+from fastapi import Depends, Query, Request
+from fastapi.responses import StreamingResponse
 
 from .. import db, schema
+from ..db import paged_query
+from . import export
 
 from enum import StrEnum
 
 
-async def create_user_table(db: db.Database = Depends(db.get_database)):
-    """Create the users table"""
-    create_user_table = (
-        "CREATE TABLE IF NOT EXISTS users ("
-        "    id TEXT NOT NULL,"
-        "    email TEXT NOT NULL,"
-        "    verified_email BOOLEAN NOT NULL,"
-        "    name TEXT NOT NULL,"
-        "    given_name TEXT NOT NULL,"
-        "    family_name TEXT NOT NULL,"
-        "    picture TEXT NOT NULL"
-        ")"
-    )
-    create_unique_index_user_id = (
-        "CREATE UNIQUE INDEX IF NOT EXISTS unique_idx_users_id ON users (id);"
-    )
-    create_index_user_email = (
-        "CREATE INDEX IF NOT EXISTS idx_users_email ON users (email);"
-    )
-    create_group_table = (
-        "CREATE TABLE IF NOT EXISTS groups ("
-        "    id INTEGER PRIMARY KEY AUTOINCREMENT,"
-        "    name TEXT NOT NULL"
-        ")"
-    )
-    create_group_table_name_index = (
-        "CREATE UNIQUE INDEX IF NOT EXISTS unique_idx_groups_name ON groups (name);"
-    )
-    create_user_group_table = (
-        "CREATE TABLE IF NOT EXISTS user_groups ("
-        "    user_id TEXT NOT NULL,"
-        "    group_id INTEGER NOT NULL,"
-        "    PRIMARY KEY (user_id, group_id),"
-        "    FOREIGN KEY (user_id) REFERENCES users (id),"
-        "    FOREIGN KEY (group_id) REFERENCES groups (id)"
-        ")"
-    )
-
-    return [
-        await db.execute(query=query)
-        for query in (
-            create_user_table,
-            create_unique_index_user_id,
-            create_index_user_email,
-            create_group_table,
-            create_group_table_name_index,
-            create_user_group_table,
-        )
-    ]
-
-
 async def create_user(
     user: schema.users.User,
     db: db.Database = Depends(db.get_database),
@@ -75,14 +27,30 @@ async def list_users(
     page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
 ):
     """List all users"""
-    query = "SELECT * FROM users LIMIT :per_page OFFSET :offset"
-    users = await db.fetch_all(
-        query=query,
-        values={"per_page": page_options.per_page, "offset": page_options.offset},
-    )
+    query, values = paged_query("SELECT * FROM users", page_options, key=["id"])
+    users = await db.fetch_all(query=query, values=values)
     return [schema.users.User.model_validate(dict(user)) for user in users]
 
 
+async def export_users(
+    request: Request,
+    group_id: int | None = None,
+    export_format: schema.api.ExportFormat = Query(
+        schema.api.ExportFormat.NDJSON, alias="format"
+    ),
+) -> StreamingResponse:
+    """Stream every user, or the members of `group_id`, as NDJSON or CSV"""
+    where, values = [], {}
+    if group_id is not None:
+        where.append(
+            "id IN (SELECT user_id FROM user_groups WHERE group_id = :group_id)"
+        )
+        values["group_id"] = group_id
+    return export.export_response(
+        request, "users", "SELECT * FROM users", "id", where, values, export_format
+    )
+
+
 async def get_user(user_id: str, db: db.Database = Depends(db.get_database)):
     """Get a user by ID"""
     query = "SELECT * FROM users WHERE id = :id"
@@ -107,20 +75,28 @@ async def add_user_to_group(
     )
 
 
+async def list_user_group_ids(
+    user_id: str,
+    db: db.Database = Depends(db.get_database),
+) -> list[int]:
+    """List the IDs of the groups a user belongs to"""
+    query = "SELECT group_id FROM user_groups WHERE user_id = :user_id"
+    rows = await db.fetch_all(query=query, values={"user_id": user_id})
+    return [row["group_id"] for row in rows]
+
+
 async def list_groups(
     db: db.Database = Depends(db.get_database),
     page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
 ) -> schema.users.GroupListServiceResponse:
     """List all groups"""
-    query = "SELECT * FROM groups LIMIT :per_page OFFSET :offset"
-    groups = await db.fetch_all(
-        query=query,
-        values={"per_page": page_options.per_page, "offset": page_options.offset},
-    )
+    query, values = paged_query("SELECT * FROM groups", page_options, key=["id"])
+    groups = await db.fetch_all(query=query, values=values)
     groups = [schema.users.Group.model_validate(dict(group)) for group in groups]
     return schema.users.GroupListServiceResponse(
         data=groups,
         db=db,
+        page_options=page_options,
     )
 
 
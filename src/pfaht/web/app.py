@@ -3,25 +3,91 @@ Web Application Entry Point
 ===========================
 """
 
+from contextlib import asynccontextmanager
 from logging import getLogger
+from secrets import compare_digest
+from typing import Annotated
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 
 
-from .. import __version__, dist_name, schema, config
+from .. import __version__, dist_name, schema, config, db, metrics, migrations, services
+from ..logging import configure_logging
 from . import html
 from .routes import install_routes
 
+configure_logging()
 logger = getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own the resources shared by every request for the app lifetime"""
+    if not config.SESSION_SECRET:
+        raise RuntimeError(
+            "SESSION_SECRET is not set; set it to a long random string that is "
+            "used for nothing else, to sign session tokens with"
+        )
+    async with (
+        db.create_engine() as database_engine,
+        services.google.create_http_client() as http_client,
+    ):
+        if config.TEMPLATE_PRECOMPILE:
+            html.precompile_templates()
+        if config.DATABASE_MIGRATE:
+            async with database_engine.session() as session:
+                await migrations.migrate(session)
+        async with services.tasks.create_task_engine(database_engine) as task_engine:
+            app.state.database_engine = database_engine
+            app.state.http_client = http_client
+            app.state.task_engine = task_engine
+            yield
+
+
 app = FastAPI(
     title=dist_name,
     version=__version__,
+    lifespan=lifespan,
 )
+
+
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.middleware("http")
+async def send_refreshed_session(request: Request, call_next):
+    """Send the client a session token that was refreshed in the background"""
+    response = await call_next(request)
+    if session_token := getattr(request.state, "session_token", None):
+        services.sessions.set_session_cookie(response, session_token)
+    return response
+
+
 app.mount("/static", html.static, name="static")
 install_routes(app)
 html.configure_templates(app)
 
 
+@app.get("/metrics", tags=["Admin"], response_class=PlainTextResponse)
+def app_metrics(authorization: Annotated[str | None, Header()] = None):
+    """Request, database, template and Google timings for Prometheus
+
+    Scrapers authenticate with ``Authorization: Bearer <METRICS_TOKEN>``.
+    """
+    if not config.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not compare_digest(authorization or "", f"Bearer {config.METRICS_TOKEN}"):
+        raise HTTPException(
+            status_code=401,
+            detail="Send the metrics token as a bearer token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/", tags=["Index"])
 @html.content_negotiation()
 def app_index(_request: Request):
@@ -1,24 +1,46 @@
 from asyncio import iscoroutine
+from collections import OrderedDict
 from functools import wraps
 from pathlib import Path
 from logging import getLogger
+from time import perf_counter
+from urllib.parse import parse_qs
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
+from pydantic import BaseModel, computed_field
 
-from ... import schema
+from ... import config, metrics, schema
+from .sprites import Sprite
 
 logger = getLogger(__name__)
 template_path = Path(__file__).parent / "templates"
 templates = Jinja2Templates(directory=template_path)
 
 static_path = Path(__file__).parent / "static"
-print(f"Static Path: {static_path}")
-static = StaticFiles(directory=static_path)
 
-_cached_templates = {}
+
+class VersionedStaticFiles(StaticFiles):
+    """Static files, cached for good when requested with a ``v`` version"""
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code == 200 and "v" in parse_qs(
+            scope["query_string"].decode()
+        ):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+static = VersionedStaticFiles(directory=static_path)
+sprite = Sprite(template_path, static_path)
+
+template_index: frozenset[str] = frozenset()
+"""Names of every template, scanned when the templates are configured"""
 
 
 def camel_to_kebab(string: str) -> str:
@@ -27,15 +49,31 @@ def camel_to_kebab(string: str) -> str:
 
 
 def template_exists(template_name: str) -> bool:
-    """Check if a template exists"""
-    if template_name in _cached_templates:
-        return _cached_templates[template_name]
-    try:
-        exists = templates.get_template(template_name) is not None
-    except Exception:
-        exists = False
-    _cached_templates[template_name] = exists
-    return exists
+    """Check if a template exists
+
+    >>> template_exists(None)
+    False
+    """
+    if not isinstance(template_name, str):
+        return False
+    # The same normalization the template loader applies
+    pieces = [p for p in template_name.split("/") if p and p != "."]
+    return "/".join(pieces) in template_index
+
+
+def index_templates():
+    """Scan the template tree into `template_index`"""
+    global template_index
+    template_index = frozenset(templates.env.list_templates())
+
+
+def precompile_templates():
+    """Compile every HTML template now instead of on first use"""
+    started = perf_counter()
+    names = [name for name in template_index if name.endswith(".html")]
+    for name in names:
+        templates.env.get_template(name)
+    logger.info(f"Compiled {len(names)} templates in {perf_counter() - started:.3f}s")
 
 
 def template_path_from_request(request: Request):
@@ -58,7 +96,103 @@ def template_path_from_item(item: any, request: Request):
     return f"{template_base_path}/{template_format}.html"
 
 
+class FragmentCacheStats(BaseModel):
+    """Fragment Cache Statistics"""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size: int = 0
+    """Characters held by the cached fragments"""
+
+    @computed_field
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class FragmentCache:
+    """Rendered Fragment Cache
+
+    A least recently used cache of rendered per-item templates, capped by
+    the characters it holds. Items opt in with a `_fragment_version` that
+    changes whenever the item does, so an updated item misses the cache and
+    its stale renders age out. An item whose template reads the user lists
+    the user attributes it reads in `_fragment_user_fields`.
+
+    >>> cache = FragmentCache(max_size=5)
+    >>> cache.set("a", "abc"); cache.set("b", "def")
+    >>> cache.get("a") is None, cache.get("b")
+    (True, 'def')
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.stats = FragmentCacheStats()
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+
+    def get(self, key) -> str | None:
+        if (fragment := self._entries.get(key)) is None:
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return fragment
+
+    def set(self, key, fragment: str):
+        if len(fragment) > self.max_size:
+            return
+        if (replaced := self._entries.pop(key, None)) is not None:
+            self.stats.size -= len(replaced)
+        self._entries[key] = fragment
+        self.stats.size += len(fragment)
+        while self.stats.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.stats.size -= len(evicted)
+            self.stats.evictions += 1
+        self.stats.entries = len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.stats.size = self.stats.entries = 0
+
+
+fragment_cache = FragmentCache(max_size=config.FRAGMENT_CACHE_SIZE)
+
+
+def fragment_key(item: any, template_name: str, request: Request) -> tuple | None:
+    """Cache key for rendering `item` with `template_name`; None if uncacheable"""
+    if (version := getattr(item, "_fragment_version", None)) is None:
+        return None
+    user = getattr(request.state, "user", None)
+    user_fields = getattr(item, "_fragment_user_fields", ())
+    vary = tuple(getattr(user, field, None) for field in user_fields)
+    return (template_name, item.__class__.__name__, version, vary)
+
+
+@pass_context
+def render_fragment(context, item: any, template_name: str) -> Markup:
+    """Render one item with `template_name`, reusing an earlier render
+
+    The fragment is rendered with only `item` and `request` in its context,
+    which is all a cached render may depend on.
+    """
+    request = context["request"]
+    key = None
+    if config.FRAGMENT_CACHE_SIZE:
+        key = fragment_key(item, template_name, request)
+    if key is not None and (fragment := fragment_cache.get(key)) is not None:
+        return Markup(fragment)
+    fragment = templates.get_template(template_name).render(item=item, request=request)
+    if key is not None:
+        fragment_cache.set(key, fragment)
+    return Markup(fragment)
+
+
 def configure_templates(app: FastAPI):
+    logger.debug(f"Static Path: {static_path}")
     #  configure the template environment filters
     templates.env.globals["app_name"] = app.title
     templates.env.globals["app"] = app.version
@@ -69,12 +203,43 @@ def configure_templates(app: FastAPI):
     templates.env.filters["template_exists"] = template_exists
     templates.env.filters["template_path_from_request"] = template_path_from_request
     templates.env.filters["template_path_from_item"] = template_path_from_item
+    templates.env.globals["render_fragment"] = render_fragment
+    sprite.load()
+    app.add_api_route(sprite.route, sprite.response, include_in_schema=False)
+    templates.env.filters["icon_href"] = sprite.href
+    templates.env.auto_reload = config.TEMPLATE_AUTO_RELOAD
+    if config.TEMPLATE_BYTECODE_CACHE:
+        templates.env.bytecode_cache = FileSystemBytecodeCache(
+            config.TEMPLATE_BYTECODE_CACHE_DIR
+        )
+    index_templates()
+
 
+def json_response(response: any, request: Request) -> Response:
+    """Serialize a response model straight to JSON
 
-def content_negotiation():
+    FastAPI validates a returned model against the route's `response_model`
+    by dumping it and validating the dump again before serializing it. A
+    route whose return value already is its `response_model` can skip that
+    and have pydantic serialize it once.
+    """
+    if not isinstance(response, BaseModel):
+        return response
+    return Response(
+        content=response.model_dump_json(by_alias=True),
+        media_type="application/json",
+        headers=getattr(request.state, "etag_headers", None),
+    )
+
+
+def content_negotiation(fast_json: bool = False):
     """Decorator that will check the Accept header and return the appropriate response]
 
     Requires that you have the request object as a parameter in the decorated function
+
+    Args:
+        fast_json (bool, optional): Serialize JSON responses with `json_response`.
+            Only for routes returning their `response_model`. Defaults to False.
     """
 
     def decorator(f):
@@ -88,14 +253,21 @@ def content_negotiation():
 
             # Requires that the request object is passed in as a parameter
             if not (request := kwargs.get("_request", kwargs.get("request", None))):
-                logger.info("Skipping HTML Parsing; Request object not found in kwargs")
+                logger.debug(
+                    "Skipping HTML Parsing; Request object not found in kwargs"
+                )
                 return response
 
+            # Read back by the metrics middleware to label the request
+            request.state.response_format = "json"
+            as_json = json_response if fast_json else lambda response, _: response
+
             # Check if the request has an Accept header
-            logger.info(f"Request Headers: {request.headers}")
+            if config.LOG_REQUEST_HEADERS:
+                logger.debug("Request Headers: %s", request.headers)
             if not (accept_header := request.headers.get("Accept", None)):
-                logger.info("No Accept header found")
-                return response
+                logger.debug("No Accept header found")
+                return as_json(response, request)
 
             html_found = False
             for html_accept in ["text/html", "application/xhtml+xml"]:
@@ -104,24 +276,34 @@ def content_negotiation():
                     break
 
             if not html_found:
-                logger.info("No HTML Accept header found")
-                return response
+                logger.debug("No HTML Accept header found")
+                return as_json(response, request)
 
             # Transform the response into an html response if the return
             # has an _html or _html_template attribute.
+            # Headers set through an injected Response only reach JSON
+            # responses, so the entity tag is carried on the request state.
+            headers = getattr(request.state, "etag_headers", None)
             if hasattr(response, "_html"):
-                logger.info(f"Returning HTML: {response._html}")
-                return HTMLResponse(content=response._html)
+                logger.debug("Returning HTML: %s", response._html)
+                request.state.response_format = "html"
+                return HTMLResponse(content=response._html, headers=headers)
 
             if hasattr(response, "_html_template"):
-                logger.info(f"Rendering template: {response._html_template}")
-                return templates.TemplateResponse(
-                    request=request,
-                    name=response._html_template,
-                    context={"item": response},
-                )
+                logger.debug("Rendering template: %s", response._html_template)
+                request.state.response_format = "html"
+                # The template is rendered when the response is created
+                with metrics.Timer(
+                    metrics.template_render_seconds, response._html_template
+                ):
+                    return templates.TemplateResponse(
+                        request=request,
+                        name=response._html_template,
+                        context={"item": response},
+                        headers=headers,
+                    )
 
-            return response
+            return as_json(response, request)
 
         return wrapper
 
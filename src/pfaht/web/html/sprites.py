@@ -0,0 +1,156 @@
+"""
+SVG Sprite Sheet
+================
+
+Packs the heroicons and svgrepo icons into one sprite sheet of ``<symbol>``
+elements, served from memory and cached by the browser for good. Icons are
+then drawn with a ``<use>`` reference to their symbol instead of repeating
+the SVG markup for every item on a page.
+
+The sprite is rebuilt at startup whenever an icon is newer than the copy in
+``static``, or by hand with ``python -m pfaht.web.html.sprites``. It is still
+served when that copy cannot be written, such as from a read-only install.
+"""
+
+import re
+import xml.etree.ElementTree as ElementTree
+from hashlib import blake2b
+from logging import getLogger
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from fastapi import Request
+from fastapi.responses import Response
+
+logger = getLogger(__name__)
+
+icon_dirs = ("heroicons", "svgrepo")
+"""Template directories whose icons are packed into the sprite"""
+
+svg_namespace = "http://www.w3.org/2000/svg"
+
+inherited_attributes = (
+    "fill",
+    "stroke",
+    "stroke-width",
+    "stroke-linecap",
+    "stroke-linejoin",
+)
+"""Attributes of an icon's root that its shapes inherit"""
+
+ElementTree.register_namespace("", svg_namespace)
+
+
+def symbol_id(icon: str) -> str:
+    """The sprite symbol id of an icon template path
+
+    >>> symbol_id("/svgrepo/router.svg")
+    'svgrepo-router'
+    >>> symbol_id("heroicons/solid/cog-6-tooth.svg")
+    'heroicons-solid-cog-6-tooth'
+    """
+    return icon.strip("/").removesuffix(".svg").replace("/", "-")
+
+
+def _symbol(icon_id: str, svg: ElementTree.Element) -> ElementTree.Element:
+    """Turn an icon's root ``<svg>`` into a ``<symbol>``"""
+    symbol = ElementTree.Element(f"{{{svg_namespace}}}symbol", id=icon_id)
+    if view_box := svg.get("viewBox"):
+        symbol.set("viewBox", view_box)
+    # Wrapped in a group so the shapes keep inheriting the root's colours
+    group = ElementTree.SubElement(
+        symbol,
+        f"{{{svg_namespace}}}g",
+        {name: svg.get(name) for name in inherited_attributes if svg.get(name)},
+    )
+    group.extend(svg)
+    for element in symbol.iter():
+        element.text = element.text.strip() if element.text else None
+        element.tail = None
+    return symbol
+
+
+def build_sprite(template_path: Path) -> tuple[str, set[str]]:
+    """Pack the icons under `template_path` into a minified sprite sheet
+
+    Returns the sprite and the ids of the symbols in it.
+    """
+    sprite = ElementTree.Element(f"{{{svg_namespace}}}svg")
+    icon_ids = set()
+    for icon_dir in icon_dirs:
+        for path in sorted((template_path / icon_dir).rglob("*.svg")):
+            icon_id = symbol_id(path.relative_to(template_path).as_posix())
+            try:
+                svg = ElementTree.parse(path).getroot()
+            except ElementTree.ParseError as e:
+                logger.warning(f"Skipping icon {path}: {e}")
+                continue
+            sprite.append(_symbol(icon_id, svg))
+            icon_ids.add(icon_id)
+    markup = ElementTree.tostring(sprite, encoding="unicode")
+    return re.sub(r"\s+", " ", markup), icon_ids
+
+
+class Sprite:
+    """The sprite sheet served by the app
+
+    The URL carries a hash of the sprite, so it can be cached forever and
+    still change whenever an icon does.
+    """
+
+    def __init__(self, template_path: Path, static_path: Path, name="sprite.svg"):
+        self.template_path = template_path
+        self.path = static_path / name
+        self.markup = ""
+        self.icon_ids: frozenset[str] = frozenset()
+        self.route = f"/{name}"
+        """Path the app serves the sprite on"""
+        self.url = self.route
+
+    def _stale(self) -> bool:
+        if not self.path.exists():
+            return True
+        built = self.path.stat().st_mtime
+        return any(
+            path.stat().st_mtime > built
+            for icon_dir in icon_dirs
+            for path in (self.template_path / icon_dir).rglob("*.svg")
+        )
+
+    def load(self):
+        """Build the sprite if it is out of date, then index it"""
+        if self._stale():
+            markup, icon_ids = build_sprite(self.template_path)
+            try:
+                self.path.write_text(markup, encoding="utf-8")
+            except OSError as e:
+                logger.warning(f"Could not write the icon sprite {self.path}: {e}")
+            logger.info(f"Built icon sprite with {len(icon_ids)} icons")
+        else:
+            markup = self.path.read_text(encoding="utf-8")
+            icon_ids = set(re.findall(r'<symbol id="([^"]+)"', markup))
+        self.markup = markup
+        self.icon_ids = frozenset(icon_ids)
+        version = blake2b(markup.encode(), digest_size=8).hexdigest()
+        self.url = f"{self.route}?v={version}"
+
+    def response(self, request: Request) -> Response:
+        """The sprite, cached for good when requested with a ``v`` version"""
+        headers = {}
+        if "v" in parse_qs(request.url.query):
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return Response(self.markup, media_type="image/svg+xml", headers=headers)
+
+    def href(self, icon: str) -> str | None:
+        """The ``<use>`` reference of an icon, None if it is not in the sprite"""
+        if (icon_id := symbol_id(icon)) not in self.icon_ids:
+            return None
+        return f"{self.url}#{icon_id}"
+
+
+if __name__ == "__main__":
+    from . import static_path, template_path
+
+    markup, icon_ids = build_sprite(template_path)
+    (static_path / "sprite.svg").write_text(markup, encoding="utf-8")
+    print(f"Packed {len(icon_ids)} icons into {static_path / 'sprite.svg'}")
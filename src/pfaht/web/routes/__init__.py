@@ -7,17 +7,20 @@ This module contains the FastAPI routers for the web app server.
 
 from fastapi import FastAPI, Depends
 
-from . import auth, devices, device_types, issues, users
+from . import admin, auth, devices, device_types, issues, search, tasks, users
 
 from ... import services
 
 
 def install_routes(app: FastAPI):
     for router in [
+        admin.router,
         auth.router,
         devices.router,
         device_types.router,
         issues.router,
+        search.router,
+        tasks.router,
         users.router,
         users.group_router,
     ]:
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Depends, status
+
+from ... import db, services
+from .. import html
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"],
+    dependencies=[Depends(services.google.require_admin)],
+)
+
+
+@router.get("/fragment-cache", response_model=html.FragmentCacheStats)
+async def fragment_cache_stats():
+    """Hits, misses and size of the rendered fragment cache"""
+    return html.fragment_cache.stats
+
+
+@router.get("/slow-queries", response_model=list[db.SlowQuery])
+async def slow_queries():
+    """The slowest queries since startup, with their query plans"""
+    return db.slow_queries.queries
+
+
+@router.delete("/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_slow_queries():
+    """Forget the slow queries seen so far"""
+    db.slow_queries.clear()
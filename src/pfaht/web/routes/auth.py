@@ -23,22 +23,26 @@ async def login(request: Request):
         "access_type": "offline",
         "redirect_uri": config.GOOGLE_REDIRECT_URI,
     }
-    google_auth_url = (
-        f"https://accounts.google.com/o/oauth2/v2/auth?{parse.urlencode(params)}"
-    )
+    google_auth_url = f"{config.GOOGLE_AUTH_URL}?{parse.urlencode(params)}"
     return RedirectResponse(google_auth_url)
 
 
 @router.get("/google")
 async def auth_google(
     response: Response,
-    token_response: dict = Depends(services.google.get_google_auth_token),
+    google_session: schema.auth.GoogleSessionServiceResponse = Depends(
+        services.google.get_google_auth_token
+    ),
 ):
-    logger.debug(f"{token_response=}")
-    for google_json_key, google_json_value in token_response.items():
+    if isinstance(google_session, schema.auth.GetAuthGoogleResponse):
+        # The login failed, the response explains why
+        return google_session
+    logger.debug("Logged in %s", google_session.data.user.id)
+    services.sessions.set_session_cookie(response, google_session.data.session_token)
+    if google_session.data.refresh_token:
         response.set_cookie(
-            google_json_key,
-            google_json_value,
+            "refresh_token",
+            google_session.data.refresh_token,
             httponly=True,
             samesite="strict",
         )
@@ -47,9 +51,31 @@ async def auth_google(
     )
 
 
+@router.get("/logout")
+async def logout(
+    request: Request,
+    response: Response,
+    access_token: Annotated[str | None, Cookie()] = None,
+):
+    if access_token:
+        services.google.userinfo_cache.invalidate(access_token)
+    # Do not hand out a session that was refreshed during this request
+    request.state.session_token = None
+    for google_json_key in (
+        services.sessions.session_cookie,
+        "access_token",
+        "expires_in",
+        "refresh_token",
+    ):
+        response.delete_cookie(google_json_key, httponly=True, samesite="strict")
+    return schema.auth.GetAuthLogoutResponse(
+        message="Successfully logged out",
+    )
+
+
 @router.get("/google/token")
-async def get_token(access_token: Annotated[str | None, Cookie()] = None):
-    return jwt.decode(access_token, config.GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
+async def get_token(session: Annotated[str | None, Cookie()] = None):
+    return services.sessions.decode_session_token(session) if session else None
 
 
 @router.get("/google/me")
@@ -1,33 +1,64 @@
 from logging import getLogger
 from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
 
-from ... import schema, services
+from ... import migrations, schema, services
 from .. import html
 
 logger = getLogger(__name__)
 router = APIRouter(prefix="/devices", tags=["Devices"])
 
 
-@router.get("/init")
+@router.get("/init", deprecated=True)
 async def install_devices_table(
-    install_result=Depends(services.devices.create_device_table),
+    install_result=Depends(migrations.apply_migrations),
 ):
-    """Initialize the devices table"""
-    logger.debug(f"{install_result=}")
+    """Initialize the devices table
+
+    Pending migrations are applied at startup; this applies any left over.
+    """
+    logger.debug("install_result=%r", install_result)
     return {"message": "Device table created"}
 
 
-@router.get("", response_model=schema.devices.DeviceListResponse)
-@html.content_negotiation()
+@router.get(
+    "",
+    response_model=schema.devices.DeviceListResponse,
+    dependencies=[
+        Depends(
+            services.etags.table_etag("devices", counted=("related_devices", "issues"))
+        )
+    ],
+)
+@html.content_negotiation(fast_json=True)
 async def list_devices(
-    _request: Request, device_list=Depends(services.devices.list_devices)
+    _request: Request,
+    device_list=Depends(services.devices.list_devices),
+    page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
+    device_filter: schema.devices.DeviceFilter = Depends(schema.devices.DeviceFilter),
+    count_options: schema.api.CountOptions = Depends(schema.api.CountOptions),
 ):
-    """List all devices"""
-    return schema.devices.DeviceListResponse(response=device_list)
-
-
-@router.get("/{device_id}", response_model=schema.devices.DeviceResponse)
-@html.content_negotiation()
+    """List devices, filtered by type, location or name prefix"""
+    return schema.devices.DeviceListResponse(
+        response=device_list,
+        page_options=page_options,
+        filters=device_filter,
+        count_options=count_options,
+    )
+
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_devices(export=Depends(services.devices.export_devices)):
+    """Stream all devices as NDJSON or CSV (``?format=csv``)"""
+    return export
+
+
+@router.get(
+    "/{device_id}",
+    response_model=schema.devices.DeviceResponse,
+    dependencies=[Depends(services.etags.row_etag("devices", "device_id"))],
+)
+@html.content_negotiation(fast_json=True)
 async def get_device(_request: Request, device=Depends(services.devices.get_device)):
     """Get a device by ID"""
     return schema.devices.DeviceResponse(response=device)
@@ -63,6 +94,21 @@ def create_device(
     return schema.devices.DeviceCreatedResponse(response=created_device)
 
 
+@router.post("/bulk", response_model=schema.api.BulkImportResponse)
+async def bulk_create_devices(
+    import_result: schema.api.BulkImportResult = Depends(
+        services.devices.bulk_create_devices
+    ),
+):
+    """
+    Create devices from a streamed NDJSON or CSV (``text/csv``) upload
+    """
+    return schema.api.BulkImportResponse(
+        response=import_result,
+        message=f"Created {import_result.created} of {import_result.received} devices",
+    )
+
+
 @router.get("/{device_id}/issues", response_model=schema.issues.IssueListResponse)
 def list_assigned_issues(
     issue_list: schema.issues.IssueListServiceResponse = Depends(
@@ -1,21 +1,28 @@
 from logging import getLogger
 from fastapi import APIRouter, Depends, Request, Form, Body
+from fastapi.responses import StreamingResponse
 from typing import Annotated
 
-from ... import schema, services
+from ... import migrations, schema, services
 from .. import html
 
 logger = getLogger(__name__)
 router = APIRouter(prefix="/issues", tags=["Issues"])
 
 
-@router.get("/init", response_model=schema.issues.IssueTableCreatedResponse)
+@router.get(
+    "/init",
+    response_model=schema.issues.IssueTableCreatedResponse,
+    deprecated=True,
+)
 async def init_issues_tables(
-    issues_table=Depends(services.issues.create_issue_table),
-    related_devices_table=Depends(services.issues.create_related_devices_table),
+    install_result=Depends(migrations.apply_migrations),
 ) -> schema.issues.IssueTableCreatedResponse:
-    """Initialize the Issues table"""
-    logger.debug(f"{issues_table=}; {related_devices_table=}")
+    """Initialize the Issues table
+
+    Pending migrations are applied at startup; this applies any left over.
+    """
+    logger.debug("install_result=%r", install_result)
 
     return schema.issues.IssueTableCreatedResponse()
 
@@ -31,20 +38,39 @@ async def new_issue(_request: Request):
     )
 
 
-@router.get("", response_model=schema.issues.IssueListResponse)
-@html.content_negotiation()
+@router.get(
+    "",
+    response_model=schema.issues.IssueListResponse,
+    dependencies=[
+        Depends(services.etags.table_etag("issues", counted=("related_devices",)))
+    ],
+)
+@html.content_negotiation(fast_json=True)
 async def list_issues(
     _request: Request,
     issue_list=Depends(services.issues.list_issues),
+    count_options: schema.api.CountOptions = Depends(schema.api.CountOptions),
 ) -> schema.issues.IssueListResponse:
     """List all issues"""
     return schema.issues.IssueListResponse(
-        response=issue_list.data, page_options=issue_list.page_options
+        response=issue_list.data,
+        page_options=issue_list.page_options,
+        count_options=count_options,
     )
 
 
-@router.get("/{issue_id}", response_model=schema.issues.IssueResponse)
-@html.content_negotiation()
+@router.get("/export", response_class=StreamingResponse)
+async def export_issues(export=Depends(services.issues.export_issues)):
+    """Stream all issues as NDJSON or CSV (``?format=csv``)"""
+    return export
+
+
+@router.get(
+    "/{issue_id}",
+    response_model=schema.issues.IssueResponse,
+    dependencies=[Depends(services.etags.row_etag("issues", "issue_id"))],
+)
+@html.content_negotiation(fast_json=True)
 async def get_issue(
     _request: Request,
     issue: schema.issues.IssueServiceResponse = Depends(services.issues.get_issue),
@@ -86,17 +112,38 @@ def create_issue(
     return schema.issues.IssueResponse(response=created_issue)
 
 
-@router.get("/{issue_id}/devices", response_model=schema.issues.RelatedDevicesResponse)
-@html.content_negotiation()
+@router.post("/bulk", response_model=schema.api.BulkImportResponse)
+async def bulk_create_issues(
+    import_result: schema.api.BulkImportResult = Depends(
+        services.issues.bulk_create_issues
+    ),
+):
+    """
+    Create issues from a streamed NDJSON or CSV (``text/csv``) upload
+    """
+    return schema.api.BulkImportResponse(
+        response=import_result,
+        message=f"Created {import_result.created} of {import_result.received} issues",
+    )
+
+
+@router.get(
+    "/{issue_id}/devices",
+    response_model=schema.issues.RelatedDevicesResponse,
+    dependencies=[Depends(services.etags.table_etag("related_devices", "devices"))],
+)
+@html.content_negotiation(fast_json=True)
 def get_related_devices(
     _request: Request,
     issue_id: int,
     related_devices=Depends(services.issues.get_related_devices),
+    page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
 ):
-    """Get all devices related to an issue"""
+    """Get a page of the devices related to an issue"""
     return schema.issues.RelatedDevicesResponse(
         response=related_devices,
         issue_id=issue_id,
+        page_options=page_options,
     )
 
 
@@ -128,3 +175,35 @@ def relate_device(
 ):
     """Relate a device to an issue"""
     return schema.issues.RelateDeviceResponse(response=related_device.response)
+
+
+@router.put(
+    "/{issue_id}/devices/bulk-relate",
+    response_model=schema.issues.RelatedDeviceBatchResponse,
+)
+async def relate_devices(
+    batch_result: schema.issues.RelatedDeviceBatchResult = Depends(
+        services.issues.relate_devices
+    ),
+):
+    """Relate devices, listed by id or matching a filter, to an issue at once"""
+    return schema.issues.RelatedDeviceBatchResponse(
+        response=batch_result,
+        message=f"Related {batch_result.changed} of {batch_result.matched} devices",
+    )
+
+
+@router.put(
+    "/{issue_id}/devices/bulk-unrelate",
+    response_model=schema.issues.RelatedDeviceBatchResponse,
+)
+async def unrelate_devices(
+    batch_result: schema.issues.RelatedDeviceBatchResult = Depends(
+        services.issues.unrelate_devices
+    ),
+):
+    """Unrelate devices, listed by id or matching a filter, from an issue at once"""
+    return schema.issues.RelatedDeviceBatchResponse(
+        response=batch_result,
+        message=f"Unrelated {batch_result.changed} of {batch_result.matched} devices",
+    )
@@ -0,0 +1,37 @@
+from logging import getLogger
+
+from fastapi import APIRouter, Depends, Request
+
+from ... import migrations, schema, services
+from .. import html
+
+logger = getLogger(__name__)
+router = APIRouter(prefix="/search", tags=["Search"])
+
+
+@router.get("/init", deprecated=True)
+async def install_search_index(
+    install_result=Depends(migrations.apply_migrations),
+):
+    """Initialize the search index
+
+    Pending migrations are applied at startup; this applies any left over.
+    """
+    logger.debug("install_result=%r", install_result)
+    return {"message": "Search index created"}
+
+
+@router.get("", response_model=schema.search.SearchResponse)
+@html.content_negotiation(fast_json=True)
+async def search(
+    _request: Request,
+    search_result: schema.search.SearchServiceResponse = Depends(
+        services.search.search
+    ),
+):
+    """Search issues, devices and users"""
+    return schema.search.SearchResponse(
+        response=search_result.data,
+        page_options=search_result.page_options,
+        q=search_result.q,
+    )
@@ -0,0 +1,59 @@
+from logging import getLogger
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+
+from ... import schema, services
+
+logger = getLogger(__name__)
+router = APIRouter(prefix="/tasks", tags=["Tasks"])
+
+
+@router.post(
+    "",
+    response_model=schema.tasks.TaskCreatedResponse,
+    dependencies=[Depends(services.google.require_admin)],
+)
+async def start_task(
+    task: schema.tasks.TaskServiceResponse = Depends(services.tasks.start_task),
+):
+    """Run a command against the selected devices; admins only"""
+    return schema.tasks.TaskCreatedResponse(response=task.data)
+
+
+@router.get(
+    "/{task_id}",
+    response_model=schema.tasks.TaskResponse,
+    dependencies=[Depends(services.google.require_admin)],
+)
+async def get_task(
+    task: schema.tasks.TaskServiceResponse = Depends(services.tasks.get_task),
+):
+    """Get a task and the results of the devices that have finished; admins only"""
+    return schema.tasks.TaskResponse(response=task.data)
+
+
+@router.get(
+    "/{task_id}/stream",
+    response_class=StreamingResponse,
+    dependencies=[Depends(services.google.require_admin)],
+)
+async def stream_task(stream=Depends(services.tasks.stream_task)):
+    """Stream a running task's output as Server-Sent Events; admins only
+
+    Connect with ``sse-connect`` from the HTMX SSE extension and swap the
+    ``output``, ``status`` and ``done`` events, or ask for ``?format=json``.
+    """
+    return stream
+
+
+@router.post(
+    "/{task_id}/cancel",
+    response_model=schema.tasks.TaskResponse,
+    dependencies=[Depends(services.google.require_admin)],
+)
+async def cancel_task(
+    task: schema.tasks.TaskServiceResponse = Depends(services.tasks.cancel_task),
+):
+    """Cancel a running task; admins only"""
+    return schema.tasks.TaskResponse(response=task.data, message="Task cancelled")
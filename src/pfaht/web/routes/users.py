@@ -1,17 +1,21 @@
 from fastapi import Response, APIRouter, Depends, Request
-from ... import schema, services
+from fastapi.responses import StreamingResponse
+from ... import migrations, schema, services
 from logging import getLogger
 
 logger = getLogger(__name__)
 router = APIRouter(prefix="/users", tags=["Users"])
 
 
-@router.get("/init")
+@router.get("/init", deprecated=True)
 async def install_users_table(
-    install_result=Depends(services.users.create_user_table),
+    install_result=Depends(migrations.apply_migrations),
 ):
-    """Initialize the users table"""
-    logger.debug(f"{install_result=}")
+    """Initialize the users table
+
+    Pending migrations are applied at startup; this applies any left over.
+    """
+    logger.debug("install_result=%r", install_result)
     return {"message": "User table created"}
 
 
@@ -19,9 +23,16 @@ async def install_users_table(
 def list_users(
     _request: Request,
     user_list=Depends(services.users.list_users),
+    page_options: schema.api.PageOptions = Depends(schema.api.PageOptions),
 ):
     """List all users"""
-    return schema.users.ListUserResponse(response=user_list)
+    return schema.users.ListUserResponse(response=user_list, page_options=page_options)
+
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_users(export=Depends(services.users.export_users)):
+    """Stream all users as NDJSON or CSV (``?format=csv``)"""
+    return export
 
 
 @router.delete("/{user_id}", response_model=schema.users.DeleteUserResponse)
@@ -43,7 +54,9 @@ async def list_groups(
     ),
 ) -> schema.users.ListGroupResponse:
     """List all groups"""
-    return schema.users.ListGroupResponse(response=group_list.data)
+    return schema.users.ListGroupResponse(
+        response=group_list.data, page_options=group_list.page_options
+    )
 
 
 @group_router.post("", response_model=schema.users.Group)
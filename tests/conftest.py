@@ -1,10 +1,86 @@
 """
-    Dummy conftest.py for pfaht.
+Fixtures shared by the API tests
 
-    If you don't know what this is for, just leave it empty.
-    Read more about conftest.py under:
-    - https://docs.pytest.org/en/stable/fixture.html
-    - https://docs.pytest.org/en/stable/writing_plugins.html
+Every test gets the app with a fresh, migrated database in its own temporary
+directory, and a client that drives it in process.
 """
 
-# import pytest
+import json
+import os
+
+# Set before the app reads its config
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("FAST_API_RELOAD", "0")
+os.environ.setdefault("TEMPLATE_BYTECODE_CACHE", "0")
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from pfaht import db, schema, services  # noqa: E402
+from pfaht.web import html  # noqa: E402
+
+test_user = schema.users.User(
+    id="user-1",
+    email="user@example.com",
+    verified_email=True,
+    name="Test User",
+    given_name="Test",
+    family_name="User",
+    picture="https://example.com/avatar.png",
+)
+
+
+@pytest.fixture
+def user() -> schema.users.User:
+    return test_user
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app, with its database file in a temporary directory"""
+    from pfaht.web.app import app
+
+    monkeypatch.chdir(tmp_path)
+    html.fragment_cache.clear()
+    db.slow_queries.clear()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def login(client):
+    """Sign `client` in as the test user, a member of `group_ids`"""
+
+    def login(group_ids: tuple[int, ...] = (), user: schema.users.User = test_user):
+        token = services.sessions.create_session_token(user, list(group_ids))
+        client.cookies.set(services.sessions.session_cookie, token)
+        return client
+
+    return login
+
+
+@pytest.fixture
+def bulk(client):
+    """Import `rows` through the bulk endpoint of `table`"""
+
+    def bulk(table: str, rows: list[dict]) -> dict:
+        response = client.post(
+            f"/{table}/bulk",
+            content="\n".join(json.dumps(row) for row in rows),
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        return response.json()["response"]
+
+    return bulk
+
+
+@pytest.fixture
+def anyio_backend():
+    """Async tests run on asyncio, as the app does"""
+    return "asyncio"
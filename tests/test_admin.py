@@ -0,0 +1,37 @@
+import pytest
+
+from pfaht import config
+
+admins = 7
+
+
+@pytest.fixture(autouse=True)
+def admin_group(monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_GROUP_ID", admins)
+
+
+@pytest.mark.parametrize(
+    "method, path",
+    [
+        ("GET", "/admin/slow-queries"),
+        ("DELETE", "/admin/slow-queries"),
+        ("GET", "/admin/fragment-cache"),
+    ],
+)
+def test_admin_routes_need_admin(client, login, method, path):
+    assert client.request(method, path).status_code == 401
+    login(group_ids=(admins + 1,))
+    assert client.request(method, path).status_code == 403
+    login(group_ids=(admins,))
+    assert client.request(method, path).status_code in (200, 204)
+
+
+def test_slow_queries(client, login, monkeypatch):
+    monkeypatch.setattr(config, "SLOW_QUERY_SECONDS", 0)
+    login(group_ids=(admins,))
+    client.get("/devices", headers={"accept": "application/json"})
+    queries = client.get("/admin/slow-queries").json()
+    assert any("FROM devices" in query["query"] for query in queries)
+    assert all(query["plan"] for query in queries)
+    client.delete("/admin/slow-queries")
+    assert client.get("/admin/slow-queries").json() == []
@@ -0,0 +1,76 @@
+import json
+
+from pfaht import config
+
+ndjson = {"content-type": "application/x-ndjson"}
+
+
+def device(name: str) -> bytes:
+    row = {"device_name": name, "device_type": "router", "device_location": "lab"}
+    return json.dumps(row, ensure_ascii=False).encode() + b"\n"
+
+
+def test_import_reports_row_errors(client):
+    body = device("r1") + b"\n" + b'{"device_name": "r2"}\n' + b"not json\n"
+    response = client.post("/devices/bulk", content=body, headers=ndjson)
+    assert response.status_code == 200
+    result = response.json()["response"]
+    assert (result["received"], result["created"], result["failed"]) == (3, 1, 2)
+    assert [error["row"] for error in result["errors"]] == [2, 3]
+
+
+def test_import_decodes_characters_split_across_chunks(client):
+    body = device("r\N{EURO SIGN}")
+    split = body.index("\N{EURO SIGN}".encode()) + 1
+    response = client.post(
+        "/devices/bulk", content=iter([body[:split], body[split:]]), headers=ndjson
+    )
+    assert response.json()["response"]["created"] == 1
+    devices = client.get("/devices", headers={"accept": "application/json"}).json()
+    assert devices["response"][0]["device_name"] == "r\N{EURO SIGN}"
+
+
+def test_import_rejects_invalid_utf8_as_row_error(client):
+    body = device("r1") + b'{"device_name": "\xff"}\n' + device("r3")
+    response = client.post("/devices/bulk", content=body, headers=ndjson)
+    assert response.status_code == 200
+    result = response.json()["response"]
+    assert (result["created"], result["failed"]) == (2, 1)
+    assert result["errors"][0]["row"] == 2
+    assert "UTF-8" in result["errors"][0]["error"]
+
+
+def test_import_rejects_long_lines_as_row_errors(client, monkeypatch):
+    monkeypatch.setattr(config, "BULK_IMPORT_MAX_LINE_BYTES", 100)
+    long_line = b'{"device_name": "' + b"x" * 200 + b'"}\n'
+    body = device("r1") + long_line[:50] + long_line[50:] + device("r3")
+    response = client.post(
+        "/devices/bulk", content=iter([body[:80], body[80:]]), headers=ndjson
+    )
+    result = response.json()["response"]
+    assert (result["created"], result["failed"]) == (2, 1)
+    assert "longer than 100 bytes" in result["errors"][0]["error"]
+
+
+def test_import_csv_reports_row_errors(client):
+    body = (
+        b'issue_title,issue_body,issue_status\r\nt1,"two\nlines",open\r\n'
+        b"t2,b,bogus\r\nt3,b\r\n"
+    )
+    response = client.post(
+        "/issues/bulk", content=body, headers={"content-type": "text/csv"}
+    )
+    result = response.json()["response"]
+    assert (result["created"], result["failed"]) == (1, 2)
+    assert "Expected 3 fields" in result["errors"][1]["error"]
+
+
+def test_import_csv_rejects_unclosed_quotes(client, monkeypatch):
+    monkeypatch.setattr(config, "BULK_IMPORT_MAX_LINE_BYTES", 100)
+    body = b'issue_title,issue_body,issue_status\r\nt1,"' + b"line\n" * 30
+    response = client.post(
+        "/issues/bulk", content=body, headers={"content-type": "text/csv"}
+    )
+    result = response.json()["response"]
+    assert result["created"] == 0
+    assert result["errors"][0]["error"] == "Quoted field is never closed"
@@ -0,0 +1,213 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from pfaht import config
+
+json_accept = {"accept": "application/json"}
+
+
+def new_device(name: str, device_type: str = "router") -> dict:
+    return {"device_name": name, "device_type": device_type, "device_location": "lab"}
+
+
+@pytest.fixture
+def devices(bulk):
+    bulk("devices", [new_device(f"d{i}") for i in range(1, 6)])
+
+
+def device_ids(response) -> list[int]:
+    return [device["device_id"] for device in response.json()["response"]]
+
+
+def test_pages_follow_cursors_both_ways(client, devices):
+    response = client.get("/devices?per_page=2", headers=json_accept)
+    pages = [device_ids(response)]
+    while "Next" in response.json()["links"]:
+        response = client.get(
+            response.json()["links"]["Next"]["url"], headers=json_accept
+        )
+        pages.append(device_ids(response))
+    assert pages == [[1, 2], [3, 4], [5]]
+    prior = response.json()["links"]["Prior"]["url"]
+    assert device_ids(client.get(prior, headers=json_accept)) == [3, 4]
+
+
+def test_pages_go_back_to_the_first_row(client, devices):
+    response = client.get("/devices?per_page=2&after=WzRd", headers=json_accept)
+    pages = [device_ids(response)]
+    while "Prior" in response.json()["links"]:
+        response = client.get(
+            response.json()["links"]["Prior"]["url"], headers=json_accept
+        )
+        pages.append(device_ids(response))
+    assert pages == [[5], [3, 4], [1, 2], []]
+    next_page = response.json()["links"]["Next"]["url"]
+    assert next_page == "/devices?per_page=2"
+    first = client.get("/devices?per_page=2&before=WzNd", headers=json_accept)
+    next_page = first.json()["links"]["Next"]["url"]
+    assert device_ids(client.get(next_page, headers=json_accept)) == [3, 4]
+
+
+def test_empty_page_has_no_links(client, devices):
+    response = client.get("/devices?per_page=2&after=WzVd", headers=json_accept)
+    assert device_ids(response) == []
+    assert response.json()["links"] == {}
+
+
+def test_cursors_follow_the_sort(client, bulk):
+    bulk("devices", [new_device(name) for name in ("c", "a", "b")])
+    response = client.get("/devices?per_page=2&sort=device_name", headers=json_accept)
+    assert device_ids(response) == [2, 3]
+    next_page = response.json()["links"]["Next"]["url"]
+    assert device_ids(client.get(next_page, headers=json_accept)) == [1]
+
+
+def test_device_is_not_sent_again_while_unchanged(client, devices):
+    etag = client.get("/devices/1", headers=json_accept).headers["etag"]
+    response = client.get("/devices/1", headers={**json_accept, "if-none-match": etag})
+    assert response.status_code == 304
+    html = client.get("/devices/1", headers={"accept": "text/html"})
+    assert html.headers["etag"] != etag
+
+
+def test_device_list_tag_changes_with_the_table(client, devices, bulk):
+    etag = client.get("/devices", headers=json_accept).headers["etag"]
+    cached = {**json_accept, "if-none-match": etag}
+    assert client.get("/devices", headers=cached).status_code == 304
+    bulk("devices", [new_device("d6")])
+    assert client.get("/devices", headers=cached).status_code == 200
+
+
+def test_update_needs_the_current_tag(client, devices):
+    etag = client.get("/devices/1", headers=json_accept).headers["etag"]
+    update = new_device("renamed")
+    response = client.put("/devices/1", json=update, headers={"if-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    stale = client.put("/devices/1", json=update, headers={"if-match": etag})
+    assert stale.status_code == 412
+
+
+def test_issue_counts(client, devices, bulk):
+    bulk(
+        "issues",
+        [
+            {"issue_title": t, "issue_body": "", "issue_status": s}
+            for t, s in (("a", "open"), ("b", "closed"))
+        ],
+    )
+    for issue_id in (1, 2):
+        client.put(f"/issues/{issue_id}/devices/bulk-relate", json={"device_ids": [1]})
+    counted = client.get("/devices?counts=true&per_page=2", headers=json_accept).json()
+    first, second = (device["issue_counts"] for device in counted["response"])
+    assert (first["open"], first["closed"], first["pending"]) == (1, 1, 0)
+    assert sum(second.values()) == 0
+    assert "counts=true" in counted["links"]["Next"]["url"]
+    plain = client.get("/devices", headers=json_accept).json()
+    assert plain["response"][0]["issue_counts"] is None
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("conditional", [False, True])
+async def test_concurrent_updates(app, monkeypatch, conditional):
+    monkeypatch.setattr(config, "DATABASE_ENGINE", "pool")
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/devices/bulk",
+            content=json.dumps(new_device("d1")),
+            headers={"content-type": "application/x-ndjson"},
+        )
+        response = await client.get("/devices/1", headers=json_accept)
+        headers = {"if-match": response.headers["etag"]} if conditional else {}
+        responses = await asyncio.gather(
+            *(
+                client.put("/devices/1", json=new_device(f"r{i}"), headers=headers)
+                for i in range(40)
+            )
+        )
+    statuses = sorted(response.status_code for response in responses)
+    assert statuses == ([200] + [412] * 39 if conditional else [200] * 40)
+
+
+@pytest.mark.anyio
+async def test_busy_pool_asks_to_retry(app, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_ENGINE", "pool")
+    monkeypatch.setattr(config, "DATABASE_POOL_SIZE", 1)
+    monkeypatch.setattr(config, "DATABASE_POOL_TIMEOUT", 0.1)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        engine = app.state.database_engine
+        async with engine.session():
+            response = await client.get("/devices", headers=json_accept)
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+        assert engine.metrics.timeouts == 1
+        response = await client.get("/devices", headers=json_accept)
+        assert response.status_code == 200
+
+
+def test_export_reads_in_chunks(client, devices, monkeypatch):
+    monkeypatch.setattr(config, "EXPORT_CHUNK_SIZE", 2)
+    ndjson = client.get("/devices/export").text.splitlines()
+    assert [json.loads(line)["device_id"] for line in ndjson] == [1, 2, 3, 4, 5]
+    csv = client.get("/devices/export?format=csv").text.splitlines()
+    assert csv[0].startswith("device_id,") and len(csv) == 6
+
+
+@pytest.mark.anyio
+async def test_slow_export_leaves_connections_free(app, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_ENGINE", "pool")
+    monkeypatch.setattr(config, "DATABASE_POOL_SIZE", 1)
+    monkeypatch.setattr(config, "DATABASE_POOL_TIMEOUT", 0.5)
+    monkeypatch.setattr(config, "EXPORT_CHUNK_SIZE", 1)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/devices/bulk",
+            content="\n".join(json.dumps(new_device(f"d{i}")) for i in range(3)),
+            headers={"content-type": "application/x-ndjson"},
+        )
+        first_chunk = asyncio.Event()
+        messages = [{"type": "http.request", "body": b""}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # The client never disconnects
+            await asyncio.Event().wait()
+
+        async def send(message):
+            # The client stops reading after the first chunk
+            if message["type"] == "http.response.body" and message["body"]:
+                first_chunk.set()
+                await asyncio.Event().wait()
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/devices/export",
+            "raw_path": b"/devices/export",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"test")],
+            "client": ("test", 1),
+            "server": ("test", 80),
+        }
+        export = asyncio.create_task(app(scope, receive, send))
+        try:
+            await asyncio.wait_for(first_chunk.wait(), 5)
+            response = await client.get("/devices", headers=json_accept)
+            assert response.status_code == 200
+        finally:
+            export.cancel()
+            await asyncio.gather(export, return_exceptions=True)
@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+
+schema_budget = 0.25
+"""Seconds a cold import of pfaht.schema may take, as in benchmarks/run.py"""
+
+heavy_modules = ("fastapi", "databases", "yaml", "rich")
+"""Modules only the app needs, which importing the schema must not load"""
+
+code = f"""
+import json, sys
+from time import perf_counter
+started = perf_counter()
+import pfaht.schema
+seconds = perf_counter() - started
+loaded = [module for module in {heavy_modules!r} if module in sys.modules]
+print(json.dumps({{"seconds": seconds, "loaded": loaded}}))
+"""
+
+
+def import_schema() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    return json.loads(result.stdout)
+
+
+def test_schema_import_stays_light():
+    runs = [import_schema() for _ in range(3)]
+    assert runs[0]["loaded"] == []
+    assert min(run["seconds"] for run in runs) < schema_budget
+
+
+def test_submodules_load_on_first_use():
+    import pfaht
+
+    assert pfaht.metrics.__name__ == "pfaht.metrics"
+    assert "metrics" in dir(pfaht)
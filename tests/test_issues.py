@@ -0,0 +1,62 @@
+import pytest
+
+json_accept = {"accept": "application/json"}
+
+
+@pytest.fixture
+def issue(bulk):
+    bulk(
+        "devices",
+        [
+            {
+                "device_name": f"d{i}",
+                "device_type": device_type,
+                "device_location": "lab",
+            }
+            for i, device_type in enumerate(["router", "router", "switch"], 1)
+        ],
+    )
+    bulk("issues", [{"issue_title": "down", "issue_body": "", "issue_status": "open"}])
+    return 1
+
+
+def relate(client, action: str, batch: dict, issue_id: int = 1):
+    return client.put(f"/issues/{issue_id}/devices/bulk-{action}", json=batch)
+
+
+def test_bulk_relate_counts(client, issue):
+    response = relate(client, "relate", {"device_ids": [1, 99]})
+    assert response.json()["response"] == {"matched": 1, "changed": 1, "related": 1}
+    by_type = {"device_filter": {"device_type": "router"}}
+    response = relate(client, "relate", by_type)
+    assert response.json()["response"] == {"matched": 2, "changed": 1, "related": 2}
+    response = relate(client, "unrelate", {"device_ids": [2, 3]})
+    assert response.json()["response"] == {"matched": 2, "changed": 1, "related": 1}
+
+
+@pytest.mark.parametrize(
+    "batch", [{}, {"device_ids": []}, {"device_filter": {"sort": "device_name"}}]
+)
+def test_bulk_relate_needs_a_selection(client, issue, batch):
+    assert relate(client, "relate", batch).status_code == 422
+
+
+def test_bulk_relate_unknown_issue(client, issue):
+    assert relate(client, "relate", {"device_ids": [1]}, issue_id=9).status_code == 404
+
+
+def test_related_devices_are_paged(client, issue):
+    relate(client, "relate", {"device_ids": [1, 2, 3]})
+    response = client.get("/issues/1/devices?per_page=2", headers=json_accept)
+    first = [device["device_id"] for device in response.json()["response"]]
+    next_page = response.json()["links"]["Next"]["url"]
+    response = client.get(next_page, headers=json_accept)
+    assert first + [d["device_id"] for d in response.json()["response"]] == [1, 2, 3]
+
+
+def test_device_counts(client, issue):
+    relate(client, "relate", {"device_ids": [1, 2]})
+    counted = client.get("/issues?counts=true", headers=json_accept).json()
+    assert counted["response"][0]["device_count"] == 2
+    plain = client.get("/issues", headers=json_accept).json()
+    assert plain["response"][0]["device_count"] is None
@@ -0,0 +1,22 @@
+import logging
+import queue
+import sys
+
+from pfaht.logging import _UnformattedQueueHandler
+
+
+def test_queued_records_are_left_for_the_listener_to_format():
+    log_queue = queue.SimpleQueue()
+    handler = _UnformattedQueueHandler(log_queue)
+    handler.setFormatter(logging.Formatter("formatted %(message)s"))
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.makeLogRecord(
+            {"msg": "failed %s", "args": ("job",), "exc_info": sys.exc_info()}
+        )
+    handler.handle(record)
+    queued = log_queue.get_nowait()
+    assert (queued.msg, queued.args) == ("failed job", None)
+    assert queued.exc_info[0] is ValueError
+    assert (record.msg, record.args) == ("failed %s", ("job",))
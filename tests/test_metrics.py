@@ -0,0 +1,16 @@
+from pfaht import config
+
+
+def test_metrics_not_served_without_token(client, monkeypatch):
+    monkeypatch.setattr(config, "METRICS_TOKEN", None)
+    assert client.get("/metrics").status_code == 404
+
+
+def test_metrics_need_token(client, monkeypatch):
+    monkeypatch.setattr(config, "METRICS_TOKEN", "scrape")
+    assert client.get("/metrics").status_code == 401
+    wrong = {"Authorization": "Bearer guess"}
+    assert client.get("/metrics", headers=wrong).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape"})
+    assert response.status_code == 200
+    assert "pfaht_http_requests" in response.text
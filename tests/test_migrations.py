@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from pfaht import db, migrations
+
+device = {"device_name": "r1", "device_type": "router", "device_location": "lab"}
+issue = {"issue_title": "link down", "issue_body": "r1", "issue_status": "open"}
+
+
+@pytest.fixture
+def connection(bulk):
+    bulk("devices", [device])
+    bulk("issues", [issue])
+    with db.get_self_db() as connection:
+        yield connection
+
+
+def versions(connection) -> tuple[int, int]:
+    """Row version of the device and table version of the devices table"""
+    return connection.execute(
+        "SELECT row_version, "
+        "(SELECT version FROM table_versions WHERE table_name = 'devices') "
+        "FROM devices WHERE device_id = 1"
+    ).fetchone()
+
+
+def search(connection, term: str) -> list[int]:
+    rows = connection.execute(
+        "SELECT rowid FROM devices_fts WHERE devices_fts MATCH ?", (term,)
+    )
+    return [rowid for (rowid,) in rows]
+
+
+def test_every_migration_is_applied(connection):
+    applied = {
+        row[0] for row in connection.execute("SELECT version FROM schema_migrations")
+    }
+    assert applied == {migration.version for migration in migrations.migrations}
+
+
+def test_update_moves_versions_once(client, connection):
+    row_version, table_version = versions(connection)
+    response = client.put("/devices/1", json={**device, "device_name": "r2"})
+    assert response.status_code == 200
+    connection.rollback()
+    assert versions(connection) == (row_version + 1, table_version + 1)
+    assert (search(connection, "r1"), search(connection, "r2")) == ([], [1])
+
+
+def test_trigger_moves_versions_of_other_updates(connection):
+    row_version, table_version = versions(connection)
+    with connection:
+        connection.execute("UPDATE devices SET device_name = 'r2'")
+    assert versions(connection) == (row_version + 1, table_version + 1)
+    assert search(connection, "r2") == [1]
+
+
+@pytest.mark.parametrize("table", ["devices", "issues"])
+def test_export_leaves_out_row_versions(client, connection, table):
+    response = client.get(f"/{table}/export")
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 1
+    assert "row_version" not in rows[0]
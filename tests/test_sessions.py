@@ -0,0 +1,74 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from pfaht import config, services
+from pfaht.services import sessions
+
+user_info = {
+    "id": "google-1",
+    "email": "user@example.com",
+    "verified_email": True,
+    "name": "Test User",
+    "given_name": "Test",
+    "family_name": "User",
+    "picture": "https://example.com/avatar.png",
+}
+
+
+@pytest.fixture
+def google(app, monkeypatch):
+    """A client whose calls to Google are answered, and counted, locally"""
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.method)
+        if request.method == "POST":
+            token = {"access_token": "at", "expires_in": 3600, "refresh_token": "rt"}
+            return httpx.Response(200, json=token)
+        return httpx.Response(200, json=user_info)
+
+    monkeypatch.setattr(
+        services.google,
+        "create_http_client",
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    with TestClient(app) as client:
+        yield client, calls
+
+
+def test_token_round_trip(user):
+    token = sessions.create_session_token(user, [3])
+    claims = sessions.decode_session_token(token)
+    assert (claims.user, claims.group_ids) == (user, [3])
+
+
+def test_tampered_and_expired_tokens_are_rejected(user):
+    token = sessions.create_session_token(user, [])
+    assert sessions.decode_session_token(token[:-2] + "xx") is None
+    expired = sessions.create_session_token(user, [], now=0)
+    assert sessions.decode_session_token(expired) is None
+
+
+def test_refresh_window(user):
+    claims = sessions.decode_session_token(sessions.create_session_token(user, []))
+    assert not sessions.needs_refresh(
+        claims, now=claims.exp - config.SESSION_REFRESH_WINDOW - 1
+    )
+    assert sessions.needs_refresh(
+        claims, now=claims.exp - config.SESSION_REFRESH_WINDOW
+    )
+
+
+def test_login_issues_a_session_checked_without_google(google):
+    client, calls = google
+    response = client.get("/auth/google?code=x")
+    assert response.status_code == 200
+    assert sessions.session_cookie in client.cookies
+    google_calls = len(calls)
+    for _ in range(3):
+        me = client.get("/auth/google/me").json()["response"]
+        assert me["id"] == "google-1"
+    assert len(calls) == google_calls
+    client.get("/auth/logout")
+    assert client.get("/auth/google/me").json()["response"] is None
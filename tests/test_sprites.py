@@ -0,0 +1,29 @@
+import pytest
+
+from pfaht.web import html
+
+
+def test_sprite_is_served_when_it_cannot_be_written(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(html.sprite, "path", tmp_path / "missing" / "sprite.svg")
+    html.sprite.load()
+    assert not html.sprite.path.exists()
+    response = client.get(html.sprite.url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/svg+xml"
+    assert "immutable" in response.headers["cache-control"]
+    assert '<symbol id="svgrepo-router"' in response.text
+    assert html.sprite.href("svgrepo/router.svg").startswith(html.sprite.url)
+
+
+@pytest.mark.parametrize(
+    "icon, symbol",
+    [
+        ("svgrepo/router.svg", "svgrepo-router"),
+        ("svgrepo/missing.svg", "heroicons-solid-cog-6-tooth"),
+    ],
+)
+def test_icon_button_falls_back_to_the_default_icon(client, icon, symbol):
+    template = html.templates.env.get_template("component/icon-button.html")
+    markup = template.render(icon=icon)
+    assert f'<use href="{html.sprite.url}#{symbol}">' in markup
+    assert "None" not in markup
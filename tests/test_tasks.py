@@ -0,0 +1,158 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from pfaht import config, services
+
+admins = 7
+
+
+@pytest.fixture(autouse=True)
+def admin_group(monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_GROUP_ID", admins)
+
+
+@pytest.fixture
+def device_id(bulk):
+    bulk(
+        "devices",
+        [{"device_name": "r1", "device_type": "router", "device_location": "lab"}],
+    )
+    return 1
+
+
+def new_task(device_id: int, command: str = "echo hello") -> dict:
+    return {"command": command, "devices": {"device_ids": [device_id]}}
+
+
+def wait_for(client, task_id: int) -> dict:
+    for _ in range(100):
+        task = client.get(f"/tasks/{task_id}").json()["response"]
+        if task["status"] != "running":
+            return task
+        time.sleep(0.05)
+    raise AssertionError(f"Task {task_id} is still running")
+
+
+def test_start_needs_login(client, device_id):
+    assert client.post("/tasks", json=new_task(device_id)).status_code == 401
+
+
+def test_start_needs_admin(client, login, device_id):
+    login(group_ids=(admins + 1,))
+    assert client.post("/tasks", json=new_task(device_id)).status_code == 403
+
+
+def test_cancel_needs_admin(client, login):
+    assert client.post("/tasks/1/cancel").status_code == 401
+    login()
+    assert client.post("/tasks/1/cancel").status_code == 403
+
+
+@pytest.mark.parametrize("path", ["/tasks/1", "/tasks/1/stream"])
+def test_reading_needs_admin(client, login, path):
+    assert client.get(path).status_code == 401
+    login()
+    assert client.get(path).status_code == 403
+
+
+def test_admin_runs_task_without_app_secrets(client, login, device_id):
+    login(group_ids=(admins,))
+    command = 'echo "$PFAHT_DEVICE_NAME:$SESSION_SECRET"'
+    response = client.post("/tasks", json=new_task(device_id, command))
+    assert response.status_code == 200
+    task = wait_for(client, response.json()["response"]["task_id"])
+    assert task["status"] == "succeeded"
+    assert task["results"][0]["stdout"] == "r1:\n"
+
+
+def test_admin_cancels_task(client, login, device_id):
+    login(group_ids=(admins,))
+    response = client.post("/tasks", json=new_task(device_id, "sleep 5"))
+    task_id = response.json()["response"]["task_id"]
+    response = client.post(f"/tasks/{task_id}/cancel")
+    assert response.status_code == 200
+    assert wait_for(client, task_id)["status"] == "cancelled"
+
+
+def test_command_times_out(client, login, device_id):
+    login(group_ids=(admins,))
+    task = {**new_task(device_id, "sleep 5"), "timeout": 0.1}
+    task_id = client.post("/tasks", json=task).json()["response"]["task_id"]
+    assert wait_for(client, task_id)["results"][0]["status"] == "timed_out"
+
+
+async def open_stream(app, path: str, cookie: str) -> asyncio.Task:
+    """Start a streamed request to `app`, returning once its headers are sent"""
+    started = asyncio.Event()
+    messages = [{"type": "http.request", "body": b""}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The client never disconnects
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            started.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"format=json",
+        "root_path": "",
+        "headers": [(b"host", b"test"), (b"cookie", cookie.encode())],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    stream = asyncio.create_task(app(scope, receive, send))
+    await asyncio.wait_for(started.wait(), 5)
+    return stream
+
+
+@pytest.mark.anyio
+async def test_open_streams_leave_connections_free(app, user, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_POOL_SIZE", 2)
+    monkeypatch.setattr(config, "DATABASE_POOL_TIMEOUT", 1)
+    token = services.sessions.create_session_token(user, [admins])
+    cookie = f"{services.sessions.session_cookie}={token}"
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://test",
+        headers={"cookie": cookie},
+    ) as client:
+        device = {
+            "device_name": "r1",
+            "device_type": "router",
+            "device_location": "lab",
+        }
+        await client.post(
+            "/devices/bulk",
+            content=json.dumps(device),
+            headers={"content-type": "application/x-ndjson"},
+        )
+        response = await client.post("/tasks", json=new_task(1, "sleep 10"))
+        task_id = response.json()["response"]["task_id"]
+        streams = [
+            await open_stream(app, f"/tasks/{task_id}/stream", cookie)
+            for _ in range(config.DATABASE_POOL_SIZE + 1)
+        ]
+        try:
+            response = await client.get(
+                "/devices", headers={"accept": "application/json"}
+            )
+            assert response.status_code == 200
+        finally:
+            await client.post(f"/tasks/{task_id}/cancel")
+            for stream in streams:
+                stream.cancel()
+            await asyncio.gather(*streams, return_exceptions=True)